@@ -1,8 +1,19 @@
-"""Load settings on import"""
+"""Settings and constants shared by the modules"""
+from collections.abc import MutableMapping
 from enum import IntEnum
+import os
 import sys
+import threading
+import time
+import traceback
+from typing import Dict, Iterator, Optional
 import yaml
 
+SETTINGS_ENV = "GPTUTOR_SETTINGS"
+ENV_PREFIX = "GPTUTOR_"
+# Seconds between checks whether the settings file changed.
+RELOAD_CHECK_INTERVAL = 1.0
+
 
 class MessageType(IntEnum):
     """Type of message send or received from the GPT API"""
@@ -15,13 +26,111 @@ class MessageType(IntEnum):
     EXERCISE_EVAL = 6
 
 
-try:
-    if len(sys.argv) > 1:
-        with open(sys.argv[1], "r") as yaml_file:
-            print("Loading yaml")  # How often does this actually get loaded by Dash?!
+class Settings(MutableMapping):
+    """
+    The settings yaml, loaded on first use and again when the file changes
+
+    Environment variables override values in the file: GPTUTOR_DATABASE__URL
+    sets url in the database section. The values are parsed as yaml.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self.loads = 0
+        self._data: Optional[Dict] = None
+        self._mtime: Optional[float] = None
+        self._checked = 0.0
+        self._lock = threading.Lock()
+        os.register_at_fork(after_in_child=self._reset_lock)
+
+    def _reset_lock(self):
+        """A lock held by another thread while forking is never released"""
+        self._lock = threading.Lock()
+
+    def use(self, path: str):
+        """Read the settings from path from now on"""
+        with self._lock:
+            self.path = path
+            self._data = None
+
+    def _modified(self) -> Optional[float]:
+        """Modification time of the file, None if there is no file"""
+        try:
+            return os.stat(self.path).st_mtime if self.path is not None else None
+        except OSError:
+            return None
+
+    def _load(self) -> Dict:
+        """
+        Read the file and apply the environment overrides
+
+        When the file can't be read after an earlier load, e.g. while it is
+        being edited, the last good settings are kept.
+        """
+        data: Dict = {}
+        if self.path is not None:
             try:
-                app_settings = yaml.safe_load(yaml_file)
-            except yaml.YAMLError:
-                pass
-except FileNotFoundError:
-    pass
+                with open(self.path, "r") as yaml_file:
+                    data = yaml.safe_load(yaml_file) or {}
+            except (OSError, yaml.YAMLError):
+                if self._data is not None:
+                    print(
+                        f"Keeping the last settings, {self.path} can't be loaded:",
+                        file=sys.stderr,
+                    )
+                    traceback.print_exc()
+                    return self._data
+        for name, value in os.environ.items():
+            if not name.startswith(ENV_PREFIX) or name == SETTINGS_ENV:
+                continue
+            *sections, key = name[len(ENV_PREFIX) :].lower().split("__")
+            target = data
+            for section in sections:
+                target = target.setdefault(section, {})
+            target[key] = yaml.safe_load(value)
+        self.loads += 1
+        return data
+
+    @property
+    def data(self) -> Dict:
+        """The settings, reloaded when the file changed since the last load"""
+        now = time.monotonic()
+        if self._data is not None and now - self._checked < RELOAD_CHECK_INTERVAL:
+            return self._data
+        with self._lock:
+            self._checked = now
+            mtime = self._modified()
+            if self._data is None or mtime != self._mtime:
+                self._mtime = mtime
+                self._data = self._load()
+            return self._data
+
+    @property
+    def version(self) -> int:
+        """Changes whenever the settings are loaded again"""
+        # Reading data loads the file again when it changed.
+        _ = self.data
+        return self.loads
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __setitem__(self, key, value):
+        self.data[key] = value
+
+    def __delitem__(self, key):
+        del self.data[key]
+
+    def __iter__(self) -> Iterator:
+        return iter(self.data)
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+
+# The settings file is the first argument, or GPTUTOR_SETTINGS when the app is
+# loaded by a WSGI server. Empty when there is neither, e.g. when running
+# database.py directly.
+app_settings = Settings(
+    os.environ.get(SETTINGS_ENV, sys.argv[1] if len(sys.argv) > 1 else None)
+)
@@ -0,0 +1,147 @@
+"""
+Check that concurrent users have their answers graded against their own exercise
+
+Run as `python benchmarks/concurrent_grading.py gptutor.yaml`. Half of the
+simulated users are logged in, half are anonymous. Each starts an exercise,
+submits an answer naming the user and waits for the evaluation. Afterwards
+every saved answer must belong to an exercise of the user who wrote it. A fresh
+SQLite database and the fake completion backend are used. Pass --write-behind
+to save through the write-behind writer.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple
+
+import sqlalchemy
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app_globals  # noqa: E402
+import database  # noqa: E402
+import main as app_main  # noqa: E402
+import migrations  # noqa: E402
+import write_behind  # noqa: E402
+from app_globals import MessageType  # noqa: E402
+from dash_client import DashClient  # noqa: E402
+
+POLL_INTERVAL = 0.1
+
+
+def wait_for(client: DashClient, stream_id: str):
+    """Poll the stream until it is done, returns the last response"""
+    n_intervals = 0
+    while True:
+        time.sleep(POLL_INTERVAL)
+        n_intervals += 1
+        response = client.call("poll_stream", [n_intervals], [stream_id])
+        if response.get("stream-interval", {}).get("disabled"):
+            return response
+
+
+def simulate_user(app, index: int, user_id):
+    """Start an exercise and answer it, returns whether it was evaluated"""
+    client = DashClient(app)
+    if user_id is not None:
+        client.login({"id": user_id})
+    state = ["Easy", "Python", "15 minutes", None, "Start", None]
+    response = client.call("start_exercise", [1], state)
+    response = wait_for(client, response["stream-id"]["data"])
+    active = response["active-exercise"]["data"]
+
+    state = ["Easy", "Python", "15 minutes", f"Answer of user {index}", "Done", active]
+    response = client.call("start_exercise", [2], state)
+    response = wait_for(client, response["stream-id"]["data"])
+    evaluation = response.get("exercise-eval", {}).get("children", "")
+    return evaluation != "Something went wrong, please try again."
+
+
+def create_users(users: int) -> Dict[int, int]:
+    """Create an account for every other simulated user, returns their ids"""
+    user_ids = {}
+    with database.Session(database.get_engine()) as session:
+        for index in range(0, users, 2):
+            user = database.User(
+                username=f"user{index}", email=f"user{index}@mail", password=b""
+            )
+            session.add(user)
+            session.flush()
+            user_ids[index] = user.id
+        session.commit()
+    return user_ids
+
+
+def run_users(app, users: int, user_ids: Dict[int, int]) -> List[bool]:
+    """Simulate the users at the same time, returns which were evaluated"""
+    with ThreadPoolExecutor(max_workers=users) as pool:
+        return list(
+            pool.map(
+                lambda index: simulate_user(app, index, user_ids.get(index)),
+                range(users),
+            )
+        )
+
+
+def saved_answers(user_ids: Dict[int, int]) -> Tuple[List, List]:
+    """The saved answers and those saved with another user's exercise"""
+    with database.Session(database.get_engine()) as session:
+        answers = session.execute(
+            sqlalchemy.select(database.Message.text, database.Exercise.user_id)
+            .join(database.Exercise)
+            .where(database.Message.message_type == MessageType.EXERCISE_ANSWER)
+        ).all()
+    owners = {f"Answer of user {index}": user_id for index, user_id in user_ids.items()}
+    misplaced = [text for text, user_id in answers if owners.get(text) != user_id]
+    return answers, misplaced
+
+
+def main():
+    """Parse the arguments, run the users and check the saved answers"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("settings")
+    parser.add_argument("--users", type=int, default=32)
+    parser.add_argument("--write-behind", action="store_true")
+    args = parser.parse_args()
+
+    settings = app_globals.app_settings
+    settings["completion_backend"] = {
+        "type": "fake",
+        "latency": 0.2,
+        "tokens_per_second": 200.0,
+    }
+    settings.pop("exercise_cache", None)
+    settings.pop("write_behind", None)
+    if args.write_behind:
+        settings["write_behind"] = {}
+    settings["rate_limits"] = {
+        "user_per_minute": 60 * args.users,
+        "user_burst": args.users,
+        "global_per_minute": 60 * args.users,
+        "global_burst": 2 * args.users,
+    }
+
+    with tempfile.TemporaryDirectory() as directory:
+        database.engine = database.create_engine_from_settings(
+            {"url": "sqlite:///" + os.path.join(directory, "grading.sqlite")}
+        )
+        migrations.upgrade(database.engine)
+        user_ids = create_users(args.users)
+        app = app_main.create_app(settings)
+        evaluated = run_users(app, args.users, user_ids)
+        if args.write_behind:
+            write_behind.writer().flush()
+        answers, misplaced = saved_answers(user_ids)
+        database.engine.dispose()
+
+    print(f"{args.users} users, {sum(evaluated)} answers evaluated")
+    print(f"{len(answers)} answers saved for {len(user_ids)} logged in users")
+    print(f"{len(misplaced)} answers saved with another user's exercise")
+    if misplaced or not all(evaluated) or len(answers) != len(user_ids):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
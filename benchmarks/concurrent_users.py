@@ -0,0 +1,101 @@
+"""
+Throughput of exercise generation with N concurrent simulated users
+
+Run as `python benchmarks/concurrent_users.py gptutor.yaml`. Completions come
+from the fake backend, so no tokens are used. A fixed number of
+request workers stands in for the Flask worker threads. In blocking mode each
+request generates the exercise itself, in jobs mode a request only starts a
+background job and the user polls for the result like the browser does. The
+jobs are kept in a fresh SQLite database.
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app_globals  # noqa: E402
+import database  # noqa: E402
+import exercises  # noqa: E402
+import migrations  # noqa: E402
+import streaming  # noqa: E402
+
+POLL_INTERVAL = 0.25
+
+
+def blocking_user(workers: ThreadPoolExecutor) -> float:
+    """Generate an exercise inside a request, return the time it took"""
+    start = time.perf_counter()
+    workers.submit(exercises.get_exercise, "Easy", "Python", "15 minutes").result()
+    return time.perf_counter() - start
+
+
+def jobs_user(workers: ThreadPoolExecutor) -> float:
+    """Start a background job in a request and poll until it is done"""
+    start = time.perf_counter()
+
+    def target(stream):
+        messages = exercises.stream_exercise(
+            "Easy", "Python", "15 minutes", stream.write, stream.clear
+        )
+        stream.finish(title=messages[3]["content"])
+
+    stream_id = workers.submit(streaming.start, "exercise", target).result()
+    while True:
+        time.sleep(POLL_INTERVAL)
+        stream = workers.submit(streaming.get, stream_id).result()
+        if stream.done:
+            streaming.discard(stream_id)
+            return time.perf_counter() - start
+
+
+def run(mode: str, users: int, request_workers: int):
+    """Let all users generate one exercise at the same time"""
+    user = blocking_user if mode == "blocking" else jobs_user
+    with ThreadPoolExecutor(max_workers=request_workers) as workers:
+        with ThreadPoolExecutor(max_workers=users) as clients:
+            start = time.perf_counter()
+            latencies = list(clients.map(lambda _: user(workers), range(users)))
+            elapsed = time.perf_counter() - start
+    print(
+        f"{mode:>8}: {users / elapsed:6.2f} exercises/s, "
+        f"median latency {statistics.median(latencies):5.2f}s, "
+        f"max latency {max(latencies):5.2f}s"
+    )
+
+
+def main():
+    """Parse the arguments and run both modes"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("settings")
+    parser.add_argument("--users", type=int, default=32)
+    parser.add_argument("--request-workers", type=int, default=4)
+    parser.add_argument("--latency", type=float, default=0.5)
+    parser.add_argument("--tokens-per-second", type=float, default=50.0)
+    args = parser.parse_args()
+
+    # Measure generation, not the cache or the pool.
+    settings = app_globals.app_settings
+    settings.pop("exercise_cache", None)
+    settings.setdefault("jobs", {})["max_workers"] = args.users
+    settings["completion_backend"] = {
+        "type": "fake",
+        "latency": args.latency,
+        "tokens_per_second": args.tokens_per_second,
+    }
+    with tempfile.TemporaryDirectory() as directory:
+        database.engine = database.create_engine_from_settings(
+            {"url": "sqlite:///" + os.path.join(directory, "gptutor.sqlite")}
+        )
+        migrations.upgrade(database.engine)
+        for mode in ("blocking", "jobs"):
+            run(mode, args.users, args.request_workers)
+        database.engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
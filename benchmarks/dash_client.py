@@ -0,0 +1,50 @@
+"""Call Dash callbacks over HTTP like the browser does, for benchmarks"""
+from typing import Any, Dict, List, Sequence
+
+from dash import Dash
+
+
+class DashClient:
+    """A browser stand-in using the Flask test client of a Dash app"""
+
+    def __init__(self, app: Dash):
+        self.app = app
+        self.client = app.server.test_client()
+        # Dash registers the callbacks on the first request.
+        self.client.get("/")
+
+    def login(self, user: Dict):
+        """Put a user in the Flask session"""
+        with self.client.session_transaction() as session:
+            session["user"] = user
+
+    def callback_spec(self, name: str):
+        """Find the output key and spec of a callback by function name"""
+        for key, spec in self.app.callback_map.items():
+            if getattr(spec.get("callback"), "__name__", "") == name:
+                return key, spec
+        raise KeyError(name)
+
+    def call(
+        self, name: str, inputs: Sequence[Any], state: Sequence[Any] = ()
+    ) -> Dict[str, Dict[str, Any]]:
+        """Call a callback, returns {component id: {property: value}}"""
+        key, spec = self.callback_spec(name)
+        outputs: List[Dict[str, str]] = []
+        for output in key.strip(".").split("..."):
+            component_id, prop = output.rsplit(".", 1)
+            outputs.append({"id": component_id, "property": prop})
+        first_input = spec["inputs"][0]
+        payload = {
+            "output": key,
+            "outputs": outputs if key.startswith("..") else outputs[0],
+            "inputs": [dict(i, value=v) for i, v in zip(spec["inputs"], inputs)],
+            "state": [dict(s, value=v) for s, v in zip(spec["state"], state)],
+            "changedPropIds": [f"{first_input['id']}.{first_input['property']}"],
+        }
+        response = self.client.post("/_dash-update-component", json=payload)
+        if response.status_code == 204:
+            return {}
+        if response.status_code != 200:
+            raise RuntimeError(f"{name} failed: {response.status_code}")
+        return response.get_json()["response"]
@@ -0,0 +1,140 @@
+"""
+Concurrent exercise saves with the old and the new database settings
+
+Run as `python benchmarks/db_saves.py`. Each thread saves exercises with
+their four messages like start_exercise does, in a fresh SQLite file. The old
+settings log every statement and use SQLite's defaults, the new ones don't log
+and use WAL mode with normal synchronisation. write-behind uses the new settings
+and queues the saves for the write-behind writer. Besides throughput the time a
+request spends saving is reported.
+"""
+import argparse
+import contextlib
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database  # noqa: E402
+import write_behind  # noqa: E402
+from app_globals import MessageType  # noqa: E402
+
+CONFIGURATIONS = {
+    "before": {
+        "echo": True,
+        "sqlite_pragmas": {
+            "journal_mode": "DELETE",
+            "synchronous": "FULL",
+            "busy_timeout": 5000,
+            "mmap_size": 0,
+        },
+    },
+    "after": {},
+    "write-behind": {},
+}
+MESSAGE_TYPES = (
+    MessageType.INITIAL_QUESTION,
+    MessageType.INITIAL_EXERCISE,
+    MessageType.ASK_TITLE,
+    MessageType.EXERCISE_TITLE,
+)
+
+
+def save_exercises(engine, user_id: int, count: int) -> float:
+    """Save count exercises with their messages, one transaction each"""
+    start = time.perf_counter()
+    for _ in range(count):
+        with database.Session(engine) as session:
+            exercise = database.save_exercise(session, user_id, "A title", time.time())
+            session.add_all(
+                database.Message(
+                    exercise=exercise,
+                    role="user",
+                    text="Some text " * 50,
+                    message_type=message_type,
+                )
+                for message_type in MESSAGE_TYPES
+            )
+            session.commit()
+    return time.perf_counter() - start
+
+
+def queue_exercises(writer, user_id: int, count: int) -> float:
+    """Queue count exercises with their messages for the writer"""
+    start = time.perf_counter()
+    for _ in range(count):
+        writer.save_exercise(
+            user_id,
+            "A title",
+            time.time(),
+            [
+                {
+                    "role": "user",
+                    "text": "Some text " * 50,
+                    "message_type": message_type,
+                }
+                for message_type in MESSAGE_TYPES
+            ],
+        )
+    return time.perf_counter() - start
+
+
+def run(name: str, threads: int, saves: int):
+    """Time the saves of all threads with one configuration"""
+    with tempfile.TemporaryDirectory() as directory:
+        settings = dict(
+            CONFIGURATIONS[name],
+            url="sqlite:///" + os.path.join(directory, "benchmark.sqlite"),
+            pool_size=threads,
+        )
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            engine = database.create_engine_from_settings(settings)
+            database.Base.metadata.create_all(engine)
+            with database.Session(engine) as session:
+                user = database.User(username="user", email="e@mail", password=b"")
+                session.add(user)
+                session.commit()
+                user_id = user.id
+
+            if name == "write-behind":
+                writer = write_behind.WriteBehind(
+                    engine,
+                    write_behind.DEFAULT_FLUSH_INTERVAL,
+                    write_behind.DEFAULT_MAX_BATCH,
+                )
+                target, first = queue_exercises, writer
+            else:
+                target, first = save_exercises, engine
+
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=threads) as executor:
+                futures = [
+                    executor.submit(target, first, user_id, saves)
+                    for _ in range(threads)
+                ]
+                saving = sum(future.result() for future in futures)
+            if name == "write-behind":
+                writer.flush()
+            elapsed = time.perf_counter() - start
+            engine.dispose()
+    print(
+        f"{name:>12}: {threads * saves / elapsed:8.1f} exercises saved/s, "
+        f"{saving / (threads * saves) * 1000:7.3f} ms per save in the request"
+    )
+
+
+def main():
+    """Parse the arguments and run both configurations"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--saves", type=int, default=50)
+    args = parser.parse_args()
+    for name in CONFIGURATIONS:
+        run(name, args.threads, args.saves)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+"""
+Server requests made by browsers while users work on an exercise
+
+Run as `python benchmarks/exercise_requests.py gptutor.yaml --users 100`. Each
+simulated user starts an exercise, then keeps it open for --seconds seconds.
+Like the browser, every tick of the stopwatch interval calls the server side
+callbacks that depend on it. Pass --server-timer to add back the stopwatch as a
+server callback, as it was before it moved to the browser. The exercises are
+kept in a fresh SQLite database.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from dash import callback, Input, Output
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app_globals  # noqa: E402
+import database  # noqa: E402
+import main as app_main  # noqa: E402
+import migrations  # noqa: E402
+import streaming  # noqa: E402
+from dash_client import DashClient  # noqa: E402
+
+TIMER_INPUT = "interval-component.n_intervals"
+
+
+def register_server_timer():
+    """The stopwatch as a server callback"""
+
+    @callback(
+        Output("stopwatch", "children", allow_duplicate=True),
+        [
+            Input("interval-component", "n_intervals"),
+            Input("timer-start-in-seconds", "data"),
+        ],
+        prevent_initial_call=True,
+    )
+    def server_timer(_, timer_start):
+        """Format the time since timer_start"""
+        if timer_start is None:
+            return "00:00:00"
+        seconds = int(time.time() - timer_start)
+        return "{:02d}:{:02d}:{:02d}".format(
+            seconds // 3600, seconds % 3600 // 60, seconds % 60
+        )
+
+
+def timer_callbacks(app):
+    """Names of the server callbacks triggered by the stopwatch"""
+    names = []
+    for spec in app.callback_map.values():
+        inputs = [f"{i['id']}.{i['property']}" for i in spec["inputs"]]
+        if "callback" in spec and TIMER_INPUT in inputs:
+            names.append(spec["callback"].__name__)
+    return names
+
+
+def simulate_user(app, seconds: float, tick: float) -> int:
+    """
+    Start an exercise and fire the stopwatch callbacks for seconds
+
+    Returns the number of requests made while the exercise was open.
+    """
+    client = DashClient(app)
+    response = client.call(
+        "start_exercise", [1], ["Easy", "Python", "15 minutes", None, "Start", None]
+    )
+    stream_id = response["stream-id"]["data"]
+    n_intervals = 0
+    while True:
+        time.sleep(0.25)
+        n_intervals += 1
+        # The poll only shows that something went wrong, the stream says what.
+        stream = streaming.get(stream_id)
+        if stream is not None and stream.error is not None:
+            raise RuntimeError(f"The exercise failed: {stream.error}")
+        response = client.call("poll_stream", [n_intervals], [stream_id])
+        if response.get("stream-interval", {}).get("disabled"):
+            break
+    timer_start = response["timer-start-in-seconds"]["data"]
+
+    names = timer_callbacks(app)
+    end = time.monotonic() + seconds
+    n_intervals = 0
+    requests = 0
+    while time.monotonic() < end:
+        time.sleep(tick)
+        n_intervals += 1
+        for name in names:
+            client.call(name, [n_intervals, timer_start])
+            requests += 1
+    return requests
+
+
+def main():
+    """Parse the arguments and count the requests during the exercises"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("settings")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--seconds", type=float, default=10.0)
+    parser.add_argument("--server-timer", action="store_true")
+    args = parser.parse_args()
+
+    settings = app_globals.app_settings
+    settings["completion_backend"] = {
+        "type": "fake",
+        "latency": 0.0,
+        "tokens_per_second": 10000.0,
+    }
+    settings.pop("write_behind", None)
+    settings["rate_limits"] = {
+        "user_per_minute": 60 * args.users,
+        "user_burst": args.users,
+        "global_per_minute": 60 * args.users,
+        "global_burst": args.users,
+    }
+    if args.server_timer:
+        register_server_timer()
+
+    # The stopwatch interval ticks every second.
+    tick = 1.0
+    with tempfile.TemporaryDirectory() as directory:
+        database.engine = database.create_engine_from_settings(
+            {"url": "sqlite:///" + os.path.join(directory, "gptutor.sqlite")}
+        )
+        migrations.upgrade(database.engine)
+        app = app_main.create_app(settings)
+        with ThreadPoolExecutor(max_workers=args.users) as users:
+            requests = sum(
+                users.map(
+                    lambda _: simulate_user(app, args.seconds, tick),
+                    range(args.users),
+                )
+            )
+        database.engine.dispose()
+
+    print(f"stopwatch callbacks on the server: {timer_callbacks(app) or 'none'}")
+    print(
+        f"{args.users} users exercising for {args.seconds:.0f}s made {requests} "
+        f"requests, {requests / args.seconds:.1f} requests/s"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""
+A local stand-in for the OpenAI chat completion endpoint
+
+Run as `python benchmarks/fake_openai_server.py --port 8000` and point the
+app at it with
+
+completion_backend:
+  type: local
+  api_base: http://localhost:8000/v1
+
+Replies come from the fake backend, so they are deterministic and take a
+configurable time, but unlike the in-process fake they go over HTTP.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from completion_backends import FakeBackend  # noqa: E402
+
+
+class CompletionHandler(BaseHTTPRequestHandler):
+    """Handle POST /v1/chat/completions"""
+
+    backend = FakeBackend()
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        """Reply with a completion, streamed if asked for"""
+        if self.path.rstrip("/") != "/v1/chat/completions":
+            self.send_error(404)
+            return
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        messages = body["messages"]
+        model = body.get("model", "fake")
+        created = int(time.time())
+
+        if not body.get("stream", False):
+            content = self.backend.complete(messages, model)
+            reply = json.dumps(
+                {
+                    "id": "fake",
+                    "object": "chat.completion",
+                    "created": created,
+                    "model": model,
+                    "choices": [
+                        {
+                            "index": 0,
+                            "message": {"role": "assistant", "content": content},
+                            "finish_reason": "stop",
+                        }
+                    ],
+                }
+            ).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(reply)))
+            self.end_headers()
+            self.wfile.write(reply)
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for token in self.backend.stream(messages, model):
+            chunk = {
+                "id": "fake",
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "delta": {"content": token}}],
+            }
+            self.write_chunk(f"data: {json.dumps(chunk)}\n\n")
+        self.write_chunk("data: [DONE]\n\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def write_chunk(self, data: str):
+        """Write data using chunked transfer encoding"""
+        encoded = data.encode("utf-8")
+        self.wfile.write(f"{len(encoded):x}\r\n".encode("ascii") + encoded + b"\r\n")
+        self.wfile.flush()
+
+    def log_message(self, *args):
+        """Keep the benchmark output clean"""
+
+
+def main():
+    """Parse the arguments and serve"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0.5)
+    parser.add_argument("--tokens-per-second", type=float, default=50.0)
+    args = parser.parse_args()
+    CompletionHandler.backend = FakeBackend(args.latency, args.tokens_per_second)
+    ThreadingHTTPServer(("localhost", args.port), CompletionHandler).serve_forever()
+
+
+if __name__ == "__main__":
+    main()
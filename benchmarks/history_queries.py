@@ -0,0 +1,150 @@
+"""
+Latency of the history queries on a large synthetic database
+
+Run as `python benchmarks/history_queries.py --messages 1000000`. A fresh
+SQLite file is filled with users, exercises and messages at schema version 1,
+without indexes, and the queries of the history pages are timed. Then the
+database is migrated to the latest version and the queries are timed again,
+along with searches through the full text index.
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+import sqlalchemy
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database  # noqa: E402
+import migrations  # noqa: E402
+from app_globals import MessageType  # noqa: E402
+
+MESSAGES_PER_EXERCISE = 6
+BATCH_SIZE = 50000
+WORDS = [f"word{i}" for i in range(5000)]
+WORDS_PER_MESSAGE = 30
+
+
+def text() -> str:
+    """Random words, some messages use only common words"""
+    return " ".join(
+        random.choices(WORDS[: random.choice((50, 5000))], k=WORDS_PER_MESSAGE)
+    )
+
+
+def fill(engine, users: int, messages: int):
+    """Insert users, exercises and messages in bulk"""
+    exercises = messages // MESSAGES_PER_EXERCISE
+    with engine.begin() as connection:
+        connection.execute(
+            sqlalchemy.insert(database.User),
+            [
+                {"username": f"user{i}", "email": f"user{i}@mail", "password": b""}
+                for i in range(1, users + 1)
+            ],
+        )
+        for start in range(0, exercises, BATCH_SIZE):
+            connection.execute(
+                sqlalchemy.insert(database.Exercise),
+                [
+                    {
+                        "id": i,
+                        "user_id": random.randint(1, users),
+                        "start_timestamp": 1_600_000_000 + i,
+                        "title": f"Exercise {i}",
+                    }
+                    for i in range(start + 1, min(start + BATCH_SIZE, exercises) + 1)
+                ],
+            )
+        message_types = list(MessageType)
+        for start in range(0, exercises * MESSAGES_PER_EXERCISE, BATCH_SIZE):
+            stop = min(start + BATCH_SIZE, exercises * MESSAGES_PER_EXERCISE)
+            connection.execute(
+                sqlalchemy.insert(database.Message),
+                [
+                    {
+                        "exercise_id": i // MESSAGES_PER_EXERCISE + 1,
+                        "role": "user",
+                        "text": text(),
+                        "message_type": message_types[i % MESSAGES_PER_EXERCISE],
+                    }
+                    for i in range(start, stop)
+                ],
+            )
+    return exercises
+
+
+def time_queries(engine, users: int, exercises: int, repeat: int):
+    """Median time of the overview and the detail query in milliseconds"""
+    overview = []
+    detail = []
+    with engine.connect() as connection:
+        for _ in range(repeat):
+            user_id = random.randint(1, users)
+            start = time.perf_counter()
+            connection.execute(
+                sqlalchemy.select(database.Exercise)
+                .where(database.Exercise.user_id == user_id)
+                .order_by(sqlalchemy.desc(database.Exercise.start_timestamp))
+            ).fetchall()
+            overview.append(time.perf_counter() - start)
+
+            exercise_id = random.randint(1, exercises)
+            start = time.perf_counter()
+            connection.execute(
+                sqlalchemy.select(database.Message)
+                .where(database.Message.exercise_id == exercise_id)
+                .where(database.Message.message_type == MessageType.EXERCISE_TITLE)
+            ).fetchall()
+            detail.append(time.perf_counter() - start)
+    return statistics.median(overview) * 1000, statistics.median(detail) * 1000
+
+
+def time_search(users: int, repeat: int) -> float:
+    """Median time of a two word search in milliseconds"""
+    times = []
+    for _ in range(repeat):
+        user_id = random.randint(1, users)
+        query = " ".join(random.sample(WORDS, 2))
+        start = time.perf_counter()
+        database.search_exercises(user_id, query, 25)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times) * 1000
+
+
+def main():
+    """Parse the arguments, build the database and time the queries"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--messages", type=int, default=1_000_000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        engine = database.create_engine_from_settings(
+            {"url": "sqlite:///" + os.path.join(directory, "history.sqlite")}
+        )
+        database.engine = engine
+        migrations.upgrade(engine, target=1)
+        start = time.perf_counter()
+        exercises = fill(engine, args.users, args.messages)
+        print(f"Filled the database in {time.perf_counter() - start:.1f}s")
+
+        for label in ("without indexes", "with indexes"):
+            if label == "with indexes":
+                migrations.upgrade(engine)
+            overview, detail = time_queries(engine, args.users, exercises, args.repeat)
+            print(
+                f"{label:>16}: overview {overview:8.2f} ms, "
+                f"exercise messages {detail:8.2f} ms"
+            )
+        print(f"{'search':>16}: {time_search(args.users, args.repeat):8.2f} ms")
+        engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
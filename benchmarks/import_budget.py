@@ -0,0 +1,78 @@
+"""
+Check the cold start of the app against an import time budget
+
+Run as `python benchmarks/import_budget.py gptutor.yaml --budget 1200`. Each
+run imports main with `python -X importtime` in a fresh interpreter. The
+fastest run must stay within --budget milliseconds, slower runs are noise from
+other processes. Creating the app must not import the modules that are only
+needed on first use, and importing database must not create an engine.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Imported on first use: the OpenAI client by the openai backend and bcrypt by
+# the password worker processes.
+DEFERRED = ["openai", "bcrypt"]
+
+CREATE_APP = """
+import json, sys
+import database
+engine = database.engine
+import app_globals, main
+main.create_app(app_globals.app_settings)
+print(json.dumps({"engine": engine is not None, "modules": sorted(sys.modules)}))
+"""
+
+
+def run(settings_path: str, *arguments: str) -> subprocess.CompletedProcess:
+    """Run the interpreter in a fresh process with the settings"""
+    return subprocess.run(
+        [sys.executable, *arguments],
+        cwd=ROOT,
+        env=dict(os.environ, GPTUTOR_SETTINGS=settings_path),
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+
+def import_time(settings_path: str) -> float:
+    """Milliseconds to import main, including everything it imports"""
+    stderr = run(settings_path, "-X", "importtime", "-c", "import main").stderr
+    # Lines look like "import time: self | cumulative | name", with the name
+    # indented by its depth in the import tree.
+    for line in stderr.splitlines():
+        _, cumulative, name = line.split("|")
+        if name.rstrip() == " main":
+            return int(cumulative) / 1000
+    raise RuntimeError("main not found in the import times")
+
+
+def main():
+    """Parse the arguments and check the budget"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("settings")
+    parser.add_argument("--budget", type=float, default=1200.0)
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+    settings_path = os.path.abspath(args.settings)
+
+    fastest = min(import_time(settings_path) for _ in range(args.runs))
+    print(f"import main: {fastest:.0f} ms, budget {args.budget:.0f} ms")
+
+    created = json.loads(run(settings_path, "-c", CREATE_APP).stdout.splitlines()[-1])
+    imported = [name for name in DEFERRED if name in created["modules"]]
+    print(f"deferred modules imported by create_app: {imported or 'none'}")
+    print(f"engine created by importing database: {created['engine']}")
+
+    if fastest > args.budget or imported or created["engine"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
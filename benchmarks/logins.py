@@ -0,0 +1,116 @@
+"""
+Login latency under many concurrent logins
+
+Run as `python benchmarks/logins.py gptutor.yaml --logins 32`. Users are
+created in a fresh SQLite database, then all of them log in at the same time
+through the login callback while a ping callback measures how responsive the
+server stays. Pass --rounds to try another bcrypt cost.
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app_globals  # noqa: E402
+import database  # noqa: E402
+import main as app_main  # noqa: E402
+import migrations  # noqa: E402
+from dash_client import DashClient  # noqa: E402
+
+
+def percentile(values, q):
+    """The q-th percentile of values"""
+    return statistics.quantiles(values, n=100)[q - 1] if len(values) > 1 else values[0]
+
+
+def login(app, index: int) -> Optional[float]:
+    """Log in through the login callback, returns the latency, None if refused"""
+    client = DashClient(app)
+    start = time.perf_counter()
+    response = client.call("login_user", [1], [f"user{index}@mail", f"password{index}"])
+    latency = time.perf_counter() - start
+    message = response["login-fail"]["children"]
+    if message == "Failed":
+        raise RuntimeError(f"Login of user{index} failed")
+    if isinstance(message, str):
+        return None
+    return latency
+
+
+def ping(app, stop: threading.Event):
+    """Request the stats page until stop is set, returns the latencies"""
+    client = app.server.test_client()
+    latencies = []
+    while not stop.is_set():
+        start = time.perf_counter()
+        client.get("/stats")
+        latencies.append(time.perf_counter() - start)
+        time.sleep(0.01)
+    return latencies
+
+
+def main():
+    """Parse the arguments, create the users and log them in"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("settings")
+    parser.add_argument("--logins", type=int, default=32)
+    parser.add_argument("--rounds", type=int)
+    args = parser.parse_args()
+
+    settings = app_globals.app_settings
+    if args.rounds is not None:
+        settings.setdefault("passwords", {})["rounds"] = args.rounds
+
+    with tempfile.TemporaryDirectory() as directory:
+        database.engine = database.create_engine_from_settings(
+            {"url": "sqlite:///" + os.path.join(directory, "logins.sqlite")}
+        )
+        migrations.upgrade(database.engine)
+        with database.Session(database.engine) as session:
+            session.add_all(
+                database.User(
+                    username=f"user{index}",
+                    email=f"user{index}@mail",
+                    password=database.hash_password(f"password{index}"),
+                )
+                for index in range(args.logins)
+            )
+            session.commit()
+
+        app = app_main.create_app(settings)
+        stop = threading.Event()
+        with ThreadPoolExecutor(max_workers=args.logins + 1) as executor:
+            pings = executor.submit(ping, app, stop)
+            start = time.perf_counter()
+            results = list(
+                executor.map(lambda index: login(app, index), range(args.logins))
+            )
+            elapsed = time.perf_counter() - start
+            stop.set()
+            ping_latencies = pings.result()
+        database.engine.dispose()
+
+    latencies = [latency for latency in results if latency is not None]
+    print(
+        f"{args.logins} logins in {elapsed:.2f}s, "
+        f"{args.logins - len(latencies)} refused because the queue was full"
+    )
+    print(
+        f"login: p50 {percentile(latencies, 50) * 1000:.0f} ms, "
+        f"p99 {percentile(latencies, 99) * 1000:.0f} ms"
+    )
+    print(
+        f"ping:  p50 {percentile(ping_latencies, 50) * 1000:.1f} ms, "
+        f"p99 {percentile(ping_latencies, 99) * 1000:.1f} ms"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""
+Build and serialization time and JSON size of the page layouts
+
+Run as `python benchmarks/page_layouts.py gptutor.yaml`. A user with --exercises
+exercises is created in a fresh SQLite database. The layouts of the home page
+and of the history overview are then built for that user and serialized the
+way Dash sends them to the browser.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import flask
+from dash._utils import to_json
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app_globals  # noqa: E402
+import database  # noqa: E402
+import main as app_main  # noqa: E402
+import migrations  # noqa: E402
+
+
+def fill(count: int) -> dict:
+    """Create a user with count exercises, returns the session user"""
+    with database.Session(database.engine) as session:
+        user = database.User(username="user", email="user@mail", password=b"")
+        session.add(user)
+        session.flush()
+        session.add_all(
+            database.Exercise(
+                user_id=user.id,
+                start_timestamp=1690000000 + index,
+                title=f'Title: "Exercise number {index}"',
+            )
+            for index in range(count)
+        )
+        session.commit()
+        return {"username": user.username, "id": user.id}
+
+
+def measure(layout, repeat: int):
+    """Microseconds to build and to serialize the layout, and its size"""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        built = layout()
+    build = (time.perf_counter() - start) / repeat * 1e6
+    start = time.perf_counter()
+    for _ in range(repeat):
+        serialized = to_json(built)
+    serialize = (time.perf_counter() - start) / repeat * 1e6
+    return build, serialize, len(serialized)
+
+
+def main():
+    """Parse the arguments and measure the layouts"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("settings")
+    parser.add_argument("--exercises", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=500)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        database.engine = database.create_engine_from_settings(
+            {"url": "sqlite:///" + os.path.join(directory, "layouts.sqlite")}
+        )
+        migrations.upgrade(database.engine)
+        user = fill(args.exercises)
+        app = app_main.create_app(app_globals.app_settings)
+        from pages import history, home
+
+        with app.server.test_request_context("/"):
+            flask.session["user"] = user
+            for name, layout in [("home", home.layout), ("history", history.layout)]:
+                build, serialize, size = measure(layout, args.repeat)
+                print(
+                    f"{name:>8}: build {build:7.0f} us, serialize {serialize:7.0f} us, "
+                    f"{size} bytes"
+                )
+        database.engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
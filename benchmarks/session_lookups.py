@@ -0,0 +1,79 @@
+"""
+Session lookup time as the number of stored sessions grows
+
+Run as `python benchmarks/session_lookups.py gptutor.yaml`. Sessions are
+written to a fresh SQLite database, then --active of them are loaded at
+random from the store directly and through the in-process cache. Lookups
+should take about as long with many sessions as with few.
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database  # noqa: E402
+import migrations  # noqa: E402
+import sessions  # noqa: E402
+
+
+def fill(count: int):
+    """Store count sessions of a logged in user, returns their ids"""
+    expires = int(time.time()) + 3600
+    rows = [
+        {
+            "id": f"session{index}",
+            "data": f'{{"user": {{"username": "user{index}", "id": {index}}}}}',
+            "expires_timestamp": expires,
+        }
+        for index in range(count)
+    ]
+    with database.engine.begin() as connection:
+        connection.execute(database.StoredSession.__table__.insert(), rows)
+    return [row["id"] for row in rows]
+
+
+def time_lookups(load, session_ids, repeat: int) -> float:
+    """Microseconds per lookup of a random session"""
+    picks = random.choices(session_ids, k=repeat)
+    start = time.perf_counter()
+    for session_id in picks:
+        if load(session_id) is None:
+            raise RuntimeError(f"{session_id} not found")
+    return (time.perf_counter() - start) / repeat * 1e6
+
+
+def main():
+    """Parse the arguments and time the lookups for each number of sessions"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("settings")
+    parser.add_argument("--counts", type=int, nargs="+", default=[1000, 1000000])
+    parser.add_argument("--active", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=10000)
+    args = parser.parse_args()
+
+    for count in args.counts:
+        with tempfile.TemporaryDirectory() as directory:
+            database.engine = database.create_engine_from_settings(
+                {"url": "sqlite:///" + os.path.join(directory, "sessions.sqlite")}
+            )
+            migrations.upgrade(database.engine)
+            session_ids = random.sample(fill(count), min(args.active, count))
+            store = sessions.DatabaseSessionStore()
+            cached = sessions.Sessions(store, 3600, 60.0, len(session_ids))
+            # Warm the cache, like a worker that has served these sessions.
+            for session_id in session_ids:
+                cached.load(session_id)
+            print(
+                f"{count:>8} sessions: "
+                f"store {time_lookups(store.load, session_ids, args.repeat):6.1f} us, "
+                f"cached {time_lookups(cached.load, session_ids, args.repeat):6.1f} us"
+            )
+            database.engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""
+Latency and throughput of the whole start_exercise flow
+
+Run as `python benchmarks/start_exercise.py gptutor.yaml`. The completion
+backend is replaced by the fake backend so results are reproducible and no
+tokens are used. Each simulated user clicks Start and polls like the browser
+until the exercise is complete.
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app_globals  # noqa: E402
+import main as app_main  # noqa: E402
+from dash_client import DashClient  # noqa: E402
+
+POLL_INTERVAL = 0.25
+
+
+def simulate_user(app):
+    """Start an exercise, return the time to the first text and to completion"""
+    client = DashClient(app)
+    start = time.perf_counter()
+    response = client.call(
+        "start_exercise", [1], ["Easy", "Python", "15 minutes", None, "Start", None]
+    )
+    stream_id = response["stream-id"]["data"]
+    first_text = None
+    n_intervals = 0
+    while True:
+        time.sleep(POLL_INTERVAL)
+        n_intervals += 1
+        response = client.call("poll_stream", [n_intervals], [stream_id])
+        description = response.get("exercise-description", {}).get("children")
+        if first_text is None and description:
+            first_text = time.perf_counter() - start
+        if response.get("stream-interval", {}).get("disabled"):
+            return first_text, time.perf_counter() - start
+
+
+def percentile(values, q):
+    """The q-th percentile of values"""
+    return statistics.quantiles(values, n=100)[q - 1] if len(values) > 1 else values[0]
+
+
+def main():
+    """Parse the arguments and run the simulated users"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("settings")
+    parser.add_argument("--users", type=int, default=16)
+    parser.add_argument("--latency", type=float, default=0.5)
+    parser.add_argument("--tokens-per-second", type=float, default=50.0)
+    args = parser.parse_args()
+
+    settings = app_globals.app_settings
+    settings["completion_backend"] = {
+        "type": "fake",
+        "latency": args.latency,
+        "tokens_per_second": args.tokens_per_second,
+    }
+    # Measure generation, not the cache, the pool or the rate limits.
+    settings.pop("exercise_cache", None)
+    settings["rate_limits"] = {
+        "user_per_minute": 60 * args.users,
+        "user_burst": args.users,
+        "global_per_minute": 60 * args.users,
+        "global_burst": args.users,
+    }
+    app = app_main.create_app(settings)
+
+    with ThreadPoolExecutor(max_workers=args.users) as users:
+        start = time.perf_counter()
+        results = list(users.map(lambda _: simulate_user(app), range(args.users)))
+        elapsed = time.perf_counter() - start
+
+    first_text = [result[0] for result in results]
+    done = [result[1] for result in results]
+    print(f"{args.users} users, {args.users / elapsed:.2f} exercises/s")
+    print(
+        f"first text: p50 {percentile(first_text, 50):.2f}s, "
+        f"p99 {percentile(first_text, 99):.2f}s"
+    )
+    print(
+        f"complete:   p50 {percentile(done, 50):.2f}s, p99 {percentile(done, 99):.2f}s"
+    )
+
+
+if __name__ == "__main__":
+    main()
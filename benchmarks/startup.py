@@ -0,0 +1,67 @@
+"""
+Start up time, imported modules and settings loads of the app
+
+Run as `python benchmarks/startup.py gptutor.yaml --runs 5`. Every run starts
+a fresh interpreter that imports main and creates the app, like a gunicorn
+worker does. The settings must be loaded exactly once per process.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+STARTUP = """
+import json, sys, time
+start = time.perf_counter()
+import app_globals
+import main
+imported = time.perf_counter()
+main.create_app(app_globals.app_settings)
+created = time.perf_counter()
+print(json.dumps({
+    "import": imported - start,
+    "create_app": created - imported,
+    "modules": len(sys.modules),
+    "loads": app_globals.app_settings.loads,
+}))
+"""
+
+
+def start_up(settings_path: str) -> dict:
+    """Start the app in a fresh interpreter and return its measurements"""
+    output = subprocess.run(
+        [sys.executable, "-c", STARTUP],
+        cwd=ROOT,
+        env=dict(os.environ, GPTUTOR_SETTINGS=settings_path),
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def main():
+    """Parse the arguments and measure the start ups"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("settings")
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    runs = [start_up(os.path.abspath(args.settings)) for _ in range(args.runs)]
+    for name in ["import", "create_app"]:
+        print(
+            f"{name:>10}: {statistics.median(run[name] for run in runs) * 1000:.0f} ms"
+        )
+    print(f"{'modules':>10}: {runs[-1]['modules']}")
+    loads = {run["loads"] for run in runs}
+    print(f"{'loads':>10}: {', '.join(map(str, sorted(loads)))}")
+    if loads != {1}:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
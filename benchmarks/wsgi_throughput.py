@@ -0,0 +1,136 @@
+"""
+Requests per second of the development server and of gunicorn
+
+Run as `python benchmarks/wsgi_throughput.py gptutor.yaml --workers 4`. The
+app is started both ways as a separate process with the fake completion
+backend. Client threads then request the layout and call a callback for
+--seconds seconds.
+"""
+import argparse
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+import yaml
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import app_globals  # noqa: E402
+
+PORT = 8097
+
+
+def wait_until_up(url: str, timeout: float = 60.0):
+    """Wait for the server to answer"""
+    end = time.monotonic() + timeout
+    while time.monotonic() < end:
+        try:
+            if requests.get(url, timeout=5).status_code == 200:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up")
+
+
+def enable_start_payload(url: str):
+    """The request the browser makes when a dropdown changes"""
+    dependencies = requests.get(url + "/_dash-dependencies").json()
+    for dependency in dependencies:
+        inputs = [i["id"] for i in dependency["inputs"]]
+        if dependency["output"].startswith("start-button.disabled") and inputs == [
+            "level-dropdown",
+            "topic-dropdown",
+            "time-dropdown",
+        ]:
+            return {
+                "output": dependency["output"],
+                "outputs": {"id": "start-button", "property": "disabled"},
+                "inputs": [dict(i, value="Easy") for i in dependency["inputs"]],
+                "changedPropIds": ["level-dropdown.value"],
+            }
+    raise RuntimeError("enable_start not found")
+
+
+def client(url: str, payload, stop: threading.Event) -> int:
+    """Request the layout and call the callback until stop is set"""
+    session = requests.Session()
+    count = 0
+    while not stop.is_set():
+        session.get(url + "/_dash-layout").raise_for_status()
+        session.post(url + "/_dash-update-component", json=payload).raise_for_status()
+        count += 2
+    return count
+
+
+def measure(name: str, command, clients: int, seconds: float):
+    """Start the server with command and measure its throughput"""
+    url = f"http://127.0.0.1:{PORT}"
+    with open(os.devnull, "w") as devnull:
+        server = subprocess.Popen(
+            command, cwd=ROOT, stdout=devnull, stderr=devnull, start_new_session=True
+        )
+    try:
+        wait_until_up(url + "/")
+        payload = enable_start_payload(url)
+        stop = threading.Event()
+        with ThreadPoolExecutor(max_workers=clients) as executor:
+            futures = [
+                executor.submit(client, url, payload, stop) for _ in range(clients)
+            ]
+            time.sleep(seconds)
+            stop.set()
+            count = sum(future.result() for future in futures)
+    finally:
+        # The development server runs a reloader with a child process.
+        os.killpg(server.pid, signal.SIGTERM)
+        server.wait()
+    print(f"{name:>24}: {count / seconds:8.1f} requests/s")
+
+
+def main():
+    """Parse the arguments and measure both servers"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("settings")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--seconds", type=float, default=10.0)
+    args = parser.parse_args()
+
+    settings = dict(app_globals.app_settings)
+    settings["completion_backend"] = {"type": "fake"}
+    settings.pop("exercise_pool", None)
+    settings["rate_limits"] = {
+        "user_per_minute": 1000000,
+        "user_burst": 1000000,
+        "global_per_minute": 1000000,
+        "global_burst": 1000000,
+    }
+    with tempfile.TemporaryDirectory() as directory:
+        settings["database"] = {
+            "url": "sqlite:///" + os.path.join(directory, "throughput.sqlite")
+        }
+        settings_path = os.path.join(directory, "settings.yaml")
+        with open(settings_path, "w") as settings_file:
+            yaml.safe_dump(settings, settings_file)
+        main_py = os.path.join(ROOT, "main.py")
+        bind = ["--bind", f"127.0.0.1:{PORT}"]
+        command = [sys.executable, main_py, settings_path] + bind
+        measure("development server", command + ["--debug"], args.clients, args.seconds)
+        measure(
+            f"gunicorn, {args.workers} workers",
+            command + ["--workers", str(args.workers)],
+            args.clients,
+            args.seconds,
+        )
+
+
+if __name__ == "__main__":
+    main()
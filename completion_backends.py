@@ -0,0 +1,187 @@
+"""Backends that produce chat completions"""
+import json
+import re
+import time
+from typing import Dict, Iterator, List, Tuple
+
+import requests
+
+DEFAULT_FAKE_LATENCY = 0.5
+DEFAULT_FAKE_TOKENS_PER_SECOND = 50.0
+DEFAULT_FAKE_REPLY_TOKENS = 100
+DEFAULT_CONNECT_TIMEOUT = 5.0
+DEFAULT_READ_TIMEOUT = 60.0
+DEFAULT_POOL_SIZE = 10
+
+
+class CompletionBackend:
+    """Interface of a chat completion backend, messages are role/content dicts"""
+
+    def complete(self, messages: List[Dict], model: str) -> str:
+        """Return the content of the completion"""
+        raise NotImplementedError
+
+    def stream(self, messages: List[Dict], model: str) -> Iterator[str]:
+        """Yield the content of the completion as it arrives"""
+        raise NotImplementedError
+
+    def is_retryable(self, error: Exception) -> bool:
+        """Whether a call that raised error might succeed when tried again"""
+        return False
+
+
+class PooledSession(requests.Session):
+    """
+    A session shared by all threads
+
+    The openai package closes its session every few minutes, which would throw
+    away the pooled connections, so closing is ignored.
+    """
+
+    def close(self):
+        """Keep the connections open"""
+
+
+class OpenAIBackend(CompletionBackend):
+    """The OpenAI API, the openai package is imported when one is created"""
+
+    def __init__(
+        self,
+        api_key: str,
+        api_base: str = None,
+        timeout: Tuple[float, float] = (DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT),
+        pool_size: int = DEFAULT_POOL_SIZE,
+    ):
+        import openai
+
+        self.api_key = api_key
+        self.api_base = api_base
+        self.timeout = timeout
+        session = PooledSession()
+        # Retrying is done by gpt, with backoff.
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0
+        )
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        openai.requestssession = session
+
+    def create(self, messages: List[Dict], model: str, **kwargs):
+        """Call the chat completion endpoint"""
+        import openai
+
+        return openai.ChatCompletion.create(
+            model=model,
+            messages=messages,
+            n=1,
+            api_key=self.api_key,
+            api_base=self.api_base,
+            request_timeout=self.timeout,
+            **kwargs,
+        )
+
+    def complete(self, messages: List[Dict], model: str) -> str:
+        """Return the content of the completion"""
+        return self.create(messages, model).choices[0]["message"]["content"]
+
+    def stream(self, messages: List[Dict], model: str) -> Iterator[str]:
+        """Yield the content of the completion as it arrives"""
+        for chunk in self.create(messages, model, stream=True):
+            content = chunk.choices[0].delta.get("content")
+            if content:
+                yield content
+
+    def is_retryable(self, error: Exception) -> bool:
+        """Rate limits, time outs, connection problems and server errors"""
+        import openai
+
+        if isinstance(
+            error,
+            (
+                openai.error.RateLimitError,
+                openai.error.ServiceUnavailableError,
+                openai.error.Timeout,
+                openai.error.APIConnectionError,
+                openai.error.TryAgain,
+            ),
+        ):
+            return True
+        return isinstance(error, openai.error.APIError) and (
+            error.http_status is None or error.http_status >= 500
+        )
+
+
+class LocalHTTPBackend(OpenAIBackend):
+    """A server on our side that speaks the OpenAI chat completion protocol"""
+
+    def __init__(self, api_base: str, api_key: str = "local", **kwargs):
+        super().__init__(api_key, api_base, **kwargs)
+
+
+class FakeBackend(CompletionBackend):
+    """
+    Deterministic in-process replies for tests and benchmarks
+
+    Waits latency seconds before the first token and then produces
+    tokens_per_second tokens of which there are reply_tokens. Prompts asking
+    for JSON get an exercise with a title as JSON.
+    """
+
+    def __init__(
+        self,
+        latency: float = DEFAULT_FAKE_LATENCY,
+        tokens_per_second: float = DEFAULT_FAKE_TOKENS_PER_SECOND,
+        reply_tokens: int = DEFAULT_FAKE_REPLY_TOKENS,
+    ):
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.reply_tokens = reply_tokens
+
+    def tokens(self, messages: List[Dict]) -> List[str]:
+        """The reply split in tokens"""
+        words = [f"word{i % 10} " for i in range(self.reply_tokens)]
+        if "JSON" in messages[-1]["content"]:
+            reply = {"title": "A fake exercise", "exercise": "".join(words).strip()}
+            return re.findall(r"\S*\s*", json.dumps(reply))[:-1]
+        return words
+
+    def complete(self, messages: List[Dict], model: str) -> str:
+        """Return the content of the completion"""
+        time.sleep(self.latency + self.reply_tokens / self.tokens_per_second)
+        return "".join(self.tokens(messages))
+
+    def stream(self, messages: List[Dict], model: str) -> Iterator[str]:
+        """Yield the content of the completion as it arrives"""
+        time.sleep(self.latency)
+        for token in self.tokens(messages):
+            time.sleep(1 / self.tokens_per_second)
+            yield token
+
+
+def create_backend(app_settings: Dict) -> CompletionBackend:
+    """Create the backend configured under completion_backend"""
+    backend_settings = app_settings.get("completion_backend", {"type": "openai"})
+    backend_type = backend_settings["type"]
+    client_settings = app_settings.get("completion_client", {})
+    http_settings = {
+        "timeout": (
+            client_settings.get("connect_timeout", DEFAULT_CONNECT_TIMEOUT),
+            client_settings.get("read_timeout", DEFAULT_READ_TIMEOUT),
+        ),
+        "pool_size": client_settings.get("pool_size", DEFAULT_POOL_SIZE),
+    }
+    if backend_type == "openai":
+        return OpenAIBackend(app_settings["openai_key"], **http_settings)
+    if backend_type == "local":
+        return LocalHTTPBackend(
+            backend_settings["api_base"],
+            backend_settings.get("api_key", "local"),
+            **http_settings,
+        )
+    if backend_type == "fake":
+        return FakeBackend(
+            backend_settings.get("latency", DEFAULT_FAKE_LATENCY),
+            backend_settings.get("tokens_per_second", DEFAULT_FAKE_TOKENS_PER_SECOND),
+            backend_settings.get("reply_tokens", DEFAULT_FAKE_REPLY_TOKENS),
+        )
+    raise ValueError(f"Unknown completion backend: {backend_type}")
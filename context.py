@@ -0,0 +1,69 @@
+"""Build the context sent with a completion request"""
+from typing import Dict, List, Optional, Tuple
+
+import app_globals
+import tokenizer
+from app_globals import MessageType
+
+DEFAULT_MAX_PROMPT_TOKENS = 3000
+# Per message overhead of the chat format.
+TOKENS_PER_MESSAGE = 4
+
+# The messages worth sending for each kind of request, by the type of the last
+# message. Requests not listed get the whole conversation.
+RELEVANT_MESSAGES = {
+    MessageType.ASK_TITLE: {MessageType.INITIAL_EXERCISE, MessageType.ASK_TITLE},
+    MessageType.EXERCISE_ANSWER: {
+        MessageType.INITIAL_QUESTION,
+        MessageType.INITIAL_EXERCISE,
+        MessageType.EXERCISE_ANSWER,
+    },
+}
+
+
+def context_settings() -> Dict:
+    """The context section of the settings"""
+    return app_globals.app_settings.get("context", {})
+
+
+def prompt_tokens(messages: List[Dict]) -> int:
+    """The number of tokens of the messages in a request"""
+    return sum(
+        tokenizer.count_tokens(message["content"]) + TOKENS_PER_MESSAGE
+        for message in messages
+    )
+
+
+def build_context(
+    messages: List[Dict], message_types: List[Optional[MessageType]]
+) -> Tuple[List[Dict], int]:
+    """
+    Pick the relevant messages and fit them in the token budget
+
+    Messages are role/content dicts, message_types holds the type of each. If
+    the messages don't fit in max_prompt_tokens, the last message, usually an
+    answer, is shortened. Returns the messages to send and the number of tokens
+    saved.
+    """
+    full_size = prompt_tokens(messages)
+    relevant = RELEVANT_MESSAGES.get(message_types[-1])
+    if relevant is not None:
+        messages = [
+            message
+            for message, message_type in zip(messages, message_types)
+            if message_type in relevant
+        ]
+
+    max_prompt_tokens = context_settings().get(
+        "max_prompt_tokens", DEFAULT_MAX_PROMPT_TOKENS
+    )
+    size = prompt_tokens(messages)
+    if size > max_prompt_tokens:
+        last = messages[-1]
+        last_size = tokenizer.count_tokens(last["content"])
+        # Leave at least something of the last message.
+        allowed = max(last_size - (size - max_prompt_tokens), max_prompt_tokens // 10)
+        messages = messages[:-1] + [
+            dict(last, content=tokenizer.truncate(last["content"], allowed))
+        ]
+    return messages, full_size - prompt_tokens(messages)
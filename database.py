@@ -1,16 +1,91 @@
 """Database functionality for GPTutor"""
-import bcrypt  # scrypt can be hard to install.
-import sqlite3
+import collections
+import os
+import threading
+import time
+
 import sqlalchemy
 from sqlalchemy import create_engine, select
-from sqlalchemy.orm import declarative_base, relationship, Session
-from typing import Optional
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import contains_eager, declarative_base, relationship, Session
+from typing import Dict, List, Optional, Tuple
 
+import app_globals
+import passwords
+from app_globals import MessageType
 
 DB_NAME = "gptutor.sqlite"
+DEFAULT_URL = "sqlite:///" + DB_NAME
+DEFAULT_SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "busy_timeout": 5000,
+    "mmap_size": 256 * 1024 * 1024,
+}
+DEFAULT_USER_CACHE_TTL = 300
+DEFAULT_USER_CACHE_ENTRIES = 10000
+
+
+def create_engine_from_settings(database_settings: Dict) -> Engine:
+    """
+    Create the engine configured under database in the settings
+
+    Works for SQLite and PostgreSQL. SQLite connections get the pragmas from
+    sqlite_pragmas, by default WAL mode with normal synchronisation.
+    """
+    url = database_settings.get("url", DEFAULT_URL)
+    kwargs = {
+        "echo": database_settings.get("echo", False),
+        "pool_pre_ping": database_settings.get("pool_pre_ping", True),
+    }
+    if "pool_size" in database_settings:
+        kwargs["pool_size"] = database_settings["pool_size"]
+    if "max_overflow" in database_settings:
+        kwargs["max_overflow"] = database_settings["max_overflow"]
+    new_engine = create_engine(url, **kwargs)
+
+    if new_engine.dialect.name == "sqlite":
+        pragmas = dict(DEFAULT_SQLITE_PRAGMAS)
+        pragmas.update(database_settings.get("sqlite_pragmas", {}))
+
+        @sqlalchemy.event.listens_for(new_engine, "connect")
+        def set_sqlite_pragmas(dbapi_connection, _connection_record):
+            """Apply the pragmas to every new connection"""
+            cursor = dbapi_connection.cursor()
+            for name, value in pragmas.items():
+                cursor.execute(f"PRAGMA {name} = {value}")
+            cursor.close()
+
+    return new_engine
+
+
+# Created on first use, importing this module doesn't touch the database.
+# Assign another engine to use a different database.
+engine: Optional[Engine] = None
+_engine_lock = threading.Lock()
 
-conn = sqlite3.connect(DB_NAME)
-engine = create_engine("sqlite:///" + DB_NAME, echo=True)
+
+def get_engine() -> Engine:
+    """The engine configured under database in the settings"""
+    global engine
+    if engine is None:
+        with _engine_lock:
+            if engine is None:
+                engine = create_engine_from_settings(
+                    app_globals.app_settings.get("database", {})
+                )
+    return engine
+
+
+def _reset_after_fork():
+    """Don't share the parent's connections with a forked worker"""
+    global _engine_lock
+    _engine_lock = threading.Lock()
+    if engine is not None:
+        engine.dispose(close=False)
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
 
 Base = declarative_base()
 
@@ -36,6 +111,11 @@ class Exercise(Base):
     """Exercise holds exercise meta data"""
 
     __tablename__ = "exercises"
+    __table_args__ = (
+        sqlalchemy.Index(
+            "ix_exercises_user_id_start_timestamp", "user_id", "start_timestamp"
+        ),
+    )
 
     id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True, autoincrement=True)
     user_id = sqlalchemy.Column(
@@ -55,6 +135,11 @@ class Message(Base):
     """Records message send and received to the GPT API"""
 
     __tablename__ = "message"
+    __table_args__ = (
+        sqlalchemy.Index(
+            "ix_message_exercise_id_message_type", "exercise_id", "message_type"
+        ),
+    )
 
     id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True, autoincrement=True)
     exercise_id = sqlalchemy.Column(
@@ -65,55 +150,331 @@ class Message(Base):
     message_type = sqlalchemy.Column(sqlalchemy.Integer, nullable=False)
 
 
+class CachedExercise(Base):
+    """A generated exercise kept for reuse by other users"""
+
+    __tablename__ = "exercise_cache"
+    __table_args__ = (
+        sqlalchemy.Index(
+            "ix_exercise_cache_key", "topic", "level", "duration", "created_timestamp"
+        ),
+    )
+
+    id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True, autoincrement=True)
+    topic = sqlalchemy.Column(sqlalchemy.Text, nullable=False)
+    level = sqlalchemy.Column(sqlalchemy.Text, nullable=False)
+    duration = sqlalchemy.Column(sqlalchemy.Text, nullable=False)
+    exercise = sqlalchemy.Column(sqlalchemy.Text, nullable=False)
+    title = sqlalchemy.Column(sqlalchemy.Text, nullable=False)
+    created_timestamp = sqlalchemy.Column(sqlalchemy.Integer, nullable=False)
+
+
+class StoredSession(Base):
+    """The contents of a browser session, the cookie only holds the id"""
+
+    __tablename__ = "sessions"
+
+    id = sqlalchemy.Column(sqlalchemy.Text, primary_key=True)
+    data = sqlalchemy.Column(sqlalchemy.Text, nullable=False)
+    expires_timestamp = sqlalchemy.Column(
+        sqlalchemy.Integer, nullable=False, index=True
+    )
+
+
+class StoredStream(Base):
+    """A background completion, kept so any worker can answer polls for it"""
+
+    __tablename__ = "streams"
+
+    id = sqlalchemy.Column(sqlalchemy.Text, primary_key=True)
+    kind = sqlalchemy.Column(sqlalchemy.Text, nullable=False)
+    status = sqlalchemy.Column(sqlalchemy.Text, nullable=False)
+    text = sqlalchemy.Column(sqlalchemy.Text, nullable=False)
+    error = sqlalchemy.Column(sqlalchemy.Text)
+    # JSON of what the poller needs once the stream is done.
+    result = sqlalchemy.Column(sqlalchemy.Text)
+    created_timestamp = sqlalchemy.Column(
+        sqlalchemy.Integer, nullable=False, index=True
+    )
+
+
 def hash_password(password: str) -> bytes:
-    """Hash a password using bcrypt"""
-    salt = bcrypt.gensalt()
-    pwhash = bcrypt.hashpw(bytes(password, "utf-8"), salt)
-    return pwhash
+    """Hash a password using bcrypt, in the password worker processes"""
+    return passwords.hash_password(password)
+
+
+class DuplicateUserError(Exception):
+    """Raised when the username or e-mail address of a new user is taken"""
+
+    def __init__(self, field: str):
+        super().__init__(f"A user with this {field} exists")
+        self.field = field
 
 
 def create_user(session: Session, username, email: str, password: str) -> User:
-    """Create a user in the database, hashing with bcrypt"""
-    user = User(
-        username=username,
-        email=email,
-        password=hash_password(password),
-    )
-    session.add(User(username=username, email=email, password=hash_password(password)))
-    session.commit()
+    """
+    Create a user in the database, hashing with bcrypt
 
+    The unique constraints on username and email decide whether the user
+    already exists, DuplicateUserError tells which one was violated.
+    """
+    user = User(username=username, email=email, password=hash_password(password))
+    session.add(user)
+    try:
+        session.commit()
+    except sqlalchemy.exc.IntegrityError as e:
+        session.rollback()
+        # SQLite and PostgreSQL both name the column or constraint.
+        if "username" in str(e.orig):
+            raise DuplicateUserError("username") from e
+        if "email" in str(e.orig):
+            raise DuplicateUserError("email") from e
+        raise
     return user
 
 
+class UserCache:
+    """
+    Recently used users by id, without their password
+
+    Entries expire after ttl seconds, the least recently used are dropped when
+    there are more than max_entries.
+    """
+
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries: collections.OrderedDict = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, user_id: int) -> Optional[Dict]:
+        """The user with user_id, from the cache when possible"""
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry is not None and now - entry[0] < self.ttl:
+                self.entries.move_to_end(user_id)
+                return entry[1]
+        with Session(get_engine()) as session:
+            user = session.get(User, user_id)
+            if user is None:
+                return None
+            row = {"id": user.id, "username": user.username, "email": user.email}
+        with self.lock:
+            self.entries[user_id] = (now, row)
+            self.entries.move_to_end(user_id)
+            if len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return row
+
+    def invalidate(self, user_id: int):
+        """Forget a user"""
+        with self.lock:
+            self.entries.pop(user_id, None)
+
+
+_user_cache: Optional[UserCache] = None
+
+
+def user_cache() -> UserCache:
+    """The user cache configured under user_cache"""
+    global _user_cache
+    if _user_cache is None:
+        settings = app_globals.app_settings.get("user_cache", {})
+        _user_cache = UserCache(
+            settings.get("ttl", DEFAULT_USER_CACHE_TTL),
+            settings.get("max_entries", DEFAULT_USER_CACHE_ENTRIES),
+        )
+    return _user_cache
+
+
+def get_user(user_id: int) -> Optional[Dict]:
+    """The id, username and email of a user, None if there is no such user"""
+    return user_cache().get(user_id)
+
+
 def verify_password(email: str, password: str) -> Optional[User]:
-    """Verify that the password matches the given user"""
-    with Session(engine) as session:
-        # Warning about sqlalchemy.exc.NoResultFound to be missing seems spurious
-        # noinspection PyUnresolvedReferences
-        try:
-            user = session.scalars(select(User).where(email == User.email)).one()
-            if bcrypt.checkpw(bytes(password, "utf-8"), user.password):
-                return user
-        except sqlalchemy.exc.NoResultFound:
-            return None
+    """
+    Verify that the password matches the given user
+
+    Passwords hashed with a different number of rounds than configured are
+    hashed again.
+    """
+    with Session(get_engine()) as session:
+        user = session.scalars(select(User).where(email == User.email)).one_or_none()
+    # The connection is back in the pool while bcrypt runs, which takes a
+    # while, longer still when logins queue up for the password workers.
+    if user is None or not passwords.check_password(password, user.password):
         return None
+    if passwords.needs_rehash(user.password):
+        user.password = passwords.hash_password(password)
+        with Session(get_engine()) as session:
+            session.execute(
+                sqlalchemy.update(User)
+                .where(User.id == user.id)
+                .values(password=user.password)
+            )
+            session.commit()
+    return user
 
 
 def save_exercise(
-    session: Session, user: User, title: str, start_timestamp: float
+    session: Session, user_id: int, title: str, start_timestamp: float
 ) -> Exercise:
     """Save an exercise to the database"""
-    exercise = Exercise(user=user, title=title, start_timestamp=int(start_timestamp))
+    exercise = Exercise(
+        user_id=user_id, title=title, start_timestamp=int(start_timestamp)
+    )
     session.add(exercise)
     return exercise
 
 
+def fetch_owned_exercise(
+    session: Session, user_id: int, exercise_id: int
+) -> Optional[Exercise]:
+    """Get an exercise by id, None if it doesn't exist or isn't the user's"""
+    exercise = session.get(Exercise, exercise_id)
+    if exercise is None or exercise.user_id != user_id:
+        return None
+    return exercise
+
+
+def fetch_exercises(
+    user_id: int, page_size: int, before: Optional[Tuple[int, int]] = None
+) -> List[sqlalchemy.Row]:
+    """
+    A page of the exercises of a user, most recent first
+
+    Only the id, title and start_timestamp are loaded. Pages are keyed on
+    (start_timestamp, id), before is the key of the last exercise of the
+    previous page. One more row than page_size is returned when there are more.
+    """
+    query = select(Exercise.id, Exercise.title, Exercise.start_timestamp).where(
+        Exercise.user_id == user_id
+    )
+    if before is not None:
+        query = query.where(
+            sqlalchemy.tuple_(Exercise.start_timestamp, Exercise.id) < before
+        )
+    query = query.order_by(
+        sqlalchemy.desc(Exercise.start_timestamp), sqlalchemy.desc(Exercise.id)
+    ).limit(page_size + 1)
+    with Session(get_engine()) as session:
+        return list(session.execute(query))
+
+
+# Messages written by the user or the model, not the prompts we send.
+SEARCHED_MESSAGE_TYPES = [
+    MessageType.INITIAL_EXERCISE,
+    MessageType.EXERCISE_ANSWER,
+    MessageType.EXERCISE_EVAL,
+]
+SEARCHED_MESSAGE_TYPES_SQL = "({})".format(
+    ", ".join(str(int(message_type)) for message_type in SEARCHED_MESSAGE_TYPES)
+)
+
+# The CTE is materialized because bm25 can't be used in the aggregate that
+# SQLite would otherwise flatten it into.
+SQLITE_SEARCH_QUERY = """
+WITH matches AS MATERIALIZED (
+    SELECT exercise_id, bm25(exercise_search, 0, 2, 1) AS rank
+    FROM exercise_search
+    WHERE exercise_search MATCH :match
+)
+SELECT exercises.id, exercises.title, exercises.start_timestamp
+FROM (SELECT exercise_id, min(rank) AS rank FROM matches GROUP BY exercise_id) AS best
+JOIN exercises ON exercises.id = best.exercise_id
+ORDER BY best.rank
+LIMIT :limit
+"""
+
+POSTGRESQL_SEARCH_QUERY = f"""
+WITH search AS (SELECT plainto_tsquery('english', :query) AS query),
+hits AS (
+    SELECT message.exercise_id,
+        ts_rank(to_tsvector('english', message.text), search.query) AS rank
+    FROM message JOIN exercises ON exercises.id = message.exercise_id, search
+    WHERE exercises.user_id = :user_id
+    AND message.message_type IN {SEARCHED_MESSAGE_TYPES_SQL}
+    AND to_tsvector('english', message.text) @@ search.query
+    UNION ALL
+    SELECT exercises.id,
+        2 * ts_rank(to_tsvector('english', exercises.title), search.query)
+    FROM exercises, search
+    WHERE exercises.user_id = :user_id
+    AND to_tsvector('english', exercises.title) @@ search.query
+)
+SELECT exercises.id, exercises.title, exercises.start_timestamp
+FROM (SELECT exercise_id, max(rank) AS rank FROM hits GROUP BY exercise_id) AS best
+JOIN exercises ON exercises.id = best.exercise_id
+ORDER BY best.rank DESC
+LIMIT :limit
+"""
+
+
+def search_exercises(user_id: int, query: str, limit: int) -> List[sqlalchemy.Row]:
+    """
+    The exercises of a user matching all words of query, best match first
+
+    Uses the full text index created by the migrations, FTS5 on SQLite and
+    tsvector indexes on PostgreSQL. Titles weigh twice as much as messages.
+    """
+    words = query.split()
+    if len(words) == 0:
+        return []
+    if get_engine().dialect.name == "postgresql":
+        statement = sqlalchemy.text(POSTGRESQL_SEARCH_QUERY)
+        parameters = {"query": query, "user_id": user_id, "limit": limit}
+    else:
+        # Quote the words so the query syntax of FTS5 doesn't apply.
+        terms = " ".join('"' + word.replace('"', '""') + '"' for word in words)
+        statement = sqlalchemy.text(SQLITE_SEARCH_QUERY)
+        parameters = {
+            "match": f"owner : u{int(user_id)} AND {{title text}} : ({terms})",
+            "limit": limit,
+        }
+    with Session(get_engine()) as session:
+        return list(session.execute(statement, parameters))
+
+
+def fetch_exercise_detail(
+    user_id: int, exercise_id: int, message_types: List[MessageType]
+) -> Optional[Exercise]:
+    """
+    Fetch an exercise of a user with only the messages of the given types
+
+    The exercise and its messages are loaded in a single query, so the returned
+    exercise can be used after the session is closed.
+    """
+    with Session(get_engine()) as session:
+        return (
+            session.scalars(
+                select(Exercise)
+                .outerjoin(
+                    Message,
+                    (Message.exercise_id == Exercise.id)
+                    & Message.message_type.in_(
+                        [int(message_type) for message_type in message_types]
+                    ),
+                )
+                .options(contains_eager(Exercise.messages))
+                .where(Exercise.user_id == user_id)
+                .where(Exercise.id == exercise_id)
+                .order_by(Message.id)
+            )
+            .unique()
+            .one_or_none()
+        )
+
+
 if __name__ == "__main__":
-    Base.metadata.create_all(engine)
+    import migrations
+
+    migrations.upgrade(get_engine())
     yn = input("Create a user y/n: ").lower()
     if yn == "y":
         given_username = input("Username: ")
         given_email = input("Email: ")
         given_password = input("Password: ")
-        with Session(engine) as session_:
+        with Session(get_engine()) as session_:
             create_user(session_, given_username, given_email, given_password)
@@ -0,0 +1,123 @@
+"""Cache generated exercises in the database so they can be served again"""
+import random
+import time
+from typing import Dict, List, Optional, Tuple
+
+import sqlalchemy
+from sqlalchemy.orm import Session
+
+import app_globals
+import database
+
+DEFAULT_MAX_ENTRIES = 20
+DEFAULT_MAX_AGE_DAYS = 30
+DEFAULT_SERVE_PERCENTAGE = 50
+
+
+def cache_settings() -> Optional[Dict]:
+    """The exercise_cache section of the settings, None if caching is disabled"""
+    return app_globals.app_settings.get("exercise_cache")
+
+
+def _oldest_allowed(settings: Dict) -> int:
+    """Timestamp before which cached exercises are considered expired"""
+    max_age_days = settings.get("max_age_days", DEFAULT_MAX_AGE_DAYS)
+    return int(time.time() - max_age_days * 24 * 3600)
+
+
+def lookup(level: str, topic: str, duration: str) -> Optional[Tuple[str, str]]:
+    """
+    Return a cached (exercise, title) pair or None
+
+    Only serves from the cache serve_percentage percent of the time so the pool
+    of exercises keeps growing instead of showing the same few over and over.
+    """
+    settings = cache_settings()
+    if settings is None:
+        return None
+    serve_percentage = settings.get("serve_percentage", DEFAULT_SERVE_PERCENTAGE)
+    if random.uniform(0, 100) >= serve_percentage:
+        return None
+
+    with Session(database.get_engine()) as session:
+        # noinspection PyTypeChecker
+        cached = session.scalars(
+            sqlalchemy.select(database.CachedExercise)
+            .where(topic == database.CachedExercise.topic)
+            .where(level == database.CachedExercise.level)
+            .where(duration == database.CachedExercise.duration)
+            .where(
+                database.CachedExercise.created_timestamp >= _oldest_allowed(settings)
+            )
+            .order_by(sqlalchemy.func.random())
+            .limit(1)
+        ).first()
+        if cached is None:
+            return None
+        return cached.exercise, cached.title
+
+
+def recent(count: int) -> Dict[Tuple[str, str, str], List[Tuple[str, str]]]:
+    """The newest unexpired (exercise, title) pairs by (level, topic, duration)"""
+    settings = cache_settings()
+    if settings is None:
+        return {}
+
+    cache = database.CachedExercise
+    with Session(database.get_engine()) as session:
+        rows = session.execute(
+            sqlalchemy.select(
+                cache.level, cache.topic, cache.duration, cache.exercise, cache.title
+            )
+            .where(cache.created_timestamp >= _oldest_allowed(settings))
+            .order_by(
+                sqlalchemy.desc(cache.created_timestamp), sqlalchemy.desc(cache.id)
+            )
+        ).all()
+    exercises: Dict[Tuple[str, str, str], List[Tuple[str, str]]] = {}
+    for level, topic, duration, exercise, title in rows:
+        newest = exercises.setdefault((level, topic, duration), [])
+        if len(newest) < count:
+            newest.append((exercise, title))
+    return exercises
+
+
+def store(level: str, topic: str, duration: str, exercise: str, title: str):
+    """Store a freshly generated exercise and evict old or surplus entries"""
+    settings = cache_settings()
+    if settings is None:
+        return
+
+    cache = database.CachedExercise
+    with Session(database.get_engine()) as session:
+        session.add(
+            cache(
+                topic=topic,
+                level=level,
+                duration=duration,
+                exercise=exercise,
+                title=title,
+                created_timestamp=int(time.time()),
+            )
+        )
+        session.flush()
+
+        session.execute(
+            sqlalchemy.delete(cache).where(
+                cache.created_timestamp < _oldest_allowed(settings)
+            )
+        )
+        # Keep only the newest max_entries for this topic, level and duration.
+        # noinspection PyTypeChecker
+        surplus = (
+            sqlalchemy.select(cache.id)
+            .where(topic == cache.topic)
+            .where(level == cache.level)
+            .where(duration == cache.duration)
+            .order_by(
+                sqlalchemy.desc(cache.created_timestamp), sqlalchemy.desc(cache.id)
+            )
+            .offset(settings.get("max_entries", DEFAULT_MAX_ENTRIES))
+        )
+        session.execute(sqlalchemy.delete(cache).where(cache.id.in_(surplus)))
+        session.commit()
@@ -0,0 +1,129 @@
+"""Keep a warm queue of pre-generated exercises for every exercise option"""
+import itertools
+import os
+import queue
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+DEFAULT_DEPTH = 2
+DEFAULT_CONCURRENCY = 2
+
+Key = Tuple[str, str, str]
+
+
+class ExercisePool:
+    """
+    Bounded queues of exercises per (level, topic, duration)
+
+    generate is called with level, topic and duration and returns the messages
+    of an exercise. Queues are refilled in the background as they are consumed.
+    """
+
+    def __init__(
+        self,
+        combinations: Iterable[Key],
+        generate: Callable[[str, str, str], List[Dict]],
+        depth: int = DEFAULT_DEPTH,
+        concurrency: int = DEFAULT_CONCURRENCY,
+    ):
+        self.generate = generate
+        self.depth = depth
+        self.queues: Dict[Key, queue.Queue] = {
+            key: queue.Queue(maxsize=depth) for key in combinations
+        }
+        self.pending: Dict[Key, int] = {key: 0 for key in self.queues}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(
+            max_workers=concurrency, thread_name_prefix="exercise-pool"
+        )
+
+    def start(self, ready: Optional[Dict[Key, List[List[Dict]]]] = None):
+        """Fill all queues, first with the exercises in ready"""
+        for key, exercises in (ready or {}).items():
+            if key in self.queues:
+                for messages in exercises[: self.depth]:
+                    self.queues[key].put_nowait(messages)
+        for key in self.queues:
+            self.refill(key)
+
+    def refill(self, key: Key):
+        """Schedule generation of enough exercises to fill the queue of key"""
+        with self.lock:
+            missing = self.depth - self.queues[key].qsize() - self.pending[key]
+            self.pending[key] += max(missing, 0)
+        for _ in range(missing):
+            self.executor.submit(self._generate_one, key)
+
+    def _generate_one(self, key: Key):
+        """Generate a single exercise and queue it"""
+        try:
+            self.queues[key].put_nowait(self.generate(*key))
+        except Exception:  # Never let a failing generation kill the worker.
+            traceback.print_exc()
+        finally:
+            with self.lock:
+                self.pending[key] -= 1
+
+    def pop(self, level: str, topic: str, duration: str) -> Optional[List[Dict]]:
+        """Take a ready exercise, None if there is none"""
+        key = (level, topic, duration)
+        if key not in self.queues:
+            return None
+        try:
+            messages = self.queues[key].get_nowait()
+        except queue.Empty:
+            messages = None
+        self.refill(key)
+        return messages
+
+    def shutdown(self):
+        """Stop generating exercises"""
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+pool: Optional[ExercisePool] = None
+
+
+def _reset_after_fork():
+    """The threads of the parent's pool don't exist in a forked worker"""
+    global pool
+    pool = None
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def start(
+    app_settings: Dict,
+    generate: Callable[[str, str, str], List[Dict]],
+    ready: Optional[Callable[[int], Dict[Key, List[List[Dict]]]]] = None,
+):
+    """
+    Start the pool if it is enabled in the settings
+
+    ready is called with the depth and returns exercises to fill the queues
+    with before any are generated.
+    """
+    global pool
+    pool_settings = app_settings.get("exercise_pool")
+    if pool_settings is None or pool is not None:
+        return
+    combinations = itertools.product(
+        app_settings["levels"], app_settings["topics"], app_settings["durations"]
+    )
+    pool = ExercisePool(
+        combinations,
+        generate,
+        depth=pool_settings.get("depth", DEFAULT_DEPTH),
+        concurrency=pool_settings.get("concurrency", DEFAULT_CONCURRENCY),
+    )
+    pool.start(None if ready is None else ready(pool.depth))
+
+
+def pop(level: str, topic: str, duration: str) -> Optional[List[Dict]]:
+    """Take a ready exercise from the pool if it is running"""
+    if pool is None:
+        return None
+    return pool.pop(level, topic, duration)
@@ -0,0 +1,255 @@
+"""Create exercises, either freshly generated or from the cache"""
+import json
+import re
+from typing import Callable, Dict, List, Optional, Tuple
+
+import app_globals
+import exercise_cache
+import exercise_pool
+import gpt
+from app_globals import MessageType
+from prompts import ask_exercise, ask_exercise_with_title, ask_title
+
+MAX_TITLE_LENGTH = 200
+# Where the exercise string starts in a JSON reply, not inside another string.
+EXERCISE_KEY = re.compile(r'(?<!\\)"exercise"\s*:\s*"')
+
+
+def exercise_messages(
+    level: str, topic: str, duration: str, exercise: str, title: str
+) -> List[Dict]:
+    """The conversation that leads to an exercise with a title"""
+    return [
+        {
+            "role": "user",
+            "content": ask_exercise.format(level, topic, duration),
+            "message_type": MessageType.INITIAL_QUESTION,
+        },
+        {
+            "role": "assistant",
+            "content": exercise,
+            "message_type": MessageType.INITIAL_EXERCISE,
+        },
+        {"role": "user", "content": ask_title, "message_type": MessageType.ASK_TITLE},
+        {
+            "role": "assistant",
+            "content": title,
+            "message_type": MessageType.EXERCISE_TITLE,
+        },
+    ]
+
+
+def parse_exercise_with_title(content: str) -> Optional[Tuple[str, str]]:
+    """Get (exercise, title) from a JSON reply, None if it is not usable"""
+    content = content.strip()
+    # GPT likes to wrap JSON in a Markdown code block.
+    if content.startswith("```"):
+        content = content.strip("`").strip()
+        if content.startswith("json"):
+            content = content[len("json") :]
+    try:
+        reply = json.loads(content)
+    except json.JSONDecodeError:
+        return None
+    if not isinstance(reply, dict):
+        return None
+    exercise = reply.get("exercise")
+    title = reply.get("title")
+    if not isinstance(exercise, str) or not isinstance(title, str):
+        return None
+    exercise = exercise.strip()
+    title = title.strip()
+    if exercise == "" or title == "" or len(title) > MAX_TITLE_LENGTH:
+        return None
+    return exercise, title
+
+
+def generate_exercise_single_request(
+    level: str, topic: str, duration: str
+) -> Optional[List[Dict]]:
+    """Ask GPT for an exercise and its title at once, None if the reply is bad"""
+    prompt = ask_exercise_with_title.format(level, topic, duration)
+    question = {
+        "role": "user",
+        "content": prompt,
+        "message_type": MessageType.INITIAL_QUESTION,
+    }
+    content = gpt.get_completion([question])["message"]["content"]
+    parsed = parse_exercise_with_title(content)
+    if parsed is None:
+        return None
+    exercise, title = parsed
+    # Store the conversation as if it took two requests, the history and the
+    # evaluation of answers depend on it.
+    return exercise_messages(level, topic, duration, exercise, title)
+
+
+def decode_partial_string(text: str) -> Tuple[str, bool]:
+    """
+    Decode the start of a JSON string, text begins after the opening quote
+
+    Returns what can be decoded so far and whether the string is complete. An
+    escape sequence that is cut off is left for the next chunk.
+    """
+    index = 0
+    while index < len(text):
+        if text[index] == '"':
+            return json.loads('"' + text[:index] + '"'), True
+        if text[index] != "\\":
+            index += 1
+            continue
+        length = 6 if text[index + 1 : index + 2] == "u" else 2
+        # The high half of a surrogate pair waits for the low half.
+        if length == 6 and text[index + 2 : index + 3].lower() == "d":
+            if text[index + 3 : index + 4].lower() in "89ab":
+                length = 12
+        if index + length > len(text):
+            break
+        index += length
+    return json.loads('"' + text[:index] + '"'), False
+
+
+def stream_exercise_single_request(
+    level: str,
+    topic: str,
+    duration: str,
+    write: Callable[[str], None],
+    clear: Callable[[], None],
+) -> Tuple[Optional[List[Dict]], str]:
+    """
+    Stream an exercise and its title in one completion, writing the exercise
+
+    The reply is JSON, the exercise string is decoded while it arrives. Returns
+    the messages, None if the reply is bad, and the whole exercise if it was
+    written. Part of an exercise is removed with clear.
+    """
+    prompt = ask_exercise_with_title.format(level, topic, duration)
+    question = {
+        "role": "user",
+        "content": prompt,
+        "message_type": MessageType.INITIAL_QUESTION,
+    }
+    content = ""
+    written = ""
+    complete = False
+    for chunk in gpt.stream_completion([question]):
+        content += chunk
+        if complete:
+            continue
+        match = EXERCISE_KEY.search(content)
+        if match is None:
+            continue
+        exercise, complete = decode_partial_string(content[match.end() :])
+        if len(exercise) > len(written):
+            write(exercise[len(written) :])
+            written = exercise
+    parsed = parse_exercise_with_title(content)
+    if parsed is None:
+        if complete:
+            return None, written
+        if written:
+            clear()
+        return None, ""
+    exercise, title = parsed
+    return exercise_messages(level, topic, duration, exercise, title), written
+
+
+def generate_exercise(level: str, topic: str, duration: str) -> List[Dict]:
+    """Ask GPT for an exercise and its title"""
+    if app_globals.app_settings.get("single_request_generation", False):
+        messages = generate_exercise_single_request(level, topic, duration)
+        if messages is not None:
+            return messages
+
+    messages = exercise_messages(level, topic, duration, "", "")
+    exercise = gpt.get_completion(messages[:1])["message"]["content"]
+    messages[1]["content"] = exercise
+    title = gpt.get_completion(messages[:3])["message"]["content"]
+    messages[3]["content"] = title
+    return messages
+
+
+def new_exercise(level: str, topic: str, duration: str) -> List[Dict]:
+    """Generate an exercise and add it to the cache"""
+    messages = generate_exercise(level, topic, duration)
+    exercise_cache.store(
+        level, topic, duration, messages[1]["content"], messages[3]["content"]
+    )
+    return messages
+
+
+def cached_exercises(count: int) -> Dict[Tuple[str, str, str], List[List[Dict]]]:
+    """The messages of at most count cached exercises per exercise option"""
+    return {
+        (level, topic, duration): [
+            exercise_messages(level, topic, duration, exercise, title)
+            for exercise, title in cached
+        ]
+        for (level, topic, duration), cached in exercise_cache.recent(count).items()
+    }
+
+
+def ready_exercise(level: str, topic: str, duration: str) -> Optional[List[Dict]]:
+    """Get the messages of an exercise from the pool or the cache"""
+    messages = exercise_pool.pop(level, topic, duration)
+    if messages is not None:
+        return messages
+
+    cached = exercise_cache.lookup(level, topic, duration)
+    if cached is not None:
+        exercise, title = cached
+        return exercise_messages(level, topic, duration, exercise, title)
+    return None
+
+
+def get_exercise(level: str, topic: str, duration: str) -> List[Dict]:
+    """Get the messages of an exercise, generating one only when none is ready"""
+    messages = ready_exercise(level, topic, duration)
+    if messages is not None:
+        return messages
+    return new_exercise(level, topic, duration)
+
+
+def stream_exercise(
+    level: str,
+    topic: str,
+    duration: str,
+    write: Callable[[str], None],
+    clear: Callable[[], None],
+) -> List[Dict]:
+    """
+    Like get_exercise, but passes the exercise text to write as it arrives
+
+    With single_request_generation the exercise is taken from the JSON reply
+    while it streams. When the reply is bad but held the whole exercise, only
+    the title is asked for separately. Otherwise the text written is dropped
+    with clear and both are asked for.
+    """
+    messages = ready_exercise(level, topic, duration)
+    if messages is not None:
+        write(messages[1]["content"])
+        return messages
+
+    exercise = ""
+    if app_globals.app_settings.get("single_request_generation", False):
+        single, exercise = stream_exercise_single_request(
+            level, topic, duration, write, clear
+        )
+        if single is not None:
+            exercise_cache.store(
+                level, topic, duration, single[1]["content"], single[3]["content"]
+            )
+            return single
+
+    messages = exercise_messages(level, topic, duration, exercise, "")
+    if exercise == "":
+        chunks = []
+        for chunk in gpt.stream_completion(messages[:1]):
+            chunks.append(chunk)
+            write(chunk)
+        messages[1]["content"] = "".join(chunks)
+    messages[3]["content"] = gpt.get_completion(messages[:3])["message"]["content"]
+    exercise_cache.store(
+        level, topic, duration, messages[1]["content"], messages[3]["content"]
+    )
+    return messages
@@ -1,28 +1,384 @@
 """Access the GPT API"""
-import openai
+import collections
+import json
+import os
+import random
+import statistics
+import threading
+import time
+from typing import Callable, Deque, Dict, Iterator, List, Optional, Tuple, TypeVar
+
 import app_globals
+import completion_backends
+import context
+import rate_limit
+import tokenizer
+from app_globals import MessageType
+
+DEFAULT_MAX_RETRIES = 3
+DEFAULT_BACKOFF_BASE = 0.5
+DEFAULT_BACKOFF_MAX = 8.0
+DEFAULT_BREAKER_FAILURES = 5
+DEFAULT_BREAKER_RESET = 30.0
+# Number of recent calls kept for the statistics.
+CALL_LOG_SIZE = 1000
+DEFAULT_MODEL = "gpt-3.5-turbo"
+
+T = TypeVar("T")
+
+_backend: Optional[completion_backends.CompletionBackend] = None
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling the backend while it is failing"""
+
+
+class CircuitBreaker:
+    """
+    Fail fast after consecutive failures
+
+    After max_failures failures in a row the circuit opens and calls fail
+    immediately. After reset_after seconds a single trial call is let through,
+    if it succeeds the circuit closes again.
+    """
+
+    def __init__(self, max_failures: int, reset_after: float):
+        self.max_failures = max_failures
+        self.reset_after = reset_after
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.trial_running = False
+        self.lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        """closed, open or half-open"""
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < self.reset_after:
+            return "open"
+        return "half-open"
+
+    def allow(self) -> bool:
+        """Whether a call may go through"""
+        with self.lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half-open" and not self.trial_running:
+                self.trial_running = True
+                return True
+            return False
+
+    def record_success(self):
+        """Close the circuit"""
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    def record_failure(self):
+        """Count a failure, opening the circuit when there are too many"""
+        with self.lock:
+            self.failures += 1
+            self.trial_running = False
+            if self.failures >= self.max_failures or self.opened_at is not None:
+                self.opened_at = time.monotonic()
+
 
-openai.api_key = app_globals.app_settings["openai_key"]
+_breaker: Optional[CircuitBreaker] = None
+_call_log: Deque[Dict] = collections.deque(maxlen=CALL_LOG_SIZE)
+_route_stats: Dict[str, Dict] = {}
+_route_stats_lock = threading.Lock()
+_flights = rate_limit.SingleFlight()
 
 
-def choose_model():
-    """Select the model to use"""
-    return "gpt-3.5-turbo"
+def _reset_after_fork():
+    """Give a forked worker its own backend connections and circuit breaker"""
+    global _backend, _breaker
+    _backend = None
+    _breaker = None
 
 
-def get_completion(messages):
-    """Get the completion given the messages"""
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def client_settings() -> Dict:
+    """The completion_client section of the settings"""
+    return app_globals.app_settings.get("completion_client", {})
+
+
+def backend() -> completion_backends.CompletionBackend:
+    """The completion backend chosen in the settings"""
+    global _backend
+    if _backend is None:
+        _backend = completion_backends.create_backend(app_globals.app_settings)
+    return _backend
+
+
+def breaker() -> CircuitBreaker:
+    """The circuit breaker guarding the backend"""
+    global _breaker
+    if _breaker is None:
+        settings = client_settings()
+        _breaker = CircuitBreaker(
+            settings.get("breaker_failures", DEFAULT_BREAKER_FAILURES),
+            settings.get("breaker_reset", DEFAULT_BREAKER_RESET),
+        )
+    return _breaker
+
+
+def call_with_retries(kind: str, call: Callable[[], T]) -> T:
+    """
+    Call the backend, retrying with jittered exponential backoff
+
+    Every call is recorded in the call log with its latency and retry count.
+    """
+    settings = client_settings()
+    max_retries = settings.get("max_retries", DEFAULT_MAX_RETRIES)
+    backoff_base = settings.get("backoff_base", DEFAULT_BACKOFF_BASE)
+    backoff_max = settings.get("backoff_max", DEFAULT_BACKOFF_MAX)
+
+    start = time.perf_counter()
+    retries = 0
+    while True:
+        if not breaker().allow():
+            _log_call(kind, start, retries, "circuit-open")
+            raise CircuitOpenError("The completion backend is failing")
+        try:
+            result = call()
+        except Exception as e:
+            retryable = backend().is_retryable(e)
+            # Other errors mean the backend is up, but didn't like the request.
+            if retryable:
+                breaker().record_failure()
+            else:
+                breaker().record_success()
+            if not retryable or retries >= max_retries:
+                _log_call(kind, start, retries, "failed")
+                raise
+            # Full jitter: sleep a random time up to the exponential backoff.
+            time.sleep(random.uniform(0, min(backoff_max, backoff_base * 2**retries)))
+            retries += 1
+            continue
+        breaker().record_success()
+        _log_call(kind, start, retries, "ok")
+        return result
+
+
+def _log_call(kind: str, start: float, retries: int, outcome: str):
+    """Add a call to the call log"""
+    _call_log.append(
+        {
+            "kind": kind,
+            "latency": time.perf_counter() - start,
+            "retries": retries,
+            "outcome": outcome,
+        }
+    )
+
+
+def stats() -> Dict:
+    """Statistics over the recent calls for monitoring"""
+    calls = list(_call_log)
+    latencies = sorted(call["latency"] for call in calls if call["outcome"] == "ok")
+    result = {
+        "calls": len(calls),
+        "failed": sum(call["outcome"] != "ok" for call in calls),
+        "retries": sum(call["retries"] for call in calls),
+        "circuit": breaker().state,
+        "coalesced": _flights.coalesced,
+    }
+    if len(latencies) > 1:
+        quantiles = statistics.quantiles(latencies, n=100)
+        result["latency_p50"] = quantiles[49]
+        result["latency_p99"] = quantiles[98]
+    with _route_stats_lock:
+        result["routes"] = {
+            name: dict(
+                route_stats, mean_latency=route_stats["latency"] / route_stats["calls"]
+            )
+            for name, route_stats in _route_stats.items()
+        }
+    return result
+
+
+def routing_settings() -> Dict:
+    """The model_routing section of the settings"""
+    return app_globals.app_settings.get("model_routing", {})
+
+
+def choose_model(
+    message_type: Optional[MessageType], prompt_tokens: int
+) -> Tuple[str, str]:
+    """
+    Select the model to use, returns the name of the route and the model
+
+    The routes from the settings are tried in order. A route matches when the
+    type of the last message is in its message_types and the prompt is at most
+    max_prompt_tokens long, leaving either out matches anything.
+    """
+    settings = routing_settings()
+    for route in settings.get("routes", []):
+        message_types = route.get("message_types")
+        if message_types is not None and (
+            message_type is None
+            or message_type not in [MessageType[name] for name in message_types]
+        ):
+            continue
+        max_prompt_tokens = route.get("max_prompt_tokens")
+        if max_prompt_tokens is not None and prompt_tokens > max_prompt_tokens:
+            continue
+        return route["name"], route["model"]
+    return "default", settings.get("default", DEFAULT_MODEL)
+
+
+def _account(
+    route: str,
+    model: str,
+    latency: float,
+    prompt_tokens: int,
+    completion_tokens: int,
+    saved_tokens: int,
+):
+    """Add a completion to the latency and cost accounting of its route"""
+    costs = routing_settings().get("costs", {}).get(model, {})
+    cost = (
+        prompt_tokens * costs.get("prompt", 0)
+        + completion_tokens * costs.get("completion", 0)
+    ) / 1000
+    with _route_stats_lock:
+        route_stats = _route_stats.setdefault(
+            route,
+            {
+                "model": model,
+                "calls": 0,
+                "latency": 0.0,
+                "prompt_tokens": 0,
+                "completion_tokens": 0,
+                "saved_tokens": 0,
+                "cost": 0.0,
+            },
+        )
+        route_stats["model"] = model
+        route_stats["calls"] += 1
+        route_stats["latency"] += latency
+        route_stats["prompt_tokens"] += prompt_tokens
+        route_stats["completion_tokens"] += completion_tokens
+        route_stats["saved_tokens"] += saved_tokens
+        route_stats["cost"] += cost
+
+
+def message_type_of(message) -> Optional[MessageType]:
+    """The type of a message dict or database Message"""
+    if isinstance(message, dict):
+        message_type = message.get("message_type")
+    else:
+        message_type = message.message_type
+    return None if message_type is None else MessageType(message_type)
+
+
+def convert_messages(messages):
+    """Strip out metadata added on our side so the messages can be sent to OpenAI"""
 
-    # Strip out metadata added on our side.
     def convert_element(elem):
         """Convert an element in a message list to something that can be sent to OpenAI"""
-        if isinstance(messages[0], dict):
+        if isinstance(elem, dict):
             return {"role": elem["role"], "content": elem["content"]}
         return {"role": elem.role, "content": elem.text}
 
-    messages = [convert_element(message) for message in messages]
+    return [convert_element(message) for message in messages]
+
+
+def _prepare(messages) -> Tuple[List[Dict], str, str, int, int]:
+    """
+    Build the context to send and route it
 
-    response = openai.ChatCompletion.create(
-        model=choose_model(), messages=messages, n=1
+    Returns the messages to send, the route, the model, the prompt size and the
+    number of tokens saved by trimming the context.
+    """
+    message_types = [message_type_of(message) for message in messages]
+    messages, saved_tokens = context.build_context(
+        convert_messages(messages), message_types
     )
-    return response.choices[0]
+    prompt_tokens = context.prompt_tokens(messages)
+    route, model = choose_model(message_types[-1], prompt_tokens)
+    return messages, route, model, prompt_tokens, saved_tokens
+
+
+def _flight_key(kind: str, messages: List[Dict], model: str) -> str:
+    """Identical requests have identical keys"""
+    return json.dumps([kind, model, messages], sort_keys=True)
+
+
+def get_completion(messages, shared: bool = False):
+    """
+    Get the completion given the messages
+
+    With shared, identical concurrent requests share a single call to the
+    backend. Only for callers that want the same answer, not for generating
+    exercises, where every call should give a new one.
+    """
+    messages, route, model, prompt_tokens, saved_tokens = _prepare(messages)
+
+    def complete() -> str:
+        """Call the backend and account for the call"""
+        start = time.perf_counter()
+        content = call_with_retries(
+            "complete", lambda: backend().complete(messages, model)
+        )
+        _account(
+            route,
+            model,
+            time.perf_counter() - start,
+            prompt_tokens,
+            tokenizer.count_tokens(content),
+            saved_tokens,
+        )
+        return content
+
+    if shared:
+        content = _flights.do(_flight_key("complete", messages, model), complete)
+    else:
+        content = complete()
+    return {"message": {"role": "assistant", "content": content}}
+
+
+def stream_completion(messages, shared: bool = False) -> Iterator[str]:
+    """
+    Yield the content of the completion as it arrives
+
+    Only getting the first chunk is retried, the latency recorded is the time to
+    the first chunk. With shared, identical concurrent requests share a single
+    stream, see get_completion.
+    """
+    messages, route, model, prompt_tokens, saved_tokens = _prepare(messages)
+
+    def stream() -> Iterator[str]:
+        """Stream from the backend and account for the call"""
+        start = time.perf_counter()
+
+        def first_chunk():
+            """Start the stream and wait for the first chunk"""
+            chunks = backend().stream(messages, model)
+            return chunks, next(chunks, None)
+
+        chunks, chunk = call_with_retries("stream", first_chunk)
+        completion = []
+        while chunk is not None:
+            completion.append(chunk)
+            yield chunk
+            chunk = next(chunks, None)
+        _account(
+            route,
+            model,
+            time.perf_counter() - start,
+            prompt_tokens,
+            tokenizer.count_tokens("".join(completion)),
+            saved_tokens,
+        )
+
+    if shared:
+        yield from _flights.stream(_flight_key("stream", messages, model), stream)
+    else:
+        yield from stream()
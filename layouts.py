@@ -0,0 +1,76 @@
+"""
+Page layouts in the JSON form Dash sends to the browser
+
+Dash turns components into JSON one at a time in Python, a layout of plain
+dicts and lists is serialized in one go, by orjson when it is installed. Parts
+of a page that are the same for every user are converted once per settings
+version, parts that differ per user are filled into templates.
+"""
+import functools
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from dash.development.base_component import Component
+
+import app_globals
+
+
+def json_form(value: Any) -> Any:
+    """value with its components replaced by their JSON form"""
+    if isinstance(value, Component):
+        form = value.to_plotly_json()
+        form["props"] = {name: json_form(prop) for name, prop in form["props"].items()}
+        return form
+    if isinstance(value, (list, tuple)):
+        return [json_form(item) for item in value]
+    # Dicts are props like style, or components in JSON form already.
+    return value
+
+
+def per_settings_version(build: Callable[[], Any]) -> Callable[[], Any]:
+    """Memoize the JSON form of what build returns until the settings change"""
+    memo: Optional[Tuple[int, Any]] = None
+
+    @functools.wraps(build)
+    def memoized():
+        nonlocal memo
+        version = app_globals.app_settings.version
+        if memo is None or memo[0] != version:
+            memo = (version, json_form(build()))
+        return memo[1]
+
+    return memoized
+
+
+class Blank(str):
+    """A named hole in a template"""
+
+    def __new__(cls, name: str):
+        blank = super().__new__(cls, "{" + name + "}")
+        blank.name = name
+        return blank
+
+
+class Template:
+    """
+    The JSON form of a component with blanks, filled in per use
+
+    build is called once, with a Blank for each of names.
+    """
+
+    def __init__(self, build: Callable[..., Component], *names: str):
+        self.form = json_form(build(*(Blank(name) for name in names)))
+
+    def fill(self, **values) -> Dict:
+        """A copy of the template with the blanks replaced by values"""
+        return _fill(self.form, values)
+
+
+def _fill(form: Any, values: Dict) -> Any:
+    """Copy form, replacing the blanks"""
+    if isinstance(form, Blank):
+        return json_form(values[form.name])
+    if isinstance(form, dict):
+        return {key: _fill(value, values) for key, value in form.items()}
+    if isinstance(form, list):
+        return [_fill(item, values) for item in form]
+    return form
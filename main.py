@@ -1,6 +1,9 @@
 """Setup Dash and run the app"""
+import argparse
 import flask
+import os
 import sys
+import threading
 from typing import Dict
 from dash import (
     callback,
@@ -15,9 +18,20 @@ from dash import (
 )
 import dash_bootstrap_components as dbc
 
+import database
+import exercise_pool
+import exercises
+import gpt
+import migrations
+import sessions
+import write_behind
 
-def run(app_settings: Dict):
-    """Run the app"""
+DEFAULT_BIND = "127.0.0.1:8050"
+DEFAULT_THREADS = 4
+
+
+def create_app(app_settings: Dict) -> Dash:
+    """Create the Dash app"""
     app = Dash(
         __name__,
         title="GP Tutor",
@@ -27,6 +41,8 @@ def run(app_settings: Dict):
     )
     app.config.suppress_callback_exceptions = True
     app.server.secret_key = app_settings["flask_secret"]
+    app.server.session_interface = sessions.ServerSessionInterface()
+    app.server.add_url_rule("/stats", "stats", stats)
 
     app.layout = dbc.Container(
         [
@@ -53,7 +69,103 @@ def run(app_settings: Dict):
         ],
         className="p-5",
     )
-    app.run_server(debug=True)
+    return app
+
+
+def stats():
+    """Statistics for monitoring"""
+    return flask.jsonify(
+        {"completions": gpt.stats(), "write_behind": write_behind.stats()}
+    )
+
+
+def start_workers(app_settings: Dict):
+    """Start the background workers of a process that serves requests"""
+    exercise_pool.start(
+        app_settings, exercises.new_exercise, exercises.cached_exercises
+    )
+
+
+def set_up_dash(app: Dash):
+    """
+    Run the set up Dash does on the first request
+
+    Dash marks it as done before it is, so concurrent first requests of a
+    threaded server can fail. Call this before adding hooks of our own.
+    """
+    with app.server.test_request_context("/"):
+        for set_up in app.server.before_request_funcs.get(None, []):
+            set_up()
+
+
+def start_workers_on_first_request(app: Dash, app_settings: Dict):
+    """
+    Start the background workers when a process serves its first request
+
+    For WSGI servers that load the app themselves, before or after forking.
+    """
+    started_pid = None
+    lock = threading.Lock()
+
+    def start():
+        """Start the workers once per process"""
+        nonlocal started_pid
+        if started_pid == os.getpid():
+            return
+        with lock:
+            if started_pid != os.getpid():
+                start_workers(app_settings)
+                started_pid = os.getpid()
+
+    app.server.before_request(start)
+
+
+def run(app_settings: Dict, bind: str = DEFAULT_BIND, debug: bool = False):
+    """Run the app on the development server"""
+    host, port = bind.rsplit(":", 1)
+    migrations.upgrade(database.get_engine())
+    app = create_app(app_settings)
+    # With the reloader the app is started twice, only start the workers in
+    # the process that serves requests.
+    if not debug or os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        start_workers(app_settings)
+    app.run_server(debug=debug, host=host, port=int(port))
+
+
+def serve(app_settings: Dict, bind: str, workers: int, threads: int):
+    """
+    Serve the app with gunicorn
+
+    The app is loaded once and then forked into the workers, which each start
+    their own database connections, completion client and background workers.
+    """
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        sys.exit("Install gunicorn to serve the app with multiple workers")
+    migrations.upgrade(database.get_engine())
+    app = create_app(app_settings)
+    set_up_dash(app)
+
+    class Application(BaseApplication):
+        """gunicorn running the Flask server of the Dash app"""
+
+        def load_config(self):
+            """Configure gunicorn from the command line options"""
+            self.cfg.set("bind", bind)
+            self.cfg.set("workers", workers)
+            self.cfg.set("threads", threads)
+            self.cfg.set("worker_class", "gthread")
+            self.cfg.set("preload_app", True)
+            self.cfg.set(
+                "post_worker_init", lambda _worker: start_workers(app_settings)
+            )
+
+        def load(self):
+            """The WSGI app"""
+            return app.server
+
+    Application().run()
 
 
 @callback(
@@ -86,10 +198,37 @@ def toggle_elements_logged_in(href):
         ]
 
 
-if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("One argument required: the location of the settings yaml file")
+def main():
+    """Parse the command line and run the app"""
+    parser = argparse.ArgumentParser(description="Run GPTutor")
+    parser.add_argument("settings", help="the location of the settings yaml file")
+    parser.add_argument("--bind", default=DEFAULT_BIND, help="host:port to listen on")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="serve with this many gunicorn worker processes",
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=DEFAULT_THREADS,
+        help="threads per gunicorn worker",
+    )
+    parser.add_argument(
+        "--debug",
+        action="store_true",
+        help="use the development server with the reloader and debug tools",
+    )
+    args = parser.parse_args()
+
+    import app_globals
+
+    app_globals.app_settings.use(args.settings)
+    if args.workers is None:
+        run(app_globals.app_settings, args.bind, args.debug)
     else:
-        import app_globals
+        serve(app_globals.app_settings, args.bind, args.workers, args.threads)
 
-        run(app_globals.app_settings)
+
+if __name__ == "__main__":
+    main()
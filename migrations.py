@@ -0,0 +1,166 @@
+"""
+Versioned schema migrations
+
+The schema version is kept in the schema_version table. Each migration brings
+the schema from the previous version to its own and must work on databases
+created by older versions of GPTutor, which had no version table.
+"""
+from typing import Callable, List, Optional, Tuple
+
+import sqlalchemy
+from sqlalchemy.engine import Connection, Engine
+
+import database
+
+version_table = sqlalchemy.Table(
+    "schema_version",
+    sqlalchemy.MetaData(),
+    sqlalchemy.Column("version", sqlalchemy.Integer, nullable=False),
+)
+
+
+def create_initial_tables(connection: Connection):
+    """The tables as they were before migrations existed, without indexes"""
+    inspector = sqlalchemy.inspect(connection)
+    for table in (
+        database.User.__table__,
+        database.Exercise.__table__,
+        database.Message.__table__,
+        database.CachedExercise.__table__,
+    ):
+        if not inspector.has_table(table.name):
+            connection.execute(sqlalchemy.schema.CreateTable(table))
+
+
+def create_indexes(connection: Connection):
+    """Indexes for the history pages and the exercise cache"""
+    for table in (
+        database.Exercise.__table__,
+        database.Message.__table__,
+        database.CachedExercise.__table__,
+    ):
+        for index in table.indexes:
+            index.create(connection, checkfirst=True)
+
+
+SQLITE_SEARCH = [
+    # Messages have even and titles odd rowids. owner holds u<user id> so
+    # searches can be restricted to a user inside the index.
+    """
+    CREATE VIRTUAL TABLE exercise_search USING fts5(
+        owner, title, text, exercise_id UNINDEXED, tokenize = 'porter unicode61'
+    )
+    """,
+    f"""
+    INSERT INTO exercise_search (rowid, owner, title, text, exercise_id)
+    SELECT message.id * 2, 'u' || exercises.user_id, '', message.text, exercises.id
+    FROM message JOIN exercises ON exercises.id = message.exercise_id
+    WHERE message.message_type IN {database.SEARCHED_MESSAGE_TYPES_SQL}
+    """,
+    """
+    INSERT INTO exercise_search (rowid, owner, title, text, exercise_id)
+    SELECT id * 2 + 1, 'u' || user_id, title, '', id FROM exercises
+    """,
+    f"""
+    CREATE TRIGGER message_search_insert AFTER INSERT ON message
+    WHEN NEW.message_type IN {database.SEARCHED_MESSAGE_TYPES_SQL}
+    BEGIN
+        INSERT INTO exercise_search (rowid, owner, title, text, exercise_id)
+        SELECT NEW.id * 2, 'u' || user_id, '', NEW.text, id
+        FROM exercises WHERE id = NEW.exercise_id;
+    END
+    """,
+    """
+    CREATE TRIGGER message_search_delete AFTER DELETE ON message
+    BEGIN
+        DELETE FROM exercise_search WHERE rowid = OLD.id * 2;
+    END
+    """,
+    """
+    CREATE TRIGGER exercise_search_insert AFTER INSERT ON exercises
+    BEGIN
+        INSERT INTO exercise_search (rowid, owner, title, text, exercise_id)
+        VALUES (NEW.id * 2 + 1, 'u' || NEW.user_id, NEW.title, '', NEW.id);
+    END
+    """,
+    """
+    CREATE TRIGGER exercise_search_update AFTER UPDATE OF title ON exercises
+    BEGIN
+        UPDATE exercise_search SET title = NEW.title WHERE rowid = NEW.id * 2 + 1;
+    END
+    """,
+    """
+    CREATE TRIGGER exercise_search_delete AFTER DELETE ON exercises
+    BEGIN
+        DELETE FROM exercise_search WHERE rowid = OLD.id * 2 + 1;
+    END
+    """,
+]
+
+POSTGRESQL_SEARCH = [
+    f"""
+    CREATE INDEX ix_message_text_search ON message
+    USING gin (to_tsvector('english', text))
+    WHERE message_type IN {database.SEARCHED_MESSAGE_TYPES_SQL}
+    """,
+    """
+    CREATE INDEX ix_exercises_title_search ON exercises
+    USING gin (to_tsvector('english', title))
+    """,
+]
+
+
+def create_search_index(connection: Connection):
+    """Full text search over exercise titles and messages"""
+    if connection.dialect.name == "postgresql":
+        statements = POSTGRESQL_SEARCH
+    else:
+        statements = SQLITE_SEARCH
+    for statement in statements:
+        connection.exec_driver_sql(statement)
+
+
+def create_sessions_table(connection: Connection):
+    """Server side sessions"""
+    database.StoredSession.__table__.create(connection)
+
+
+def create_streams_table(connection: Connection):
+    """Background completions shared by the workers"""
+    database.StoredStream.__table__.create(connection)
+
+
+MIGRATIONS: List[Tuple[int, str, Callable[[Connection], None]]] = [
+    (1, "Initial tables", create_initial_tables),
+    (2, "Indexes on exercises, messages and the cache", create_indexes),
+    (3, "Full text search", create_search_index),
+    (4, "Sessions", create_sessions_table),
+    (5, "Streams", create_streams_table),
+]
+
+
+def current_version(connection: Connection) -> int:
+    """The version of the schema, 0 for a database without migrations"""
+    if not sqlalchemy.inspect(connection).has_table(version_table.name):
+        return 0
+    version = connection.execute(sqlalchemy.select(version_table.c.version)).scalar()
+    return version or 0
+
+
+def upgrade(engine: Engine, target: Optional[int] = None):
+    """Apply the migrations up to target, by default all of them"""
+    for version, description, migrate in MIGRATIONS:
+        if target is not None and version > target:
+            break
+        with engine.begin() as connection:
+            if version <= current_version(connection):
+                continue
+            print(f"Migrating the database to version {version}: {description}")
+            migrate(connection)
+            version_table.create(connection, checkfirst=True)
+            connection.execute(sqlalchemy.delete(version_table))
+            connection.execute(sqlalchemy.insert(version_table).values(version=version))
+
+
+if __name__ == "__main__":
+    upgrade(database.get_engine())
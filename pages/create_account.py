@@ -4,6 +4,8 @@ import flask
 from dash import callback, dcc, exceptions, Output, Input, State
 import dash_bootstrap_components as dbc
 import database
+import passwords
+import sessions
 
 register_page(__name__)
 
@@ -106,23 +108,21 @@ def create_user(_, username, email, password1, password2):
     if password1 != password2:
         return ["Passwords don't match", {"display": "block"}]
 
-    with database.Session(database.engine) as session:
-        # noinspection PyTypeChecker
-        if (
-            session.query(database.User)
-            .where(username == database.User.username)
-            .count()
-            > 0
-        ):
-            return ["Username exists", {"display": "block"}]
-
-        # noinspection PyTypeChecker
-        if session.query(database.User).where(email == database.User.email).count() > 0:
+    with database.Session(database.get_engine()) as session:
+        try:
+            user = database.create_user(session, username, email, password1)
+        except database.DuplicateUserError as e:
+            if e.field == "username":
+                return ["Username exists", {"display": "block"}]
             return ["E-mail address already used", {"display": "block"}]
-
-        user = database.create_user(session, username, email, password1)
+        except passwords.PasswordQueueFull:
+            return [
+                "Too many sign ups at the moment, please try again",
+                {"display": "block"},
+            ]
 
         if user is not None:
+            sessions.regenerate()
             flask.session.setdefault("user", {"username": user.username, "id": user.id})
             return [dcc.Location(pathname="/", id="login-fail"), {}]
 
@@ -1,65 +1,70 @@
 """Display the exercise history"""
 import datetime
-from typing import Optional
+from typing import Dict, List, Optional, Tuple
 
 import flask
 from dash import dcc, html, register_page
 import dash_bootstrap_components as dbc
 import sqlalchemy
+import app_globals
 import database
+import layouts
 from app_globals import MessageType
 
 register_page(__name__)
 
+DEFAULT_PAGE_SIZE = 25
 
-def layout(hid: Optional[str] = None) -> dbc.Container:
+
+def layout(
+    hid: Optional[str] = None, before: Optional[str] = None, q: Optional[str] = None
+) -> Dict:
     """Layout of the exercise history page"""
-    print(f"{hid=}")
+    return layouts.json_form(history_page(hid, before, q))
+
+
+def history_page(
+    hid: Optional[str], before: Optional[str], q: Optional[str]
+) -> dbc.Container:
+    """The overview, search results or an exercise"""
     user = flask.session.get("user")
     if user is None:
         return dbc.Container()
 
     if hid is None:
-        # noinspection PyTypeChecker
-        exercises = database.Session(database.engine).scalars(
-            sqlalchemy.select(database.Exercise).where(
-                user["id"] == database.Exercise.user_id
+        page_size = app_globals.app_settings.get("history", {}).get(
+            "page_size", DEFAULT_PAGE_SIZE
+        )
+        if q:
+            return search_results(
+                q, database.search_exercises(user["id"], q, page_size)
             )
+        return overview(
+            database.fetch_exercises(user["id"], page_size, parse_key(before)),
+            page_size,
+            before is not None,
         )
-        if exercises is None:
-            return dbc.Container()
-        return overview(exercises)
-
-    # noinspection PyTypeChecker
-    exercise = (
-        database.Session(database.engine)
-        .query(database.Exercise)
-        .where(user["id"] == database.Exercise.user_id)
-        .where(hid == database.Exercise.id)
-        .order_by(sqlalchemy.desc(database.Exercise.id))
-        .first()
-    )
+    if not hid.isdigit():
+        return dbc.Container()
 
+    exercise = database.fetch_exercise_detail(
+        user["id"],
+        int(hid),
+        [
+            MessageType.EXERCISE_TITLE,
+            MessageType.INITIAL_EXERCISE,
+            MessageType.EXERCISE_EVAL,
+        ],
+    )
     if exercise is None:
         return dbc.Container()
 
-    exercise_title = [
-        message.text.strip()
-        for message in exercise.messages
-        if message.message_type == int(MessageType.EXERCISE_TITLE)
-    ]
-
-    exercise_body = [
-        message.text.strip()
-        for message in exercise.messages
-        if message.message_type == MessageType.INITIAL_EXERCISE
-    ]
-
-    exercise_answer = [
-        message.text.strip()
-        for message in exercise.messages
-        if message.message_type == MessageType.EXERCISE_EVAL
-    ]
+    texts = {message_type: [] for message_type in MessageType}
+    for message in exercise.messages:
+        texts[MessageType(message.message_type)].append(message.text.strip())
+    exercise_title = texts[MessageType.EXERCISE_TITLE]
+    exercise_body = texts[MessageType.INITIAL_EXERCISE]
+    exercise_answer = texts[MessageType.EXERCISE_EVAL]
 
     if len(exercise_answer) == 0 or exercise_answer[0] == "":
         return dbc.Container([html.H1(exercise_title), html.P(exercise_body)])
@@ -81,9 +86,35 @@ def format_title(title):
     return title
 
 
-def overview(exercises: sqlalchemy.ScalarResult) -> dbc.Container:
-    """Provide a history overview"""
-    exercises = exercises.fetchall()
+def parse_key(key: Optional[str]) -> Optional[Tuple[int, int]]:
+    """Parse a page key of the form start_timestamp-id"""
+    if key is None:
+        return None
+    try:
+        start_timestamp, exercise_id = key.split("-")
+        return int(start_timestamp), int(exercise_id)
+    except ValueError:
+        return None
+
+
+def overview(
+    exercises: List[sqlalchemy.Row], page_size: int, paged: bool
+) -> dbc.Container:
+    """Provide a page of the history overview"""
+    more = len(exercises) > page_size
+    exercises = exercises[:page_size]
+    links = []
+    if paged:
+        links.append(dcc.Link("Newest", href="/history/", className="me-3"))
+    if more:
+        last = exercises[-1]
+        links.append(
+            dcc.Link(
+                "Older",
+                href=f"/history/?before={last.start_timestamp}-{last.id}",
+            )
+        )
+
     if len(exercises) == 0:
         return dbc.Container(
             dbc.Alert("You have not started any exercises yet"), className="m-2"
@@ -93,35 +124,74 @@ def overview(exercises: sqlalchemy.ScalarResult) -> dbc.Container:
         [
             dcc.Location(id="url", refresh=False),
             html.H1(id="param"),
-            dbc.Table(
+            SEARCH_FORM,
+            exercise_table(exercises),
+            html.Div(links),
+        ],
+        className="m-2",
+    )
+
+
+def search_results(query: str, exercises: List[sqlalchemy.Row]) -> dbc.Container:
+    """Show the exercises matching a search"""
+    if len(exercises) == 0:
+        results = dbc.Alert(f"No exercises match {query}")
+    else:
+        results = exercise_table(exercises)
+    return dbc.Container(
+        [
+            search_form(query),
+            results,
+            dcc.Link("All exercises", href="/history/"),
+        ],
+        className="m-2",
+    )
+
+
+def search_form(query: str = "") -> html.Form:
+    """A search box, submitting it reloads the page with the query in q"""
+    return html.Form(
+        dbc.InputGroup(
+            [
+                dbc.Input(name="q", value=query, placeholder="Search exercises"),
+                dbc.Button("Search", type="submit"),
+            ]
+        ),
+        action="/history/",
+        method="GET",
+        className="mb-2",
+    )
+
+
+def exercise_row(title: str, href: str, started: str) -> html.Tr:
+    """A row of the exercise table"""
+    return html.Tr([html.Td(dcc.Link(title, href=href)), html.Td(started)])
+
+
+# Built once, the rows differ per user and are filled in.
+SEARCH_FORM = layouts.json_form(search_form())
+TABLE_HEAD = layouts.json_form(
+    html.Thead(html.Tr([html.Th("Title"), html.Th("Timestamp")]))
+)
+EXERCISE_ROW = layouts.Template(exercise_row, "title", "href", "started")
+
+
+def exercise_table(exercises: List[sqlalchemy.Row]) -> dbc.Table:
+    """A table linking to the exercises"""
+    return dbc.Table(
+        [
+            TABLE_HEAD,
+            html.Tbody(
                 [
-                    html.Thead(
-                        html.Tr([html.Th("Title"), html.Th("Timestamp")]),
-                    )
-                ]
-                + [
-                    html.Tbody(
-                        [
-                            html.Tr(
-                                [
-                                    html.Td(
-                                        dcc.Link(
-                                            format_title(row.title),
-                                            href=f"/history/?hid={row.id}",
-                                        )
-                                    ),
-                                    html.Td(
-                                        datetime.datetime.fromtimestamp(
-                                            row.start_timestamp
-                                        )
-                                    ),
-                                ],
-                            )
-                            for row in exercises
-                        ]
+                    EXERCISE_ROW.fill(
+                        title=format_title(row.title),
+                        href=f"/history/?hid={row.id}",
+                        started=datetime.datetime.fromtimestamp(
+                            row.start_timestamp
+                        ).isoformat(),
                     )
+                    for row in exercises
                 ]
             ),
-        ],
-        className="m-2",
+        ]
     )
@@ -1,43 +1,52 @@
 """The home page"""
-from typing import Dict, List
+from concurrent.futures import Future
+from typing import Dict, List, Optional, Union
 import flask
+import math
+import secrets
 import time
-from dash import callback, dcc, exceptions, html, register_page, Output, Input, State
+from dash import (
+    callback,
+    clientside_callback,
+    dcc,
+    exceptions,
+    html,
+    no_update,
+    register_page,
+    Output,
+    Input,
+    State,
+)
 import dash_bootstrap_components as dbc
-import sqlalchemy
 
 import database
+import exercises
 import gpt
+import layouts
+import rate_limit
+import streaming
+import write_behind
 import app_globals
 from app_globals import MessageType
-from prompts import ask_exercise, ask_title
 
 
 register_page(__name__, path="/")
 
+# Session key of the exercise an anonymous user is working on.
+ANONYMOUS_EXERCISE = "anonymous_exercise"
+
 
 def options_from_settings_key(key: str) -> List[Dict[str, str]]:
     """Transform a list of names to dropdown option values"""
     return [{"label": val, "value": val} for val in app_globals.app_settings[key]]
 
 
-dropdown_level = dcc.Dropdown(
-    id="level-dropdown",
-    options=options_from_settings_key("levels"),
-    clearable=False,
-)
+def dropdown(component_id: str, key: str) -> dcc.Dropdown:
+    """A dropdown with the names under key in the settings"""
+    return dcc.Dropdown(
+        id=component_id, options=options_from_settings_key(key), clearable=False
+    )
 
-dropdown_topic = dcc.Dropdown(
-    id="topic-dropdown",
-    options=options_from_settings_key("topics"),
-    clearable=False,
-)
-
-dropdown_time = dcc.Dropdown(
-    id="time-dropdown",
-    options=options_from_settings_key("durations"),
-    clearable=False,
-)
 
 prompt_description = html.Div(id="prompt-description", style={"fontSize:": 16})
 exercise_description = html.Div(id="exercise-description", style={"fontSize:": 16})
@@ -49,6 +58,14 @@ start_button = dbc.Button(
 timer = dcc.Interval(
     id="interval-component", interval=1000, max_intervals=0
 )  # interval in milliseconds
+stream_interval = dcc.Interval(id="stream-interval", interval=250, disabled=True)
+cancel_button = dbc.Button(
+    "Cancel",
+    id="cancel-button",
+    color="secondary",
+    n_clicks=0,
+    style={"display": "none"},
+)
 
 
 def layout():
@@ -58,20 +75,25 @@ def layout():
         greeting = dbc.Alert("You are not logged in", color="danger")
     else:
         greeting = html.Div(f"Welcome {user['username']}")
+    return [layouts.json_form(html.Div(greeting, className="m-2"))] + exercise_page()
+
+
+@layouts.per_settings_version
+def exercise_page() -> List:
+    """The home page below the greeting, the same for every user"""
     return [
         dcc.Location(id="url"),
-        html.Div(greeting, className="m-2"),
         html.Div(
             [
                 html.H3("Create an exercise"),
                 html.Label("Select Topic"),
-                dropdown_topic,
+                dropdown("topic-dropdown", "topics"),
                 html.Div(style={"height": "20px"}),
                 html.Label("Select Difficulty"),
-                dropdown_level,
+                dropdown("level-dropdown", "levels"),
                 html.Div(style={"height": "20px"}),
                 html.Label("Select Duration"),
-                dropdown_time,
+                dropdown("time-dropdown", "durations"),
                 html.Div(style={"height": "20px"}),
             ],
             id="exercise-options",
@@ -95,17 +117,167 @@ def layout():
         html.Div(
             [
                 start_button,
+                cancel_button,
                 html.H1(id="stopwatch", children="00:00:00"),
                 timer,
             ],
             className="d-grid gap-2 d-md-flex justify-content-md-start",
         ),
+        html.Small(id="stream-progress", className="text-muted"),
         html.Div(style={"height": "20px"}),
         html.Div(id="exercise-eval"),
         dcc.Store("timer-start-in-seconds"),
+        dcc.Store("stream-id"),
+        # The exercise being answered: its id for logged in users, for
+        # anonymous users the key of the exercise in their session.
+        dcc.Store("active-exercise"),
+        stream_interval,
+    ]
+
+
+def message_rows(messages: List[Dict]) -> List[Dict]:
+    """Message dicts as rows of the message table"""
+    return [
+        {
+            "role": message["role"],
+            "text": message["content"],
+            "message_type": message["message_type"],
+        }
+        for message in messages
     ]
 
 
+def save_exercise(
+    user: Dict, messages: List[Dict], start_time: float
+) -> Union[int, Future]:
+    """
+    Save a generated exercise and the messages that led to it, returns its id
+
+    With write_behind the exercise is queued and a future of the id returned.
+    """
+    writer = write_behind.writer()
+    if writer is not None:
+        return writer.save_exercise(
+            user["id"], messages[3]["content"], start_time, message_rows(messages)
+        )
+    with database.Session(database.get_engine()) as session:
+        exercise_obj = database.save_exercise(
+            session, user["id"], messages[3]["content"], start_time
+        )
+
+        message_objs = [
+            database.Message(
+                exercise=exercise_obj,
+                role=message["role"],
+                text=message["content"],
+                message_type=message["message_type"],
+            )
+            for message in messages
+        ]
+        session.add_all(message_objs)
+        session.commit()
+        return exercise_obj.id
+
+
+def generate_exercise(stream: streaming.Stream, user, level, topic, duration):
+    """Stream a new exercise and save it once it is complete"""
+    messages = exercises.stream_exercise(
+        level, topic, duration, stream.write, stream.clear
+    )
+    if stream.cancelled:
+        return
+    start_time = time.time()
+    # The account may have been removed while the user was logged in.
+    if user is not None and database.get_user(user["id"]) is None:
+        user = None
+    if user is None:
+        active = {"messages": messages}
+    else:
+        exercise_id = save_exercise(user, messages, start_time)
+        if isinstance(exercise_id, Future):
+            # The poll that gets the result may reach another worker, so the
+            # id is waited for here, off the request threads.
+            exercise_id = exercise_id.result()
+        active = {"id": exercise_id}
+    stream.finish(
+        exercise=messages[1]["content"],
+        title=messages[3]["content"],
+        start_time=start_time,
+        active=active,
+    )
+
+
+def evaluate_answer(
+    stream: streaming.Stream, user: Optional[Dict], active: Dict, answer: str
+):
+    """
+    Stream the evaluation of the answer to the active exercise
+
+    For logged in users the answer and evaluation are saved with the exercise.
+    For anonymous users active holds the messages from their session.
+    """
+    answer = (answer or "").strip()
+    if user is None:
+        messages = active["messages"] + [
+            {
+                "role": "user",
+                "content": answer,
+                "message_type": MessageType.EXERCISE_ANSWER,
+            }
+        ]
+        for chunk in gpt.stream_completion(messages, shared=True):
+            stream.write(chunk)
+        stream.finish()
+        return
+
+    with database.Session(database.get_engine()) as session:
+        exercise = database.fetch_owned_exercise(session, user["id"], active["id"])
+        if exercise is None:
+            stream.fail("The exercise was not found")
+            return
+        new_message = database.Message(
+            exercise_id=exercise.id,
+            role="user",
+            text=answer,
+            message_type=MessageType.EXERCISE_ANSWER,
+        )
+        messages = exercise.messages + [new_message]
+        for chunk in gpt.stream_completion(messages, shared=True):
+            stream.write(chunk)
+        if stream.cancelled:
+            return
+        evaluation = database.Message(
+            exercise_id=exercise.id,
+            role="assistant",
+            text=stream.text(),
+            message_type=MessageType.EXERCISE_EVAL,
+        )
+        writer = write_behind.writer()
+        if writer is not None:
+            writer.add_messages(
+                [
+                    {
+                        "exercise_id": message.exercise_id,
+                        "role": message.role,
+                        "text": message.text,
+                        "message_type": message.message_type,
+                    }
+                    for message in (new_message, evaluation)
+                ]
+            )
+        else:
+            session.add_all([new_message, evaluation])
+            session.commit()
+    stream.finish()
+
+
+def rate_limit_key(user: Dict):
+    """Rate limit logged in users by id and anonymous users by address"""
+    if user is None:
+        return "address", flask.request.remote_addr
+    return "user", user["id"]
+
+
 @callback(
     [
         Output("start-button", "children"),
@@ -117,6 +289,12 @@ def layout():
         Output("exercise-options", "style"),
         Output("exercise-main", "style"),
         Output("exercise-eval", "children"),
+        Output("stream-id", "data"),
+        Output("stream-interval", "disabled"),
+        Output("cancel-button", "style"),
+        Output("stream-progress", "children", allow_duplicate=True),
+        Output("start-button", "disabled", allow_duplicate=True),
+        Output("active-exercise", "data"),
     ],
     [
         Input("start-button", "n_clicks"),
@@ -126,139 +304,239 @@ def layout():
         State("topic-dropdown", "value"),
         State("time-dropdown", "value"),
         State("exercise-answer", "value"),
+        State("start-button", "children"),
+        State("active-exercise", "data"),
     ],
     prevent_initial_call=True,
 )
-def start_exercise(n_clicks, level, topic, duration, answer):
-    """Start the exercise: show the result of the prompt and start the timer"""
+def start_exercise(n_clicks, level, topic, duration, answer, button_text, active):
+    """
+    Start the exercise: stream the result of the prompt
+
+    The completion runs in the background, poll_stream shows its output and
+    starts the timer once it is done. While an exercise is shown the button
+    reads Done and clicking it submits the answer.
+    """
     user = flask.session.get("user")
     if n_clicks == 0:
         raise exceptions.PreventUpdate
-    elif n_clicks % 2 == 0:
-        if user is not None:
-            with database.Session(database.engine) as session:
-                exercise = (
-                    session.query(database.Exercise)
-                    .order_by(sqlalchemy.desc(database.Exercise.id))
-                    .limit(1)
-                    .first()
-                )
-                answer = answer.strip()
-                new_message = database.Message(
-                    exercise_id=exercise.id,
-                    role="user",
-                    text=answer,
-                    message_type=MessageType.EXERCISE_ANSWER,
-                )
-                session.add(new_message)
-                messages = exercise.messages + [new_message]
-                response = gpt.get_completion(messages)["message"]
-                session.add(
-                    database.Message(
-                        exercise_id=exercise.id,
-                        role="assistant",
-                        text=response["content"],
-                        message_type=MessageType.EXERCISE_EVAL,
-                    )
-                )
-                session.commit()
-            print(f'{response["content"]=}')
-            return [
-                "Start",
-                "primary",
-                0,
-                None,
-                "",
-                "",
-                {"display": "block"},
-                {"display": "none"},
-                response["content"],
-            ]
 
-    prompt = ask_exercise.format(level, topic, duration)
-    messages = [
-        {
-            "role": "user",
-            "content": prompt,
-            "message_type": MessageType.INITIAL_QUESTION,
-        }
-    ]
-    exercise = gpt.get_completion(messages)["message"]["content"]
-    messages += [
-        {
-            "role": "assistant",
-            "content": exercise,
-            "message_type": MessageType.INITIAL_EXERCISE,
-        }
-    ]
-    messages += [
-        {"role": "user", "content": ask_title, "message_type": MessageType.ASK_TITLE}
-    ]
-    title = gpt.get_completion(messages)["message"]
-    title["message_type"] = MessageType.EXERCISE_TITLE
-    messages += [title]
-
-    start_time = time.time()
+    retry_after = rate_limit.acquire(rate_limit_key(user))
+    if retry_after is not None:
+        return [no_update] * 12 + [
+            f"Too many requests, please try again in {math.ceil(retry_after)} seconds.",
+            False,
+            no_update,
+        ]
 
-    if user is not None:
-        with database.Session(database.engine) as session:
-            # noinspection PyTypeChecker
-            user = session.scalars(
-                sqlalchemy.select(database.User).where(user["id"] == database.User.id)
-            ).first()
-            exercise_obj = database.save_exercise(
-                session, user, title["content"], start_time
-            )
-
-            message_objs = [
-                database.Message(
-                    exercise=exercise_obj,
-                    role=message["role"],
-                    text=message["content"],
-                    message_type=message["message_type"],
-                )
-                for message in messages
-            ]
-            session.add_all(message_objs)
-            session.commit()
+    if button_text == "Done" and active is not None:
+        if user is None:
+            active = take_anonymous_exercise(active)
+            if active is None:
+                return [no_update] * 12 + [
+                    "This exercise can't be graded anymore, please start a new one.",
+                    False,
+                    None,
+                ]
+        stream_id = streaming.start(
+            "eval", lambda stream: evaluate_answer(stream, user, active, answer)
+        )
+        return [
+            "Start",
+            "primary",
+            0,
+            None,
+            "",
+            "",
+            {"display": "block"},
+            {"display": "none"},
+            "",
+            stream_id,
+            False,
+            {"display": "block"},
+            "",
+            no_update,
+            None,
+        ]
 
+    stream_id = streaming.start(
+        "exercise",
+        lambda stream: generate_exercise(stream, user, level, topic, duration),
+    )
     return [
         "Done",
         "success",
-        -1,
-        start_time,
-        title["content"],
-        exercise,
+        0,
+        None,
+        "",
+        "",
         {"display": "none"},
         {"display": "block"},
         "",
+        stream_id,
+        False,
+        {"display": "block"},
+        "",
+        no_update,
+        None,
     ]
 
 
+# Disable the start button in the browser right away, so a double click can't
+# start two completions. poll_stream enables it again.
+clientside_callback(
+    "function(n_clicks) { return true; }",
+    Output("start-button", "disabled", allow_duplicate=True),
+    Input("start-button", "n_clicks"),
+    prevent_initial_call=True,
+)
+
+
 @callback(
-    Output("stopwatch", "children"),
     [
-        Input("interval-component", "n_intervals"),
-        Input("timer-start-in-seconds", "data"),
+        Output("exercise-title", "children", allow_duplicate=True),
+        Output("exercise-description", "children", allow_duplicate=True),
+        Output("exercise-eval", "children", allow_duplicate=True),
+        Output("timer-start-in-seconds", "data", allow_duplicate=True),
+        Output("interval-component", "max_intervals", allow_duplicate=True),
+        Output("stream-interval", "disabled", allow_duplicate=True),
+        Output("stream-progress", "children"),
+        Output("start-button", "disabled", allow_duplicate=True),
+        Output("cancel-button", "style", allow_duplicate=True),
+        Output("active-exercise", "data", allow_duplicate=True),
+    ],
+    [
+        Input("stream-interval", "n_intervals"),
+    ],
+    [
+        State("stream-id", "data"),
     ],
     prevent_initial_call=True,
 )
-def update_timer(_, timer_start):
+def poll_stream(_, stream_id):
+    """Show the text streamed so far and finish up once the stream is done"""
+    stream = streaming.get(stream_id)
+    finished = [True, "", False, {"display": "none"}, no_update]
+    if stream is None:
+        return [no_update] * 5 + finished
+
+    text = stream.text()
+    if stream.error is not None:
+        text = "Something went wrong, please try again."
+    if not stream.done:
+        running = [False, stream.progress(), True, no_update, no_update]
+        if stream.kind == "exercise":
+            return [no_update, text, no_update, no_update, no_update] + running
+        return [no_update, no_update, text, no_update, no_update] + running
+
+    streaming.discard(stream_id)
+    if stream.kind == "exercise" and stream.error is None:
+        return (
+            [
+                stream.result["title"],
+                stream.result["exercise"],
+                no_update,
+                stream.result["start_time"],
+                -1,
+            ]
+            + finished[:-1]
+            + [resolve_active(stream.result["active"])]
+        )
+    if stream.kind == "exercise":
+        return [no_update, text, no_update, no_update, no_update] + finished
+    return [no_update, no_update, text, no_update, no_update] + finished
+
+
+def resolve_active(active: Dict) -> Dict:
     """
-    Update the timer based on the saved timer start
+    What the browser keeps of the active exercise
 
-    The argument n_intervals is not reliable as the browser can freeze a tab if it loses focus. This causes the timer to
-    stop. Also prevents the timer from drifting.
+    That is the id of a saved exercise. The messages of an anonymous user's
+    exercise stay in their session, the browser only gets a random key, so
+    it can't change what is sent to the model when grading.
     """
-    if timer_start is None:
-        return "00:00:00"
-
-    seconds = int(time.time() - timer_start)
-    hours = seconds // 3600
-    seconds %= 3600
-    minutes = seconds // 60
-    seconds %= 60
-    return "{:02d}:{:02d}:{:02d}".format(hours, minutes, seconds)
+    if "messages" in active:
+        key = secrets.token_urlsafe(16)
+        flask.session[ANONYMOUS_EXERCISE] = {"key": key, "messages": active["messages"]}
+        return {"key": key}
+    return active
+
+
+def take_anonymous_exercise(active: Dict) -> Optional[Dict]:
+    """The messages of the exercise the key in active refers to, at most once"""
+    exercise = flask.session.get(ANONYMOUS_EXERCISE)
+    if exercise is None or exercise["key"] != active.get("key"):
+        return None
+    del flask.session[ANONYMOUS_EXERCISE]
+    return {"messages": exercise["messages"]}
+
+
+@callback(
+    [
+        Output("start-button", "children", allow_duplicate=True),
+        Output("start-button", "color", allow_duplicate=True),
+        Output("start-button", "disabled", allow_duplicate=True),
+        Output("interval-component", "max_intervals", allow_duplicate=True),
+        Output("timer-start-in-seconds", "data", allow_duplicate=True),
+        Output("exercise-options", "style", allow_duplicate=True),
+        Output("exercise-main", "style", allow_duplicate=True),
+        Output("exercise-eval", "children", allow_duplicate=True),
+        Output("stream-interval", "disabled", allow_duplicate=True),
+        Output("stream-progress", "children", allow_duplicate=True),
+        Output("cancel-button", "style", allow_duplicate=True),
+    ],
+    [
+        Input("cancel-button", "n_clicks"),
+    ],
+    [
+        State("stream-id", "data"),
+    ],
+    prevent_initial_call=True,
+)
+def cancel_stream(n_clicks, stream_id):
+    """Cancel the running completion and go back to choosing an exercise"""
+    if n_clicks == 0:
+        raise exceptions.PreventUpdate
+    streaming.cancel(stream_id)
+    return [
+        "Start",
+        "primary",
+        False,
+        0,
+        None,
+        {"display": "block"},
+        {"display": "none"},
+        "",
+        True,
+        "",
+        {"display": "none"},
+    ]
+
+
+# The stopwatch runs in the browser, computing the elapsed time from the saved
+# start on every tick. n_intervals is not reliable as the browser can freeze a
+# tab if it loses focus, this also keeps the stopwatch from drifting.
+clientside_callback(
+    """
+    function(_, timerStart) {
+        if (timerStart === null || timerStart === undefined) {
+            return "00:00:00";
+        }
+        let seconds = Math.max(0, Math.floor(Date.now() / 1000 - timerStart));
+        const pad = (value) => String(value).padStart(2, "0");
+        const hours = Math.floor(seconds / 3600);
+        seconds %= 3600;
+        const minutes = Math.floor(seconds / 60);
+        return pad(hours) + ":" + pad(minutes) + ":" + pad(seconds % 60);
+    }
+    """,
+    Output("stopwatch", "children"),
+    [
+        Input("interval-component", "n_intervals"),
+        Input("timer-start-in-seconds", "data"),
+    ],
+    prevent_initial_call=True,
+)
 
 
 @callback(
@@ -3,6 +3,8 @@ import flask
 from dash import callback, dcc, exceptions, register_page, Output, Input, State
 import dash_bootstrap_components as dbc
 import database
+import passwords
+import sessions
 
 register_page(__name__)
 
@@ -77,8 +79,12 @@ def login_user(_, email, password):
     session = flask.session
     if email is None or password is None:
         raise exceptions.PreventUpdate
-    user = database.verify_password(email, password)
+    try:
+        user = database.verify_password(email, password)
+    except passwords.PasswordQueueFull:
+        return ["Too many logins at the moment, please try again", {"display": "block"}]
     if user is not None:
+        sessions.regenerate()
         session.setdefault("user", {"username": user.username, "id": user.id})
         # dcc.Location requires an id, but we are just after the side effect. id could be anything.
         return [dcc.Location(pathname="/", id="login-fail"), {"display": "none"}]
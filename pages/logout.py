@@ -2,6 +2,7 @@
 from dash import register_page
 import flask
 import dash_bootstrap_components as dbc
+import database
 
 register_page(__name__)
 
@@ -10,6 +11,8 @@ def layout():
     """The logout page layout"""
     user = flask.session.get("user")
     if user is not None:
+        database.user_cache().invalidate(user["id"])
+        # An empty session is removed from the store, for every worker.
         flask.session.clear()
 
     return dbc.Alert("Logged out", color="success")
@@ -0,0 +1,127 @@
+"""
+Hash and check passwords with bcrypt in a pool of worker processes
+
+bcrypt is slow on purpose, running it in worker processes keeps a burst of
+logins from blocking the web server. At most max_queue requests wait for a
+worker, more are refused with PasswordQueueFull. When a worker process dies,
+the pool is replaced and the call tried once more.
+"""
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, Optional, TypeVar
+
+import app_globals
+
+DEFAULT_ROUNDS = 12
+DEFAULT_WORKERS = 2
+DEFAULT_MAX_QUEUE = 32
+
+T = TypeVar("T")
+
+
+class PasswordQueueFull(Exception):
+    """Raised when too many password checks are waiting"""
+
+
+def _hash(password: str, rounds: int) -> bytes:
+    """Hash a password, runs in a worker process"""
+    import bcrypt  # scrypt can be hard to install.
+
+    return bcrypt.hashpw(bytes(password, "utf-8"), bcrypt.gensalt(rounds))
+
+
+def _check(password: str, hashed: bytes) -> bool:
+    """Check a password against its hash, runs in a worker process"""
+    import bcrypt
+
+    return bcrypt.checkpw(bytes(password, "utf-8"), hashed)
+
+
+_pool: Optional[ProcessPoolExecutor] = None
+_slots: Optional[threading.BoundedSemaphore] = None
+_pool_lock = threading.Lock()
+
+
+def _reset_after_fork():
+    """A forked worker starts its own worker processes"""
+    global _pool, _slots, _pool_lock
+    _pool = None
+    _slots = None
+    _pool_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def settings():
+    """The passwords section of the settings"""
+    return app_globals.app_settings.get("passwords", {})
+
+
+def rounds() -> int:
+    """The bcrypt cost of new hashes"""
+    return settings().get("rounds", DEFAULT_ROUNDS)
+
+
+def pool() -> ProcessPoolExecutor:
+    """The worker processes, started on first use"""
+    global _pool, _slots
+    with _pool_lock:
+        if _pool is None:
+            workers = settings().get("workers", DEFAULT_WORKERS)
+            if _slots is None:
+                max_queue = settings().get("max_queue", DEFAULT_MAX_QUEUE)
+                _slots = threading.BoundedSemaphore(workers + max_queue)
+            methods = multiprocessing.get_all_start_methods()
+            method = "forkserver" if "forkserver" in methods else "spawn"
+            # Forking the threaded server could copy a lock held by another
+            # thread into the workers, a fork server starts them cleanly.
+            _pool = ProcessPoolExecutor(
+                max_workers=workers, mp_context=multiprocessing.get_context(method)
+            )
+    return _pool
+
+
+def _drop(broken: ProcessPoolExecutor):
+    """Forget a broken pool, the next call to pool starts a new one"""
+    global _pool
+    with _pool_lock:
+        if _pool is broken:
+            _pool = None
+    broken.shutdown(wait=False)
+
+
+def _run(function: Callable[..., T], *args) -> T:
+    """Run function in the pool, unless too many calls are waiting already"""
+    executor = pool()
+    slots = _slots
+    if not slots.acquire(blocking=False):
+        raise PasswordQueueFull("Too many password checks are waiting")
+    try:
+        try:
+            return executor.submit(function, *args).result()
+        except BrokenProcessPool:
+            # A worker process died, e.g. killed for running out of memory.
+            _drop(executor)
+            return pool().submit(function, *args).result()
+    finally:
+        slots.release()
+
+
+def hash_password(password: str) -> bytes:
+    """Hash a password with the configured number of rounds"""
+    return _run(_hash, password, rounds())
+
+
+def check_password(password: str, hashed: bytes) -> bool:
+    """Whether password matches hashed"""
+    return _run(_check, password, hashed)
+
+
+def needs_rehash(hashed: bytes) -> bool:
+    """Whether hashed was made with a different number of rounds"""
+    # bcrypt hashes look like $2b$12$..., where 12 is the cost.
+    return int(hashed.split(b"$")[2]) != rounds()
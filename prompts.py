@@ -3,3 +3,8 @@ ask_exercise = """Give me a {:s} {:s} coding exercise that takes approximately {
 Just ask the question, do not show any code. Don't offer any further assistance"""
 
 ask_title = """Give a title to this exercise"""
+
+ask_exercise_with_title = """Give me a {:s} {:s} coding exercise that takes approximately {:s}.
+Just ask the question, do not show any code. Don't offer any further assistance.
+Reply with a JSON object only, with first the key "title" for a short title of
+the exercise and then the key "exercise" for the exercise itself."""
@@ -0,0 +1,208 @@
+"""Rate limiting and coalescing of completion requests"""
+import collections
+import threading
+import time
+from typing import Callable, Dict, Hashable, Iterator, List, Optional
+
+import app_globals
+
+DEFAULT_USER_PER_MINUTE = 6
+DEFAULT_USER_BURST = 3
+DEFAULT_GLOBAL_PER_MINUTE = 120
+DEFAULT_GLOBAL_BURST = 20
+# Buckets of this many users are kept, the least recently seen are dropped.
+MAX_USERS = 10000
+
+
+class TokenBucket:
+    """Allows rate requests per second on average with bursts up to capacity"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self):
+        """Add the tokens accumulated since the last update"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self) -> float:
+        """Seconds until a token is available, 0 if one is available now"""
+        self.refill()
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class RateLimiter:
+    """A token bucket per user and one shared by everyone"""
+
+    def __init__(
+        self,
+        user_per_minute: float,
+        user_burst: float,
+        global_per_minute: float,
+        global_burst: float,
+    ):
+        self.user_rate = user_per_minute / 60
+        self.user_burst = user_burst
+        self.global_bucket = TokenBucket(global_per_minute / 60, global_burst)
+        self.user_buckets: collections.OrderedDict = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def acquire(self, user_key: Hashable) -> Optional[float]:
+        """Take a token for user_key, None if allowed, else seconds to wait"""
+        with self.lock:
+            bucket = self.user_buckets.pop(user_key, None)
+            if bucket is None:
+                bucket = TokenBucket(self.user_rate, self.user_burst)
+            self.user_buckets[user_key] = bucket
+            if len(self.user_buckets) > MAX_USERS:
+                self.user_buckets.popitem(last=False)
+
+            wait = max(bucket.wait_time(), self.global_bucket.wait_time())
+            if wait > 0:
+                return wait
+            bucket.tokens -= 1
+            self.global_bucket.tokens -= 1
+            return None
+
+
+class _Flight:
+    """A call in progress whose chunks are shared with identical calls"""
+
+    def __init__(self):
+        self.chunks: List = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.followers = 0
+        self.condition = threading.Condition()
+
+
+class SingleFlight:
+    """
+    Let identical concurrent calls share one call
+
+    The first caller for a key does the work, callers arriving while it runs
+    get the same result. When the first caller stops reading, e.g. because its
+    user cancelled, the rest is read on a thread for the others.
+    """
+
+    def __init__(self):
+        self.flights: Dict[Hashable, _Flight] = {}
+        self.coalesced = 0
+        self.lock = threading.Lock()
+
+    def _join(self, key: Hashable):
+        """Get the flight for key and whether we lead it"""
+        with self.lock:
+            flight = self.flights.get(key)
+            if flight is not None:
+                self.coalesced += 1
+                flight.followers += 1
+                return flight, False
+            flight = _Flight()
+            self.flights[key] = flight
+            return flight, True
+
+    def _land(self, key: Hashable, flight: _Flight, error: BaseException = None):
+        """Mark the flight as done and wake up the followers"""
+        with self.lock:
+            self.flights.pop(key, None)
+        with flight.condition:
+            flight.error = error
+            flight.done = True
+            flight.condition.notify_all()
+
+    def _add(self, flight: _Flight, chunk: str):
+        """Pass a chunk on to the followers"""
+        with flight.condition:
+            flight.chunks.append(chunk)
+            flight.condition.notify_all()
+
+    def _drain(self, key: Hashable, flight: _Flight, chunks: Iterator[str]):
+        """Read the rest of an abandoned call for its followers"""
+        try:
+            for chunk in chunks:
+                self._add(flight, chunk)
+        except BaseException as e:
+            self._land(key, flight, e)
+            return
+        self._land(key, flight)
+
+    def _abandon(self, key: Hashable, flight: _Flight, chunks: Iterator[str]):
+        """The leader stopped reading, finish the call if others wait for it"""
+        with self.lock:
+            if flight.followers == 0:
+                self.flights.pop(key, None)
+                return
+        threading.Thread(
+            target=self._drain,
+            args=(key, flight, chunks),
+            name="single-flight",
+            daemon=True,
+        ).start()
+
+    def do(self, key: Hashable, call: Callable[[], str]) -> str:
+        """Return the result of call, shared with identical concurrent calls"""
+        return "".join(self.stream(key, lambda: iter([call()])))
+
+    def stream(self, key: Hashable, call: Callable[[], Iterator[str]]) -> Iterator[str]:
+        """Yield the chunks of call, shared with identical concurrent calls"""
+        flight, leader = self._join(key)
+        if leader:
+            chunks = None
+            try:
+                chunks = iter(call())
+                for chunk in chunks:
+                    self._add(flight, chunk)
+                    yield chunk
+            except GeneratorExit:
+                self._abandon(key, flight, chunks)
+                raise
+            except BaseException as e:
+                self._land(key, flight, e)
+                raise
+            self._land(key, flight)
+            return
+
+        position = 0
+        while True:
+            with flight.condition:
+                flight.condition.wait_for(
+                    lambda: position < len(flight.chunks) or flight.done
+                )
+                chunks = flight.chunks[position:]
+                done = flight.done
+                error = flight.error
+            position += len(chunks)
+            yield from chunks
+            if done and position == len(flight.chunks):
+                break
+        if error is not None:
+            raise error
+
+
+_limiter: Optional[RateLimiter] = None
+
+
+def limiter() -> RateLimiter:
+    """The rate limiter configured under rate_limits"""
+    global _limiter
+    if _limiter is None:
+        settings = app_globals.app_settings.get("rate_limits", {})
+        _limiter = RateLimiter(
+            settings.get("user_per_minute", DEFAULT_USER_PER_MINUTE),
+            settings.get("user_burst", DEFAULT_USER_BURST),
+            settings.get("global_per_minute", DEFAULT_GLOBAL_PER_MINUTE),
+            settings.get("global_burst", DEFAULT_GLOBAL_BURST),
+        )
+    return _limiter
+
+
+def acquire(user_key: Hashable) -> Optional[float]:
+    """Take a token for user_key, None if allowed, else seconds to wait"""
+    return limiter().acquire(user_key)
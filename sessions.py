@@ -0,0 +1,385 @@
+"""
+Browser sessions kept on the server
+
+The session cookie only holds a random id, the contents are kept in a store:
+the database by default, or memory for a single process. Sessions expire
+lifetime_days after they were last used. Recently used sessions are cached in
+the process for cache_ttl seconds, so a session revoked by another worker
+stays valid there for at most that long. A revoked session is never stored
+again, a request that still has its id gets a new session.
+"""
+import collections
+import json
+import os
+import secrets
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+import flask
+import sqlalchemy
+from flask.sessions import SecureCookieSession, SessionInterface
+
+import app_globals
+import database
+
+DEFAULT_STORE = "database"
+DEFAULT_LIFETIME_DAYS = 30
+DEFAULT_CACHE_TTL = 5
+DEFAULT_CACHE_ENTRIES = 10000
+# Sliding expiration writes a new expiry at most this often per session.
+REFRESH_INTERVAL = 300
+# Seconds between deleting expired sessions from the store.
+PURGE_INTERVAL = 3600
+
+
+class SessionStore:
+    """Interface of a place to keep sessions, expiry is a Unix timestamp"""
+
+    def load(self, session_id: str) -> Optional[Tuple[Dict, int]]:
+        """The data and expiry of a session, None if there is no such session"""
+        raise NotImplementedError
+
+    def create(self, session_id: str, data: Dict, expires: int):
+        """Add a new session"""
+        raise NotImplementedError
+
+    def update(self, session_id: str, data: Dict, expires: int) -> bool:
+        """Replace the data of a session, False if there is no such session"""
+        raise NotImplementedError
+
+    def touch(self, session_id: str, expires: int):
+        """Move the expiry of a session"""
+        raise NotImplementedError
+
+    def delete(self, session_id: str):
+        """Remove a session"""
+        raise NotImplementedError
+
+    def purge(self, now: int):
+        """Remove the sessions that expired before now"""
+        raise NotImplementedError
+
+
+class DatabaseSessionStore(SessionStore):
+    """Sessions in the sessions table, shared by all workers"""
+
+    table = database.StoredSession.__table__
+
+    def load(self, session_id: str) -> Optional[Tuple[Dict, int]]:
+        """The data and expiry of a session, None if there is no such session"""
+        with database.get_engine().connect() as connection:
+            row = connection.execute(
+                sqlalchemy.select(
+                    self.table.c.data, self.table.c.expires_timestamp
+                ).where(self.table.c.id == session_id)
+            ).first()
+        if row is None:
+            return None
+        return json.loads(row.data), row.expires_timestamp
+
+    def create(self, session_id: str, data: Dict, expires: int):
+        """Add a new session"""
+        with database.get_engine().begin() as connection:
+            connection.execute(
+                sqlalchemy.insert(self.table).values(
+                    id=session_id, data=json.dumps(data), expires_timestamp=expires
+                )
+            )
+
+    def update(self, session_id: str, data: Dict, expires: int) -> bool:
+        """Replace the data of a session, False if there is no such session"""
+        with database.get_engine().begin() as connection:
+            return bool(
+                connection.execute(
+                    sqlalchemy.update(self.table)
+                    .where(self.table.c.id == session_id)
+                    .values(data=json.dumps(data), expires_timestamp=expires)
+                ).rowcount
+            )
+
+    def touch(self, session_id: str, expires: int):
+        """Move the expiry of a session"""
+        with database.get_engine().begin() as connection:
+            connection.execute(
+                sqlalchemy.update(self.table)
+                .where(self.table.c.id == session_id)
+                .values(expires_timestamp=expires)
+            )
+
+    def delete(self, session_id: str):
+        """Remove a session"""
+        with database.get_engine().begin() as connection:
+            connection.execute(
+                sqlalchemy.delete(self.table).where(self.table.c.id == session_id)
+            )
+
+    def purge(self, now: int):
+        """Remove the sessions that expired before now"""
+        with database.get_engine().begin() as connection:
+            connection.execute(
+                sqlalchemy.delete(self.table).where(
+                    self.table.c.expires_timestamp < now
+                )
+            )
+
+
+class MemorySessionStore(SessionStore):
+    """Sessions in a dict, only for a single process, e.g. in development"""
+
+    def __init__(self):
+        self.sessions: Dict[str, Tuple[str, int]] = {}
+        self.lock = threading.Lock()
+
+    def load(self, session_id: str) -> Optional[Tuple[Dict, int]]:
+        """The data and expiry of a session, None if there is no such session"""
+        entry = self.sessions.get(session_id)
+        if entry is None:
+            return None
+        return json.loads(entry[0]), entry[1]
+
+    def create(self, session_id: str, data: Dict, expires: int):
+        """Add a new session"""
+        # Stored as JSON, like the database does, so changes to data after
+        # saving don't leak into the store.
+        self.sessions[session_id] = (json.dumps(data), expires)
+
+    def update(self, session_id: str, data: Dict, expires: int) -> bool:
+        """Replace the data of a session, False if there is no such session"""
+        with self.lock:
+            if session_id not in self.sessions:
+                return False
+            self.sessions[session_id] = (json.dumps(data), expires)
+            return True
+
+    def touch(self, session_id: str, expires: int):
+        """Move the expiry of a session"""
+        with self.lock:
+            entry = self.sessions.get(session_id)
+            if entry is not None:
+                self.sessions[session_id] = (entry[0], expires)
+
+    def delete(self, session_id: str):
+        """Remove a session"""
+        self.sessions.pop(session_id, None)
+
+    def purge(self, now: int):
+        """Remove the sessions that expired before now"""
+        with self.lock:
+            for session_id, (_, expires) in list(self.sessions.items()):
+                if expires < now:
+                    del self.sessions[session_id]
+
+
+class Sessions:
+    """
+    A session store with sliding expiration and an in-process cache
+
+    The cache holds (time cached, data, expiry) by session id. Entries are
+    used for cache_ttl seconds, the least recently used are dropped when there
+    are more than max_entries.
+    """
+
+    def __init__(
+        self, store: SessionStore, lifetime: int, cache_ttl: float, max_entries: int
+    ):
+        self.store = store
+        self.lifetime = lifetime
+        self.cache_ttl = cache_ttl
+        self.max_entries = max_entries
+        self.cache: collections.OrderedDict = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.purged = 0.0
+
+    def _remember(self, session_id: str, data: Dict, expires: int):
+        """Put a session in the cache"""
+        with self.lock:
+            self.cache[session_id] = (time.monotonic(), data, expires)
+            self.cache.move_to_end(session_id)
+            if len(self.cache) > self.max_entries:
+                self.cache.popitem(last=False)
+
+    def _forget(self, session_id: str):
+        """Drop a session from the cache"""
+        with self.lock:
+            self.cache.pop(session_id, None)
+
+    def load(self, session_id: str) -> Optional[Tuple[Dict, int]]:
+        """The data and expiry of a live session, from the cache when possible"""
+        with self.lock:
+            entry = self.cache.get(session_id)
+            if entry is not None and time.monotonic() - entry[0] < self.cache_ttl:
+                self.cache.move_to_end(session_id)
+                loaded: Optional[Tuple[Dict, int]] = (dict(entry[1]), entry[2])
+            else:
+                loaded = None
+        if loaded is None:
+            loaded = self.store.load(session_id)
+            if loaded is None:
+                self._forget(session_id)
+                return None
+            self._remember(session_id, dict(loaded[0]), loaded[1])
+        if loaded[1] < time.time():
+            self.revoke(session_id)
+            return None
+        return loaded
+
+    def create(self, session_id: str, data: Dict) -> int:
+        """Store a new session, returns its expiry"""
+        now = int(time.time())
+        expires = now + self.lifetime
+        self.store.create(session_id, data, expires)
+        self._remember(session_id, dict(data), expires)
+        if now - self.purged > PURGE_INTERVAL:
+            self.purged = now
+            self.store.purge(now)
+        return expires
+
+    def save(self, session_id: str, data: Dict) -> Optional[int]:
+        """
+        Store a changed session for another lifetime, returns the new expiry
+
+        None when the session was revoked meanwhile, e.g. by a logout in
+        another request. It is not stored again.
+        """
+        expires = int(time.time()) + self.lifetime
+        if not self.store.update(session_id, data, expires):
+            self._forget(session_id)
+            return None
+        self._remember(session_id, dict(data), expires)
+        return expires
+
+    def refresh(self, session_id: str, data: Dict, expires: int) -> Optional[int]:
+        """
+        Extend the lifetime of a session that is in use
+
+        Returns the new expiry, or None when the last one is recent enough.
+        """
+        now = int(time.time())
+        if now + self.lifetime - expires < REFRESH_INTERVAL:
+            return None
+        expires = now + self.lifetime
+        self.store.touch(session_id, expires)
+        self._remember(session_id, dict(data), expires)
+        return expires
+
+    def revoke(self, session_id: str):
+        """End a session for every worker"""
+        self.store.delete(session_id)
+        self._forget(session_id)
+
+
+def create_store(store_type: str) -> SessionStore:
+    """Create the store configured as store under sessions"""
+    if store_type == "database":
+        return DatabaseSessionStore()
+    if store_type == "memory":
+        return MemorySessionStore()
+    raise ValueError(f"Unknown session store: {store_type}")
+
+
+_sessions: Optional[Sessions] = None
+_sessions_lock = threading.Lock()
+
+
+def _reset_after_fork():
+    """A forked worker starts with an empty cache"""
+    global _sessions, _sessions_lock
+    _sessions = None
+    _sessions_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def sessions() -> Sessions:
+    """The sessions configured under sessions"""
+    global _sessions
+    with _sessions_lock:
+        if _sessions is None:
+            settings = app_globals.app_settings.get("sessions", {})
+            _sessions = Sessions(
+                create_store(settings.get("store", DEFAULT_STORE)),
+                settings.get("lifetime_days", DEFAULT_LIFETIME_DAYS) * 24 * 3600,
+                settings.get("cache_ttl", DEFAULT_CACHE_TTL),
+                settings.get("max_entries", DEFAULT_CACHE_ENTRIES),
+            )
+    return _sessions
+
+
+class ServerSession(SecureCookieSession):
+    """flask.session backed by the store, session_id is None until saved"""
+
+    def __init__(
+        self,
+        initial: Optional[Dict] = None,
+        session_id: Optional[str] = None,
+        expires: int = 0,
+    ):
+        super().__init__(initial)
+        self.session_id = session_id
+        self.expires = expires
+
+
+class ServerSessionInterface(SessionInterface):
+    """Keeps flask.session in the store, the cookie only holds the id"""
+
+    def open_session(self, app: flask.Flask, request) -> ServerSession:
+        """The session named by the cookie, a new one if it isn't live"""
+        session_id = request.cookies.get(self.get_cookie_name(app))
+        if session_id:
+            loaded = sessions().load(session_id)
+            if loaded is not None:
+                return ServerSession(loaded[0], session_id, loaded[1])
+        return ServerSession()
+
+    def save_session(self, app: flask.Flask, session: ServerSession, response):
+        """Store the session and set the cookie when the expiry moved"""
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if session.accessed:
+            response.vary.add("Cookie")
+
+        if not session:
+            if session.session_id is not None:
+                sessions().revoke(session.session_id)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        if session.session_id is None:
+            session.session_id = secrets.token_urlsafe(32)
+            expires = sessions().create(session.session_id, dict(session))
+        elif session.modified:
+            expires = sessions().save(session.session_id, dict(session))
+            # A revoked session stays gone, the next request of the browser
+            # starts a new one. The cookie is left alone, another response
+            # may have set a new id already.
+            if expires is None:
+                return
+        else:
+            expires = sessions().refresh(
+                session.session_id, dict(session), session.expires
+            )
+            if expires is None:
+                return
+
+        response.set_cookie(
+            name,
+            session.session_id,
+            expires=expires,
+            httponly=self.get_cookie_httponly(app),
+            domain=domain,
+            path=path,
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app),
+        )
+
+
+def regenerate():
+    """Give the current session a new id, e.g. when a user logs in"""
+    session = flask.session
+    if session.session_id is not None:
+        sessions().revoke(session.session_id)
+        session.session_id = None
+    session.modified = True
@@ -0,0 +1,374 @@
+"""
+Run completions in the background so the browser can poll partial output
+
+A stream is written by a thread of the process that started it, and kept in a
+store, by default the streams table, so a poll or cancel can be answered by
+any worker. The text is written to the store at most every flush_interval
+seconds. Cancelling removes the stream from the store, the thread notices on
+its next write.
+"""
+import json
+import os
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+import sqlalchemy
+
+import app_globals
+import database
+
+DEFAULT_MAX_WORKERS = 8
+DEFAULT_STORE = "database"
+DEFAULT_FLUSH_INTERVAL = 0.2
+# Streams nobody polls anymore are dropped after this many seconds.
+MAX_STREAM_AGE = 3600
+# Seconds between deleting streams older than MAX_STREAM_AGE.
+PURGE_INTERVAL = 600
+
+
+class StreamCancelled(Exception):
+    """Raised in the background thread when the stream was cancelled"""
+
+
+class StreamStore:
+    """Interface of a place to keep streams"""
+
+    def create(self, stream_id: str, kind: str, created: int):
+        """Add a queued stream"""
+        raise NotImplementedError
+
+    def update(self, stream_id: str, fields: Dict) -> bool:
+        """Change a stream, False if it was removed, i.e. cancelled"""
+        raise NotImplementedError
+
+    def load(self, stream_id: str) -> Optional[Dict]:
+        """The fields of a stream, None if there is no such stream"""
+        raise NotImplementedError
+
+    def delete(self, stream_id: str):
+        """Remove a stream"""
+        raise NotImplementedError
+
+    def purge(self, before: int):
+        """Remove the streams created before before"""
+        raise NotImplementedError
+
+
+class DatabaseStreamStore(StreamStore):
+    """Streams in the streams table, shared by all workers"""
+
+    table = database.StoredStream.__table__
+
+    def create(self, stream_id: str, kind: str, created: int):
+        """Add a queued stream"""
+        with database.get_engine().begin() as connection:
+            connection.execute(
+                sqlalchemy.insert(self.table).values(
+                    id=stream_id,
+                    kind=kind,
+                    status="queued",
+                    text="",
+                    created_timestamp=created,
+                )
+            )
+
+    def update(self, stream_id: str, fields: Dict) -> bool:
+        """Change a stream, False if it was removed, i.e. cancelled"""
+        with database.get_engine().begin() as connection:
+            return bool(
+                connection.execute(
+                    sqlalchemy.update(self.table)
+                    .where(self.table.c.id == stream_id)
+                    .values(**fields)
+                ).rowcount
+            )
+
+    def load(self, stream_id: str) -> Optional[Dict]:
+        """The fields of a stream, None if there is no such stream"""
+        with database.get_engine().connect() as connection:
+            row = connection.execute(
+                sqlalchemy.select(self.table).where(self.table.c.id == stream_id)
+            ).first()
+        return None if row is None else dict(row._mapping)
+
+    def delete(self, stream_id: str):
+        """Remove a stream"""
+        with database.get_engine().begin() as connection:
+            connection.execute(
+                sqlalchemy.delete(self.table).where(self.table.c.id == stream_id)
+            )
+
+    def purge(self, before: int):
+        """Remove the streams created before before"""
+        with database.get_engine().begin() as connection:
+            connection.execute(
+                sqlalchemy.delete(self.table).where(
+                    self.table.c.created_timestamp < before
+                )
+            )
+
+
+class MemoryStreamStore(StreamStore):
+    """Streams in a dict, only for a single process, e.g. in development"""
+
+    def __init__(self):
+        self.streams: Dict[str, Dict] = {}
+        self.lock = threading.Lock()
+
+    def create(self, stream_id: str, kind: str, created: int):
+        """Add a queued stream"""
+        self.streams[stream_id] = {
+            "id": stream_id,
+            "kind": kind,
+            "status": "queued",
+            "text": "",
+            "error": None,
+            "result": None,
+            "created_timestamp": created,
+        }
+
+    def update(self, stream_id: str, fields: Dict) -> bool:
+        """Change a stream, False if it was removed, i.e. cancelled"""
+        with self.lock:
+            if stream_id not in self.streams:
+                return False
+            self.streams[stream_id] = dict(self.streams[stream_id], **fields)
+            return True
+
+    def load(self, stream_id: str) -> Optional[Dict]:
+        """The fields of a stream, None if there is no such stream"""
+        return self.streams.get(stream_id)
+
+    def delete(self, stream_id: str):
+        """Remove a stream"""
+        self.streams.pop(stream_id, None)
+
+    def purge(self, before: int):
+        """Remove the streams created before before"""
+        with self.lock:
+            for stream_id, fields in list(self.streams.items()):
+                if fields["created_timestamp"] < before:
+                    del self.streams[stream_id]
+
+
+class Stream:
+    """
+    Text produced so far by a background completion
+
+    The background thread writes to a stream that has a store, get returns
+    a copy loaded from the store.
+    """
+
+    def __init__(
+        self,
+        kind: str,
+        stream_id: Optional[str] = None,
+        stream_store: Optional[StreamStore] = None,
+        flush_interval: float = DEFAULT_FLUSH_INTERVAL,
+    ):
+        self.kind = kind
+        self.id = stream_id
+        self.store = stream_store
+        self.flush_interval = flush_interval
+        self.flushed = 0.0
+        self.status = "queued"
+        self.chunks: List[str] = []
+        self.error: Optional[str] = None
+        self.result: Dict = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_fields(cls, fields: Dict) -> "Stream":
+        """A copy of a stream as it was stored"""
+        stream = cls(fields["kind"])
+        stream.status = fields["status"]
+        stream.chunks = [fields["text"]]
+        stream.error = fields["error"]
+        stream.result = json.loads(fields["result"] or "{}")
+        return stream
+
+    @property
+    def done(self) -> bool:
+        """Whether the stream stopped, for whatever reason"""
+        return self.status in ("done", "failed", "cancelled")
+
+    @property
+    def cancelled(self) -> bool:
+        """Whether the stream was cancelled"""
+        return self.status == "cancelled"
+
+    def write(self, text: str):
+        """Add a chunk of text, raises StreamCancelled if nobody wants it anymore"""
+        if self.cancelled:
+            raise StreamCancelled()
+        with self.lock:
+            self.chunks.append(text)
+        if time.monotonic() - self.flushed >= self.flush_interval:
+            self.flush()
+
+    def clear(self):
+        """Drop the text written so far, e.g. to start over"""
+        if self.cancelled:
+            raise StreamCancelled()
+        with self.lock:
+            self.chunks = []
+        self.flush()
+
+    def text(self) -> str:
+        """All text written so far"""
+        with self.lock:
+            return "".join(self.chunks)
+
+    def progress(self) -> str:
+        """Human readable progress"""
+        if self.status == "queued":
+            return "Waiting for a free worker..."
+        if self.status == "running":
+            with self.lock:
+                received = sum(len(chunk) for chunk in self.chunks)
+            return f"Generating, {received} characters received..."
+        return ""
+
+    def flush(self):
+        """Write the stream to the store, it is cancelled if it was removed"""
+        self.flushed = time.monotonic()
+        if self.store is None or self.cancelled:
+            return
+        fields = {
+            "status": self.status,
+            "text": self.text(),
+            "error": self.error,
+            "result": json.dumps(self.result),
+        }
+        if not self.store.update(self.id, fields):
+            self.status = "cancelled"
+
+    def start(self):
+        """Mark the stream as running"""
+        if not self.cancelled:
+            self.status = "running"
+            self.flush()
+
+    def finish(self, **result):
+        """Mark the stream as done, result holds whatever the poller needs"""
+        self.result = result
+        if not self.cancelled:
+            self.status = "done"
+            self.flush()
+
+    def fail(self, error: str):
+        """Mark the stream as failed"""
+        if not self.cancelled:
+            self.error = error
+            self.status = "failed"
+            self.flush()
+
+    def cancel(self):
+        """Stop the stream, the background thread notices on its next write"""
+        if not self.done:
+            self.status = "cancelled"
+
+
+def create_store(store_type: str) -> StreamStore:
+    """Create the store configured as store under jobs"""
+    if store_type == "database":
+        return DatabaseStreamStore()
+    if store_type == "memory":
+        return MemoryStreamStore()
+    raise ValueError(f"Unknown stream store: {store_type}")
+
+
+_store: Optional[StreamStore] = None
+_executor: Optional[ThreadPoolExecutor] = None
+_purged = 0.0
+
+
+def _reset_after_fork():
+    """The threads of the parent don't exist in a forked worker"""
+    global _executor, _store
+    _executor = None
+    _store = None
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def jobs_settings() -> Dict:
+    """The jobs section of the settings"""
+    return app_globals.app_settings.get("jobs", {})
+
+
+def store() -> StreamStore:
+    """The stream store configured under jobs"""
+    global _store
+    if _store is None:
+        _store = create_store(jobs_settings().get("store", DEFAULT_STORE))
+    return _store
+
+
+def executor() -> ThreadPoolExecutor:
+    """The thread pool running the completions, bounded by the jobs setting"""
+    global _executor
+    if _executor is None:
+        max_workers = jobs_settings().get("max_workers", DEFAULT_MAX_WORKERS)
+        _executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="completion"
+        )
+    return _executor
+
+
+def start(kind: str, target: Callable[[Stream], None]) -> str:
+    """Queue target, passing it a new stream, and return the stream id"""
+    global _purged
+    now = time.time()
+    if now - _purged > PURGE_INTERVAL:
+        _purged = now
+        store().purge(int(now - MAX_STREAM_AGE))
+
+    stream_id = uuid.uuid4().hex
+    store().create(stream_id, kind, int(now))
+    stream = Stream(
+        kind,
+        stream_id,
+        store(),
+        jobs_settings().get("flush_interval", DEFAULT_FLUSH_INTERVAL),
+    )
+
+    def run():
+        """Run target and record a failure on the stream"""
+        stream.start()
+        if stream.cancelled:
+            return
+        try:
+            target(stream)
+        except StreamCancelled:
+            pass
+        except Exception as e:
+            traceback.print_exc()
+            stream.fail(str(e))
+
+    executor().submit(run)
+    return stream_id
+
+
+def get(stream_id: Optional[str]) -> Optional[Stream]:
+    """The stream as it was last written, by any worker"""
+    if stream_id is None:
+        return None
+    fields = store().load(stream_id)
+    return None if fields is None else Stream.from_fields(fields)
+
+
+def cancel(stream_id: Optional[str]):
+    """Cancel a stream and forget about it"""
+    if stream_id is not None:
+        discard(stream_id)
+
+
+def discard(stream_id: str):
+    """Forget about a stream"""
+    store().delete(stream_id)
@@ -0,0 +1,65 @@
+"""Make the modules of the app importable and give them settings"""
+import importlib.util
+import os
+import sys
+
+import pytest
+import yaml
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+# Otherwise the settings would be read from the first argument of pytest.
+os.environ.setdefault("GPTUTOR_SETTINGS", os.path.join(ROOT, "gptutor.example.yaml"))
+
+import completion_backends  # noqa: E402
+import database  # noqa: E402
+import gpt  # noqa: E402
+import migrations  # noqa: E402
+
+
+@pytest.fixture
+def engine(monkeypatch, tmp_path):
+    """An empty database used by database.get_engine"""
+    # A file, so threads share it, in-memory databases are per connection.
+    engine = database.create_engine_from_settings(
+        {"url": "sqlite:///" + str(tmp_path / "gptutor.sqlite")}
+    )
+    migrations.upgrade(engine)
+    monkeypatch.setattr(database, "engine", engine)
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture
+def fake_backend(monkeypatch):
+    """Completions from the fake backend, without waiting"""
+    backend = completion_backends.FakeBackend(
+        latency=0, tokens_per_second=1e6, reply_tokens=20
+    )
+    monkeypatch.setattr(gpt, "_backend", backend)
+    return backend
+
+
+def load_benchmark(name: str):
+    """Import a script from the benchmarks directory"""
+    # After the app, so the benchmarks can't shadow its modules.
+    benchmarks = os.path.join(ROOT, "benchmarks")
+    if benchmarks not in sys.path:
+        sys.path.append(benchmarks)
+    spec = importlib.util.spec_from_file_location(
+        name, os.path.join(ROOT, "benchmarks", name + ".py")
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture
+def settings_path(tmp_path):
+    """The example settings with a database in tmp_path"""
+    with open(os.path.join(ROOT, "gptutor.example.yaml")) as example:
+        settings = yaml.safe_load(example)
+    settings["database"]["url"] = "sqlite:///" + str(tmp_path / "gptutor.sqlite")
+    path = tmp_path / "gptutor.yaml"
+    path.write_text(yaml.safe_dump(settings))
+    return str(path)
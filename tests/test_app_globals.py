@@ -0,0 +1,72 @@
+"""Tests of loading the settings in app_globals.py"""
+import os
+
+import pytest
+
+import app_globals
+from conftest import load_benchmark
+
+startup = load_benchmark("startup")
+
+
+@pytest.fixture
+def settings_file(tmp_path, monkeypatch):
+    """A settings file that is checked for changes on every read"""
+    monkeypatch.setattr(app_globals, "RELOAD_CHECK_INTERVAL", 0)
+    path = tmp_path / "settings.yaml"
+    path.write_text("topics: [Python]\ndatabase:\n  url: sqlite://\n")
+    return path
+
+
+def rewrite(path, text: str):
+    """Change the file and make sure its modification time moves"""
+    modified = os.stat(path).st_mtime
+    path.write_text(text)
+    os.utime(path, (modified + 1, modified + 1))
+
+
+def test_settings_are_loaded_once_per_process(settings_path):
+    """Starting the app reads the settings file once"""
+    assert startup.start_up(settings_path)["loads"] == 1
+
+
+def test_environment_overrides(settings_file, monkeypatch):
+    """GPTUTOR_ variables override keys, in sections too, parsed as yaml"""
+    monkeypatch.setenv("GPTUTOR_DATABASE__URL", "sqlite:///other.sqlite")
+    monkeypatch.setenv("GPTUTOR_JOBS__MAX_WORKERS", "4")
+    settings = app_globals.Settings(str(settings_file))
+    assert settings["database"] == {"url": "sqlite:///other.sqlite"}
+    assert settings["jobs"] == {"max_workers": 4}
+    assert settings["topics"] == ["Python"]
+
+
+def test_changed_file_is_loaded_again(settings_file):
+    """A change to the file is picked up, an unchanged file is not read again"""
+    settings = app_globals.Settings(str(settings_file))
+    assert settings["topics"] == ["Python"]
+    version = settings.version
+    assert settings["topics"] == ["Python"]
+    assert settings.loads == 1
+
+    rewrite(settings_file, "topics: [SQL]\n")
+    assert settings["topics"] == ["SQL"]
+    assert settings.version != version
+
+
+def test_broken_file_keeps_the_last_settings(settings_file):
+    """A file that doesn't parse or is gone leaves the settings as they were"""
+    settings = app_globals.Settings(str(settings_file))
+    assert settings["topics"] == ["Python"]
+
+    rewrite(settings_file, "topics: [unclosed\n")
+    assert settings["topics"] == ["Python"]
+    os.remove(settings_file)
+    assert settings["topics"] == ["Python"]
+
+    settings_file.write_text("topics: [SQL]\n")
+    assert settings["topics"] == ["SQL"]
+
+
+def test_missing_file_on_first_load():
+    """Without a file the settings start empty"""
+    assert dict(app_globals.Settings("/nonexistent/settings.yaml")) == {}
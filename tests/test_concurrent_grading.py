@@ -0,0 +1,47 @@
+"""Concurrent users must be graded against their own exercise"""
+import pytest
+
+import app_globals
+import main
+import rate_limit
+import write_behind
+from conftest import load_benchmark
+
+grading = load_benchmark("concurrent_grading")
+
+USERS = 8
+
+
+@pytest.fixture(scope="module")
+def app():
+    """The app, created once, Dash takes the page callbacks only once"""
+    return main.create_app(app_globals.app_settings)
+
+
+@pytest.fixture
+def unlimited(monkeypatch):
+    """Rate limits that all simulated users fit in"""
+    monkeypatch.setattr(
+        rate_limit,
+        "_limiter",
+        rate_limit.RateLimiter(60 * USERS, USERS, 60 * USERS, 2 * USERS),
+    )
+
+
+@pytest.mark.parametrize("with_write_behind", [False, True])
+def test_no_cross_talk(
+    app, engine, fake_backend, unlimited, monkeypatch, with_write_behind
+):
+    """Every answer is evaluated and saved with the exercise of its user"""
+    monkeypatch.setattr(write_behind, "_writer", None)
+    if with_write_behind:
+        monkeypatch.setitem(app_globals.app_settings, "write_behind", {})
+
+    user_ids = grading.create_users(USERS)
+    evaluated = grading.run_users(app, USERS, user_ids)
+    write_behind.flush()
+    answers, misplaced = grading.saved_answers(user_ids)
+
+    assert all(evaluated)
+    assert len(answers) == len(user_ids)
+    assert misplaced == []
@@ -0,0 +1,58 @@
+"""Tests of the queries in database.py"""
+import sqlalchemy
+
+import database
+from app_globals import MessageType
+
+
+def count_statements(engine):
+    """A list that gets the SQL of every statement run on engine"""
+    statements = []
+
+    @sqlalchemy.event.listens_for(engine, "before_cursor_execute")
+    def count(_connection, _cursor, statement, *_):
+        """Remember the statement"""
+        statements.append(statement)
+
+    return statements
+
+
+def test_fetch_exercise_detail_runs_one_statement(engine):
+    """The exercise and the wanted messages come in one query"""
+    with database.Session(engine) as session:
+        user = database.User(username="user", email="user@example.com", password="")
+        session.add(user)
+        session.flush()
+        exercise = database.save_exercise(session, user.id, "Title", 0)
+        session.add_all(
+            database.Message(
+                exercise=exercise,
+                role="user",
+                text=message_type.name,
+                message_type=message_type,
+            )
+            for message_type in MessageType
+        )
+        session.commit()
+        user_id, exercise_id = user.id, exercise.id
+
+    statements = count_statements(engine)
+    wanted = [MessageType.INITIAL_EXERCISE, MessageType.EXERCISE_EVAL]
+    detail = database.fetch_exercise_detail(user_id, exercise_id, wanted)
+
+    assert [message.message_type for message in detail.messages] == wanted
+    assert detail.title == "Title"
+    assert len(statements) == 1
+
+
+def test_fetch_exercise_detail_of_another_user(engine):
+    """Exercises of other users are not found"""
+    with database.Session(engine) as session:
+        user = database.User(username="user", email="user@example.com", password="")
+        session.add(user)
+        session.flush()
+        exercise = database.save_exercise(session, user.id, "Title", 0)
+        session.commit()
+        user_id, exercise_id = user.id, exercise.id
+
+    assert database.fetch_exercise_detail(user_id + 1, exercise_id, []) is None
@@ -0,0 +1,147 @@
+"""Tests of the pool of ready exercises in exercise_pool.py"""
+import threading
+import time
+
+import pytest
+
+import app_globals
+import exercise_cache
+import exercise_pool
+import exercises
+
+KEYS = [("Easy", "Python", "15 minutes"), ("Hard", "SQL", "1 hour")]
+
+
+class StubGenerate:
+    """Stands in for exercises.new_exercise, counts calls and concurrency"""
+
+    def __init__(self, delay: float = 0.0, gate: threading.Event = None):
+        self.delay = delay
+        self.gate = gate
+        self.calls = 0
+        self.running = 0
+        self.max_running = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, level: str, topic: str, duration: str):
+        with self.lock:
+            self.calls += 1
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        if self.gate is not None:
+            self.gate.wait(5)
+        time.sleep(self.delay)
+        with self.lock:
+            self.running -= 1
+        return exercises.exercise_messages(
+            level, topic, duration, f"exercise {self.calls}", "title"
+        )
+
+
+def wait_until(condition, timeout: float = 5.0):
+    """Wait until condition returns true"""
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise TimeoutError
+        time.sleep(0.01)
+
+
+def full(pool: exercise_pool.ExercisePool) -> bool:
+    """Whether every queue of pool holds depth exercises"""
+    return all(queue.qsize() == pool.depth for queue in pool.queues.values())
+
+
+@pytest.fixture
+def make_pool():
+    """Create pools that are shut down after the test"""
+    pools = []
+
+    def make(*args, **kwargs):
+        pool = exercise_pool.ExercisePool(*args, **kwargs)
+        pools.append(pool)
+        return pool
+
+    yield make
+    for pool in pools:
+        pool.shutdown()
+
+
+def test_start_fills_to_depth(make_pool):
+    """Every option gets depth exercises"""
+    generate = StubGenerate()
+    pool = make_pool(KEYS, generate, depth=2, concurrency=2)
+    pool.start()
+    wait_until(lambda: full(pool))
+    assert generate.calls == 4
+
+
+def test_pop_refills(make_pool):
+    """Taking an exercise generates a new one"""
+    generate = StubGenerate()
+    pool = make_pool(KEYS, generate, depth=2, concurrency=2)
+    pool.start()
+    wait_until(lambda: full(pool))
+
+    messages = pool.pop(*KEYS[0])
+    assert messages[1]["content"].startswith("exercise")
+    wait_until(lambda: full(pool))
+    assert generate.calls == 5
+
+
+def test_concurrency_is_respected(make_pool):
+    """No more than concurrency exercises are generated at once"""
+    generate = StubGenerate(delay=0.02)
+    pool = make_pool(KEYS, generate, depth=3, concurrency=2)
+    pool.start()
+    wait_until(lambda: full(pool))
+    assert generate.max_running == 2
+
+
+def test_pop_without_exercise(make_pool):
+    """Unknown options and empty queues give None"""
+    gate = threading.Event()
+    pool = make_pool(KEYS, StubGenerate(gate=gate), depth=1, concurrency=1)
+    pool.start()
+    assert pool.pop("Easy", "Cobol", "15 minutes") is None
+    assert pool.pop(*KEYS[0]) is None
+    gate.set()
+
+
+@pytest.fixture
+def small_settings(engine, monkeypatch):
+    """Two exercise options and a pool in the settings"""
+    settings = app_globals.app_settings
+    monkeypatch.setitem(settings, "levels", ["Easy"])
+    monkeypatch.setitem(settings, "topics", ["Python", "SQL"])
+    monkeypatch.setitem(settings, "durations", ["15 minutes"])
+    monkeypatch.setitem(settings, "exercise_pool", {"depth": 2, "concurrency": 2})
+    monkeypatch.setitem(settings, "exercise_cache", {"max_entries": 20})
+    monkeypatch.setattr(exercise_pool, "pool", None)
+    yield settings
+    if exercise_pool.pool is not None:
+        exercise_pool.pool.shutdown()
+
+
+def test_start_seeds_from_the_cache(small_settings):
+    """Cached exercises are used before any are generated"""
+    for number in range(3):
+        exercise_cache.store("Easy", "Python", "15 minutes", f"cached {number}", "t")
+    generate = StubGenerate()
+    exercise_pool.start(small_settings, generate, exercises.cached_exercises)
+    wait_until(lambda: full(exercise_pool.pool))
+
+    # Python is filled from the cache, only SQL is generated.
+    assert generate.calls == 2
+    python = exercise_pool.pop("Easy", "Python", "15 minutes")
+    assert python[1]["content"].startswith("cached")
+
+
+def test_start_generates_with_the_backend(small_settings, fake_backend):
+    """The pool fills with exercises from the completion backend"""
+    exercise_pool.start(small_settings, exercises.new_exercise)
+    wait_until(lambda: full(exercise_pool.pool))
+
+    messages = exercise_pool.pop("Easy", "SQL", "15 minutes")
+    assert messages[1]["content"].startswith("word0")
+    assert messages[3]["content"]
@@ -0,0 +1,56 @@
+"""Tests of streaming new exercises in exercises.py"""
+import pytest
+
+import app_globals
+import exercise_pool
+import exercises
+import gpt
+import streaming
+
+
+@pytest.fixture
+def single_request(engine, monkeypatch):
+    """Generate exercises with one JSON completion, without a pool"""
+    monkeypatch.setitem(app_globals.app_settings, "single_request_generation", True)
+    monkeypatch.setattr(exercise_pool, "pool", None)
+
+
+def stub_completions(monkeypatch, json_reply: str):
+    """Let the first streamed completion be json_reply, the fallback plain text"""
+    replies = [json_reply, "Fallback exercise"]
+
+    def stream_completion(messages, shared: bool = False):
+        reply = replies.pop(0)
+        for start in range(0, len(reply), 5):
+            yield reply[start : start + 5]
+
+    monkeypatch.setattr(gpt, "stream_completion", stream_completion)
+    monkeypatch.setattr(
+        gpt,
+        "get_completion",
+        lambda messages, shared=False: {"message": {"content": "Title"}},
+    )
+
+
+def test_partial_exercise_is_replaced_by_the_fallback(single_request, monkeypatch):
+    """A reply that breaks in the exercise doesn't leave its start in the stream"""
+    stub_completions(monkeypatch, '{"exercise": "Write a func')
+    stream = streaming.Stream("exercise")
+    messages = exercises.stream_exercise(
+        "Easy", "Python", "15 minutes", stream.write, stream.clear
+    )
+    assert stream.text() == "Fallback exercise"
+    assert messages[1]["content"] == "Fallback exercise"
+    assert messages[3]["content"] == "Title"
+
+
+def test_complete_exercise_is_kept_when_the_title_is_bad(single_request, monkeypatch):
+    """Only the title is asked for again when the whole exercise arrived"""
+    stub_completions(monkeypatch, '{"exercise": "Write a function", "title": 5}')
+    stream = streaming.Stream("exercise")
+    messages = exercises.stream_exercise(
+        "Easy", "Python", "15 minutes", stream.write, stream.clear
+    )
+    assert stream.text() == "Write a function"
+    assert messages[1]["content"] == "Write a function"
+    assert messages[3]["content"] == "Title"
@@ -0,0 +1,19 @@
+"""
+The deterministic cold start checks of benchmarks/import_budget.py
+
+The import time itself depends on the machine, the benchmark checks it.
+"""
+import json
+
+from conftest import load_benchmark
+
+import_budget = load_benchmark("import_budget")
+
+
+def test_create_app_defers_imports_and_engine(settings_path):
+    """Creating the app doesn't import openai or bcrypt or create an engine"""
+    output = import_budget.run(settings_path, "-c", import_budget.CREATE_APP).stdout
+    created = json.loads(output.splitlines()[-1])
+    for name in import_budget.DEFERRED:
+        assert name not in created["modules"]
+    assert not created["engine"]
@@ -0,0 +1,38 @@
+"""Tests of the password worker processes in passwords.py"""
+import os
+import signal
+
+import pytest
+
+import passwords
+
+
+@pytest.fixture
+def fast_passwords(monkeypatch):
+    """Cheap hashes and a single worker process, shut down afterwards"""
+    monkeypatch.setattr(passwords, "settings", lambda: {"rounds": 4, "workers": 1})
+    monkeypatch.setattr(passwords, "_pool", None)
+    monkeypatch.setattr(passwords, "_slots", None)
+    yield
+    if passwords._pool is not None:
+        passwords._pool.shutdown()
+
+
+def test_hash_and_check(fast_passwords):
+    """A hash matches its password only"""
+    hashed = passwords.hash_password("secret")
+    assert passwords.check_password("secret", hashed)
+    assert not passwords.check_password("wrong", hashed)
+    assert not passwords.needs_rehash(hashed)
+
+
+def test_pool_recovers_from_a_dead_worker(fast_passwords):
+    """A killed worker process doesn't break later calls"""
+    hashed = passwords.hash_password("secret")
+    broken = passwords._pool
+    for process in list(broken._processes.values()):
+        os.kill(process.pid, signal.SIGKILL)
+        process.join()
+
+    assert passwords.check_password("secret", hashed)
+    assert passwords._pool is not broken
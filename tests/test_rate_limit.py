@@ -0,0 +1,92 @@
+"""Tests of the coalescing of identical calls in rate_limit.py"""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import rate_limit
+
+
+def gated_call(gate: threading.Event, calls: list):
+    """A call that yields a first chunk, then waits for gate to yield the rest"""
+
+    def call():
+        calls.append(1)
+        yield "first "
+        gate.wait(5)
+        yield "second "
+        yield "third"
+
+    return call
+
+
+def test_followers_share_the_call():
+    """Callers arriving while a call runs get its result without calling"""
+    flights = rate_limit.SingleFlight()
+    gate = threading.Event()
+    calls = []
+    leader = flights.stream("key", gated_call(gate, calls))
+    assert next(leader) == "first "
+    with ThreadPoolExecutor(2) as executor:
+        followers = [
+            executor.submit(lambda: "".join(flights.stream("key", lambda: iter(()))))
+            for _ in range(2)
+        ]
+        while flights.coalesced < 2:
+            time.sleep(0.01)
+        gate.set()
+        assert "".join(leader) == "second third"
+        assert [future.result(5) for future in followers] == ["first second third"] * 2
+    assert calls == [1]
+    assert flights.coalesced == 2
+
+
+def test_leader_that_stops_reading_doesnt_break_followers():
+    """A cancelled leader leaves the rest of the call to its followers"""
+    flights = rate_limit.SingleFlight()
+    gate = threading.Event()
+    calls = []
+    leader = flights.stream("key", gated_call(gate, calls))
+    assert next(leader) == "first "
+    follower = flights.stream("key", lambda: iter(()))
+    assert next(follower) == "first "
+
+    leader.close()
+    gate.set()
+    assert "".join(follower) == "second third"
+    assert calls == [1]
+    assert flights.flights == {}
+
+
+def test_leader_without_followers_stops_the_call():
+    """Nobody reads the rest of a call that nobody waits for"""
+    flights = rate_limit.SingleFlight()
+    gate = threading.Event()
+    calls = []
+    leader = flights.stream("key", gated_call(gate, calls))
+    next(leader)
+    leader.close()
+    assert flights.flights == {}
+    assert "".join(flights.stream("key", lambda: iter(["new"]))) == "new"
+
+
+def test_errors_reach_the_followers():
+    """A failing call fails for every caller"""
+    flights = rate_limit.SingleFlight()
+    gate = threading.Event()
+
+    def call():
+        yield "first "
+        gate.wait(5)
+        raise ValueError("broken")
+
+    leader = flights.stream("key", call)
+    next(leader)
+    follower = flights.stream("key", lambda: iter(()))
+    assert next(follower) == "first "
+    gate.set()
+    with pytest.raises(ValueError):
+        list(leader)
+    with pytest.raises(ValueError):
+        list(follower)
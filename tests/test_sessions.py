@@ -0,0 +1,36 @@
+"""Tests of the server side sessions in sessions.py"""
+import pytest
+
+import sessions
+
+
+@pytest.fixture(params=["database", "memory"])
+def session_cache(engine, request):
+    """Sessions in a fresh store, without a cache"""
+    return sessions.Sessions(
+        sessions.create_store(request.param),
+        lifetime=3600,
+        cache_ttl=0,
+        max_entries=10,
+    )
+
+
+def test_new_session_is_created(session_cache):
+    """A new session can be loaded after it was created"""
+    session_cache.create("new", {"user": 1})
+    assert session_cache.load("new")[0] == {"user": 1}
+
+
+def test_changed_session_is_updated(session_cache):
+    """Saving a session replaces its data"""
+    session_cache.create("id", {"user": 1})
+    assert session_cache.save("id", {"user": 2}) is not None
+    assert session_cache.load("id")[0] == {"user": 2}
+
+
+def test_revoked_session_is_not_stored_again(session_cache):
+    """A request still carrying a revoked id can't bring the session back"""
+    session_cache.create("id", {"user": 1})
+    session_cache.revoke("id")
+    assert session_cache.save("id", {"user": 1, "changed": True}) is None
+    assert session_cache.load("id") is None
@@ -0,0 +1,73 @@
+"""Tests of the background streams in streaming.py"""
+import time
+
+import pytest
+
+import streaming
+
+
+@pytest.fixture
+def stream_store(engine, monkeypatch):
+    """A fresh database stream store that flushes every write"""
+    monkeypatch.setattr(streaming, "_store", streaming.DatabaseStreamStore())
+    monkeypatch.setattr(streaming, "jobs_settings", lambda: {"flush_interval": 0})
+    return streaming.store()
+
+
+def wait_until(condition, timeout: float = 5.0):
+    """Wait until condition returns true"""
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise TimeoutError
+        time.sleep(0.01)
+
+
+def test_stream_is_read_from_the_store(stream_store):
+    """A poll sees the text and result of a stream through the store"""
+    stream_id = streaming.start(
+        "exercise", lambda stream: (stream.write("Text"), stream.finish(title="T"))
+    )
+    wait_until(lambda: streaming.get(stream_id).done)
+
+    # Another worker has no reference to the stream, only the store.
+    stream = streaming.Stream.from_fields(stream_store.load(stream_id))
+    assert stream.status == "done"
+    assert stream.text() == "Text"
+    assert stream.result == {"title": "T"}
+
+    streaming.discard(stream_id)
+    assert streaming.get(stream_id) is None
+
+
+def test_cancel_stops_the_writer(stream_store):
+    """Cancelling through the store stops the background thread"""
+    events = []
+
+    def target(stream):
+        """Write until cancelled"""
+        try:
+            while True:
+                stream.write("chunk ")
+                time.sleep(0.01)
+        except streaming.StreamCancelled:
+            events.append("cancelled")
+            raise
+
+    stream_id = streaming.start("exercise", target)
+    wait_until(lambda: streaming.get(stream_id).status == "running")
+    streaming.cancel(stream_id)
+    wait_until(lambda: events == ["cancelled"])
+    assert streaming.get(stream_id) is None
+
+
+def test_failure_is_stored(stream_store):
+    """An exception in the target fails the stream"""
+
+    def target(_stream):
+        """Fail right away"""
+        raise RuntimeError("broken")
+
+    stream_id = streaming.start("evaluation", target)
+    wait_until(lambda: streaming.get(stream_id).done)
+    assert streaming.get(stream_id).error == "broken"
@@ -0,0 +1,57 @@
+"""Count tokens locally, with tiktoken when it is installed"""
+from typing import Optional
+
+try:
+    import tiktoken
+except ImportError:  # Optional, the estimate below is good enough.
+    tiktoken = None
+
+# Rough average for English text, used without tiktoken.
+CHARACTERS_PER_TOKEN = 4
+ENCODING = "cl100k_base"
+
+_encoding = None
+
+
+def encoding():
+    """The tiktoken encoding used by the chat models, None without tiktoken"""
+    global _encoding
+    if _encoding is None and tiktoken is not None:
+        _encoding = tiktoken.get_encoding(ENCODING)
+    return _encoding
+
+
+def count_tokens(text: str) -> int:
+    """The number of tokens in text"""
+    if encoding() is not None:
+        return len(encoding().encode(text))
+    return len(text) // CHARACTERS_PER_TOKEN + 1
+
+
+def truncate(text: str, max_tokens: int, marker: Optional[str] = None) -> str:
+    """
+    Shorten text to about max_tokens tokens
+
+    The start and the end of the text are kept, the middle is replaced by a
+    marker saying how much was left out. The marker counts towards max_tokens.
+    """
+    total = count_tokens(text)
+    if total <= max_tokens:
+        return text
+    if marker is None:
+        marker = "\n[... {} tokens left out ...]\n".format(total - max_tokens)
+    keep = max(max_tokens - count_tokens(marker), 0)
+    head = keep // 2
+    tail = keep - head
+    if encoding() is not None:
+        tokens = encoding().encode(text)
+        return (
+            encoding().decode(tokens[:head])
+            + marker
+            + encoding().decode(tokens[len(tokens) - tail :])
+        )
+    return (
+        text[: head * CHARACTERS_PER_TOKEN]
+        + marker
+        + text[len(text) - tail * CHARACTERS_PER_TOKEN :]
+    )
@@ -0,0 +1,184 @@
+"""
+Write exercises and messages to the database in batches on a background thread
+
+Requests queue their inserts and return without waiting for the commit. The
+writer collects what arrives within flush_interval seconds, up to max_batch
+items, and inserts it in one transaction with one executemany per table.
+"""
+import atexit
+import os
+import queue
+import signal
+import sys
+import threading
+import traceback
+from concurrent.futures import Future
+from typing import Dict, List, Optional
+
+import sqlalchemy
+from sqlalchemy.engine import Engine
+
+import app_globals
+import database
+
+DEFAULT_FLUSH_INTERVAL = 0.05
+DEFAULT_MAX_BATCH = 500
+
+
+class _Exercise:
+    """An exercise with its messages waiting to be written"""
+
+    def __init__(self, row: Dict, messages: List[Dict]):
+        self.row = row
+        self.messages = messages
+        self.future: Future = Future()
+
+
+class WriteBehind:
+    """A queue of inserts written in batches by a background thread"""
+
+    def __init__(self, engine: Engine, flush_interval: float, max_batch: int):
+        self.engine = engine
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.queue: queue.Queue = queue.Queue()
+        self.batches = 0
+        self.rows = 0
+        self.thread = threading.Thread(
+            target=self.run, name="write-behind", daemon=True
+        )
+        self.thread.start()
+
+    def save_exercise(
+        self, user_id: int, title: str, start_timestamp: float, messages: List[Dict]
+    ) -> Future:
+        """Queue an exercise and its messages, the future gets the exercise id"""
+        item = _Exercise(
+            {
+                "user_id": user_id,
+                "title": title,
+                "start_timestamp": int(start_timestamp),
+            },
+            messages,
+        )
+        self.queue.put(item)
+        return item.future
+
+    def add_messages(self, messages: List[Dict]):
+        """Queue messages of an exercise that is already saved"""
+        self.queue.put(messages)
+
+    def depth(self) -> int:
+        """The number of items waiting to be written"""
+        return self.queue.qsize()
+
+    def flush(self):
+        """Wait until everything queued so far is written"""
+        self.queue.join()
+
+    def stats(self) -> Dict:
+        """Queue depth and totals for monitoring"""
+        return {"queue_depth": self.depth(), "batches": self.batches, "rows": self.rows}
+
+    def run(self):
+        """Collect batches from the queue and write them, forever"""
+        while True:
+            batch = [self.queue.get()]
+            try:
+                while len(batch) < self.max_batch:
+                    batch.append(self.queue.get(timeout=self.flush_interval))
+            except queue.Empty:
+                pass
+            try:
+                self.write(batch)
+            except Exception as e:
+                traceback.print_exc()
+                for item in batch:
+                    if isinstance(item, _Exercise) and not item.future.done():
+                        item.future.set_exception(e)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    def write(self, batch: List):
+        """Insert a batch in a single transaction"""
+        new_exercises = [item for item in batch if isinstance(item, _Exercise)]
+        messages = [
+            message for item in batch if isinstance(item, list) for message in item
+        ]
+        exercise_ids = []
+        with self.engine.begin() as connection:
+            if new_exercises:
+                exercise_ids = connection.scalars(
+                    sqlalchemy.insert(database.Exercise).returning(
+                        database.Exercise.id, sort_by_parameter_order=True
+                    ),
+                    [item.row for item in new_exercises],
+                ).all()
+                for item, exercise_id in zip(new_exercises, exercise_ids):
+                    messages.extend(
+                        dict(message, exercise_id=exercise_id)
+                        for message in item.messages
+                    )
+            if messages:
+                connection.execute(sqlalchemy.insert(database.Message), messages)
+        for item, exercise_id in zip(new_exercises, exercise_ids):
+            item.future.set_result(exercise_id)
+        self.batches += 1
+        self.rows += len(new_exercises) + len(messages)
+
+
+_writer: Optional[WriteBehind] = None
+_writer_lock = threading.Lock()
+
+
+def writer() -> Optional[WriteBehind]:
+    """The writer configured under write_behind, None when it is not enabled"""
+    global _writer
+    settings = app_globals.app_settings.get("write_behind")
+    if settings is None:
+        return None
+    with _writer_lock:
+        if _writer is None:
+            _writer = WriteBehind(
+                database.get_engine(),
+                settings.get("flush_interval", DEFAULT_FLUSH_INTERVAL),
+                settings.get("max_batch", DEFAULT_MAX_BATCH),
+            )
+    return _writer
+
+
+def flush():
+    """Wait until everything queued so far is written, if the writer runs"""
+    if _writer is not None:
+        _writer.flush()
+
+
+def _reset_after_fork():
+    """The writer thread of the parent doesn't exist in a forked worker"""
+    global _writer, _writer_lock
+    _writer = None
+    _writer_lock = threading.Lock()
+
+
+def _flush_on_sigterm(signum, frame):
+    """Write the queue before the process is terminated"""
+    flush()
+    if callable(_previous_sigterm):
+        _previous_sigterm(signum, frame)
+    elif _previous_sigterm != signal.SIG_IGN:
+        sys.exit(128 + signum)
+
+
+atexit.register(flush)
+os.register_at_fork(after_in_child=_reset_after_fork)
+# atexit doesn't run when SIGTERM kills the process, e.g. the development
+# server. Handlers that were installed already, like gunicorn's, still run.
+_previous_sigterm = None
+if threading.current_thread() is threading.main_thread():
+    _previous_sigterm = signal.signal(signal.SIGTERM, _flush_on_sigterm)
+
+
+def stats() -> Dict:
+    """Statistics of the writer, empty when it is not running"""
+    return {} if _writer is None else _writer.stats()
@@ -0,0 +1,17 @@
+"""
+WSGI entry point for servers like gunicorn and uWSGI
+
+Point GPTUTOR_SETTINGS at the settings file and run the migrations first, e.g.
+
+    python migrations.py gptutor.yaml
+    GPTUTOR_SETTINGS=gptutor.yaml gunicorn --workers 4 --threads 8 wsgi:server
+
+The background workers start with the first request of each process.
+"""
+import app_globals
+import main
+
+app = main.create_app(app_globals.app_settings)
+main.set_up_dash(app)
+main.start_workers_on_first_request(app, app_globals.app_settings)
+server = app.server